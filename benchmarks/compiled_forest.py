@@ -0,0 +1,99 @@
+"""compare the compiled forest with scikit-learn's predict_proba on synthetic inputs
+
+A pipeline with the same steps and forest size as the bundled model is fitted on the
+dummy data, since the bundled model is only distributed in compiled form.
+
+usage: python benchmarks/compiled_forest.py [--rows N] [--repeat N]
+"""
+
+from __future__ import annotations
+
+import argparse
+import time
+import warnings
+
+from typing import Any, Callable
+
+import numpy as np
+
+from civetqc.data import CivetData, QCRatingsData
+from civetqc.forest import CompiledForest
+
+DUMMY_DATA_PATH = "tests/dummy_data/dummy.csv"
+
+
+def synthetic_features(n_rows: int, seed: int = 0) -> np.ndarray:
+    """sample rows from the dummy data and perturb them with multiplicative noise"""
+    rng = np.random.default_rng(seed)
+    features = CivetData.from_csv(DUMMY_DATA_PATH).features
+    rows = features[rng.integers(0, len(features), n_rows)]
+    return rows * rng.normal(1, 0.05, rows.shape)
+
+
+def fit_reference_pipeline() -> Any:
+    from sklearn.ensemble import RandomForestClassifier
+    from sklearn.feature_selection import SelectPercentile, f_regression
+    from sklearn.pipeline import Pipeline
+    from sklearn.preprocessing import StandardScaler
+
+    return Pipeline(
+        [
+            ("scaler", StandardScaler()),
+            ("fs", SelectPercentile(score_func=f_regression, percentile=75)),
+            (
+                "clf",
+                RandomForestClassifier(
+                    n_estimators=336, max_depth=14, min_samples_leaf=5, random_state=0
+                ),
+            ),
+        ]
+    ).fit(
+        CivetData.from_csv(DUMMY_DATA_PATH).features,
+        QCRatingsData.from_csv(DUMMY_DATA_PATH).ratings,
+    )
+
+
+def best_time(func: Callable[[], object], repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start_time)
+    return min(times)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    warnings.filterwarnings("ignore", category=UserWarning)
+    clf = fit_reference_pipeline()
+    compile_time = best_time(lambda: CompiledForest.from_estimator(clf), 1)
+    forest = CompiledForest.from_estimator(clf)
+    features = synthetic_features(args.rows)
+
+    expected = clf.predict_proba(features)
+    max_difference = np.abs(forest.predict_probabilities(features) - expected).max()
+    print(f"compile time: {compile_time:.3f}s")
+    print(f"max abs difference on {args.rows} rows: {max_difference:.3g}")
+    assert max_difference <= 1e-12
+
+    for n_rows in (1, 100, args.rows):
+        batch = features[:n_rows]
+        repeat = args.repeat if n_rows == args.rows else 20
+        sklearn_time = best_time(lambda: clf.predict_proba(batch), repeat)
+        # the CLI used to call predict_proba once for ratings and once for probabilities
+        baseline_time = 2 * sklearn_time
+        compiled_time = best_time(lambda: forest.predict_probabilities(batch), repeat)
+        print(
+            f"{n_rows:>9} rows | predict_proba {n_rows / sklearn_time:>12,.0f} rows/s"
+            f" | compiled {n_rows / compiled_time:>12,.0f} rows/s"
+            f" | speedup vs predict_proba {sklearn_time / compiled_time:6.2f}x"
+            f" | vs previous CLI {baseline_time / compiled_time:6.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
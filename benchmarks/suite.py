@@ -0,0 +1,257 @@
+"""time and measure peak memory of the parse, predict and write paths on synthetic cohorts
+
+Cohorts are generated from the dummy data, both as an aggregated CSV and as a directory
+of civet_qc.txt files written by CivetData.to_output_files. Results are saved as JSON,
+and a previous results file can be given with --compare to report the change per case.
+
+usage: python benchmarks/suite.py [--sizes 1000,100000] [--max_files N] [--repeat N]
+                                  [--output PATH] [--compare PATH] [--tolerance 0.25]
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Callable
+
+import numpy as np
+
+from compiled_forest import synthetic_features
+
+from civetqc.data import CivetData, QCRatingsData
+from civetqc.model import Model
+
+RESULTS_DIR = Path(__file__).parent.joinpath("results")
+
+
+def write_cohort(dir_path: Path, n_subjects: int, max_files: int) -> dict[str, Path]:
+    """write a synthetic cohort as an aggregated CSV and, if small enough, as QC files"""
+    civet_data = CivetData(
+        np.array([f"sub{index:07d}" for index in range(n_subjects)]),
+        synthetic_features(n_subjects),
+    )
+    paths = {"csv": dir_path.joinpath("cohort.csv")}
+    with open(paths["csv"], "w") as file:
+        file.write(",".join(["ID", *CivetData.feature_names]) + "\n")
+        for subject_id, row in zip(civet_data.subject_ids, civet_data.features):
+            file.write(",".join([subject_id, *map(str, row)]) + "\n")
+    if n_subjects <= max_files:
+        paths["dir"] = dir_path.joinpath("qc")
+        paths["dir"].mkdir()
+        civet_data.to_output_files(paths["dir"])
+    return paths
+
+
+def measure(func: Callable[[], object], repeat: int) -> dict[str, float]:
+    """return the best wall time over repeat calls and the peak memory traced in one call"""
+    times = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start_time)
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"seconds": min(times), "peak_memory_mb": peak / 2**20}
+
+
+def measure_command(args: list[str], repeat: int) -> dict[str, float]:
+    """return the best wall time and largest resident set size of a subprocess"""
+    times = []
+    max_rss = 0
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        process = subprocess.Popen(args, stdout=subprocess.DEVNULL)
+        _, status, rusage = os.wait4(process.pid, 0)
+        times.append(time.perf_counter() - start_time)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, args)
+        # ru_maxrss is in kilobytes on linux and bytes on macos
+        scale = 1 if sys.platform == "darwin" else 1024
+        max_rss = max(max_rss, rusage.ru_maxrss * scale)
+    return {"seconds": min(times), "peak_memory_mb": max_rss / 2**20}
+
+
+def run_cohort(n_subjects: int, max_files: int, repeat: int) -> list[dict[str, Any]]:
+    results = []
+
+    def record(name: str, result: dict[str, float]) -> None:
+        results.append({"name": name, "n_subjects": n_subjects, **result})
+        print(
+            f"{name:<20} {n_subjects:>9} subjects | {result['seconds']:>9.4f}s"
+            f" | peak {result['peak_memory_mb']:>9.1f} MB"
+        )
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = write_cohort(Path(tmp_dir), n_subjects, max_files)
+        record("from_csv", measure(lambda: CivetData.from_csv(paths["csv"]), repeat))
+        if "dir" in paths:
+            record(
+                "from_output_files",
+                measure(lambda: CivetData.from_output_files(paths["dir"]), repeat),
+            )
+
+        civet_data = CivetData.from_csv(paths["csv"])
+        model = Model.load()
+        record(
+            "predict_probabilities",
+            measure(lambda: model.predict_probabilities(civet_data.features), repeat),
+        )
+
+        jobs = os.cpu_count() or 1
+        if jobs > 1:
+            with model.parallel(jobs):
+                # the pool is started by the first call, which is not timed
+                model.predict_probabilities(civet_data.features)
+                record(
+                    f"predict_jobs_{jobs}",
+                    measure(
+                        lambda: model.predict_probabilities(civet_data.features),
+                        repeat,
+                    ),
+                )
+
+        # Saabas explanations traverse the same paths, so should cost a small multiple
+        record(
+            "explain",
+            measure(lambda: model.explain(civet_data.features), repeat),
+        )
+
+        probabilities = model.predict_probabilities(civet_data.features)
+        qc_data = QCRatingsData(
+            civet_data.subject_ids,
+            model.ratings_from_probabilities(probabilities),
+            probabilities,
+        )
+        for output_format in ("csv", "json", "ndjson"):
+            output_filepath = Path(tmp_dir, f"civetqc.{output_format}")
+            record(
+                f"to_{output_format}",
+                measure(
+                    lambda: getattr(qc_data, f"to_{output_format}")(output_filepath),
+                    repeat,
+                ),
+            )
+
+        record(
+            "cli",
+            measure_command(
+                [sys.executable, "-m", "civetqc.main", str(paths["csv"])]
+                + ["--output_dir", tmp_dir],
+                repeat,
+            ),
+        )
+    return results
+
+
+def run_startup(repeat: int) -> list[dict[str, Any]]:
+    """measure the costs paid once per process, independent of cohort size"""
+
+    def load_uncached() -> None:
+        from civetqc.model import _load
+
+        _load.cache_clear()
+        Model.load()
+
+    results = [
+        {"name": "model_load", "n_subjects": 0, **measure(load_uncached, repeat)},
+        {
+            "name": "cli_startup",
+            "n_subjects": 0,
+            **measure_command(
+                [sys.executable, "-m", "civetqc.main", "--version"], repeat
+            ),
+        },
+    ]
+    for result in results:
+        print(
+            f"{result['name']:<20} {'':>18} | {result['seconds']:>9.4f}s"
+            f" | peak {result['peak_memory_mb']:>9.1f} MB"
+        )
+    return results
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(
+    results: list[dict[str, Any]], baseline: dict[str, Any], tolerance: float
+) -> list[str]:
+    """print the change in time for each case of the baseline, returning regressions"""
+    previous = {(r["name"], r["n_subjects"]): r for r in baseline["results"]}
+    regressions = []
+    print(f"\ncompared with {baseline['commit']}:")
+    for result in results:
+        key = (result["name"], result["n_subjects"])
+        if key not in previous:
+            continue
+        ratio = result["seconds"] / previous[key]["seconds"]
+        flag = ""
+        if ratio > 1 + tolerance:
+            flag = "  REGRESSION"
+            regressions.append(f"{key[0]} ({key[1]} subjects)")
+        print(f"{key[0]:<20} {key[1]:>9} subjects | {ratio:6.2f}x time{flag}")
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=str, default="1000,100000")
+    parser.add_argument("--max_files", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", type=Path, default=None)
+    parser.add_argument("--compare", type=Path, default=None)
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+
+    results = run_startup(args.repeat)
+    for n_subjects in map(int, args.sizes.split(",")):
+        results += run_cohort(n_subjects, args.max_files, args.repeat)
+
+    commit = git_commit()
+    report = {
+        "commit": commit,
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "results": results,
+    }
+    output_filepath = args.output or RESULTS_DIR.joinpath(f"{commit}.json")
+    output_filepath.parent.mkdir(parents=True, exist_ok=True)
+    with open(output_filepath, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"\nresults written to {output_filepath}")
+
+    if args.compare is not None:
+        with open(args.compare, "r") as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        if regressions:
+            sys.exit(f"slower than baseline: {', '.join(regressions)}")
+
+
+if __name__ == "__main__":
+    main()
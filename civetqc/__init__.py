@@ -0,0 +1,3 @@
+from .api import score
+
+__all__ = ["score"]
@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+from pathlib import Path
+from typing import Any, Sequence
+
+import numpy as np
+
+from .data import CivetData
+from .model import Model
+
+
+def score(
+    features: Any,
+    ids: Any | None = None,
+    columns: Sequence[str] | None = None,
+    model: Model | Path | str | None = None,
+    threshold: float | None = None,
+    sort: bool = False,
+) -> np.ndarray:
+    """return the rating and probabilities of each row of features as a structured array
+
+    Features may be a DataFrame or any array supporting the buffer protocol, with a
+    row per subject and a column per feature. Columns are matched to
+    CivetData.feature_names by name, taken from a DataFrame or given as columns, and
+    are otherwise assumed to be in that order. The array is used as is when its
+    columns are already in that order; other columns are ignored. The result has the
+    fields 'rating', 'p_pass' and 'p_fail', and 'id' if ids are given, so that each
+    field is a view on the same array. Rows are in the order given unless sort is True,
+    which sorts them by ID and so requires ids.
+    """
+    if sort and ids is None:
+        raise ValueError("Subject IDs are required to sort the results")
+    if columns is None and hasattr(features, "columns"):
+        columns = [str(name) for name in features.columns]
+    if hasattr(features, "to_numpy"):
+        features = features.to_numpy()
+    features = np.asarray(features)
+    if features.ndim != 2:
+        raise ValueError(f"Features must be two-dimensional, got {features.ndim}")
+
+    n_features = len(CivetData.feature_names)
+    if columns is None:
+        if features.shape[1] != n_features:
+            raise ValueError(
+                f"Unexpected number of features {features.shape[1]}, expected: {n_features}"
+            )
+    else:
+        if len(columns) != features.shape[1]:
+            raise ValueError(
+                f"Number of columns {len(columns)} does not match features {features.shape[1]}"
+            )
+        positions = {str(name): index for index, name in enumerate(columns)}
+        missing = [name for name in CivetData.feature_names if name not in positions]
+        if missing:
+            raise ValueError(f"Features are missing columns: {missing}")
+        order = [positions[name] for name in CivetData.feature_names]
+        if order != list(range(features.shape[1])):
+            features = features[:, order]
+
+    fields: list[tuple[str, Any]] = []
+    if ids is not None:
+        ids = np.asarray(ids)
+        if ids.shape != (len(features),):
+            raise ValueError(
+                f"Expected one ID per row of features ({len(features)}), got shape {ids.shape}"
+            )
+        fields.append(("id", ids.dtype))
+    fields.extend(
+        [("rating", np.int64), ("p_pass", np.float64), ("p_fail", np.float64)]
+    )
+
+    if not isinstance(model, Model):
+        model = Model.load(model)
+    probabilities = model.predict_probabilities(features)
+    result = np.empty(len(features), dtype=fields)
+    if ids is not None:
+        result["id"] = ids
+    result["p_pass"] = probabilities[:, 0]
+    result["p_fail"] = probabilities[:, 1]
+    result["rating"] = model.ratings_from_probabilities(probabilities, threshold)
+    if sort:
+        result = result[np.argsort(ids, kind="stable")]
+    return result
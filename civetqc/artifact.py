@@ -0,0 +1,133 @@
+from __future__ import annotations
+
+import hashlib
+import json
+
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+
+from .exceptions import InvalidModelArtifactError
+from .forest import CompiledForest
+
+
+class ModelArtifact:
+    """directory with a small JSON header and the node arrays of a compiled forest
+
+    The header holds the threshold, feature names, format and scikit-learn versions and
+    a checksum of the arrays, so it can be read without touching the arrays, which are
+    stored as .npy files and memory-mapped on load.
+    """
+
+    format_version = 1
+    header_filename = "header.json"
+    array_names = (
+        "columns",
+        "offset",
+        "scale",
+        "roots",
+        "feature",
+        "threshold",
+        "children",
+        "value",
+        "classes",
+    )
+
+    header_keys = (
+        "format_version",
+        "default_threshold",
+        "feature_names",
+        "n_trees",
+        "n_nodes",
+        "checksum",
+    )
+
+    def __init__(self, path: Path | str) -> None:
+        self.path = Path(path)
+        self._header: dict | None = None
+
+    @property
+    def header(self) -> dict:
+        if self._header is None:
+            header_path = self.path.joinpath(self.header_filename)
+            try:
+                with open(header_path, "r") as file:
+                    self._header = json.load(file)
+            except FileNotFoundError as err:
+                raise InvalidModelArtifactError(self.path, "missing header") from err
+            if self._header.get("format_version") != self.format_version:
+                raise InvalidModelArtifactError(
+                    self.path,
+                    f"unsupported format version {self._header.get('format_version')}",
+                )
+        return self._header
+
+    @property
+    def default_threshold(self) -> float:
+        return self.header["default_threshold"]
+
+    @property
+    def checksum(self) -> str:
+        return self.header["checksum"]
+
+    @property
+    def metadata(self) -> dict[str, Any]:
+        """return any entries of the header beyond those written for every artifact"""
+        return {k: v for k, v in self.header.items() if k not in self.header_keys}
+
+    def load_forest(self, mmap: bool = True, verify: bool = False) -> CompiledForest:
+        """load the node arrays, memory-mapped unless mmap is False"""
+        if verify:
+            self.verify()
+        arrays = {
+            name: np.asarray(
+                np.load(self._array_path(name), mmap_mode="r" if mmap else None)
+            )
+            for name in self.array_names
+        }
+        return CompiledForest(**arrays)
+
+    def verify(self) -> None:
+        """raise InvalidModelArtifactError if the arrays do not match the header checksum"""
+        if self._compute_checksum() != self.checksum:
+            raise InvalidModelArtifactError(self.path, "checksum mismatch")
+
+    @classmethod
+    def save(
+        cls,
+        path: Path | str,
+        forest: CompiledForest,
+        default_threshold: float,
+        feature_names: list[str],
+        metadata: dict[str, Any] | None = None,
+    ) -> ModelArtifact:
+        """write the forest and header to path, creating the directory if needed"""
+        artifact = cls(path)
+        artifact.path.mkdir(parents=True, exist_ok=True)
+        for name in cls.array_names:
+            np.save(artifact._array_path(name), getattr(forest, name))
+        header = {
+            "format_version": cls.format_version,
+            "default_threshold": default_threshold,
+            "feature_names": list(feature_names),
+            "n_trees": forest.n_trees,
+            "n_nodes": forest.n_nodes,
+            "checksum": artifact._compute_checksum(),
+        }
+        for key, value in (metadata or {}).items():
+            header.setdefault(key, value)
+        with open(artifact.path.joinpath(cls.header_filename), "w") as file:
+            json.dump(header, file, indent=2)
+        artifact._header = header
+        return artifact
+
+    def _array_path(self, name: str) -> Path:
+        return self.path.joinpath(f"{name}.npy")
+
+    def _compute_checksum(self) -> str:
+        digest = hashlib.sha256()
+        for name in self.array_names:
+            with open(self._array_path(name), "rb") as file:
+                digest.update(file.read())
+        return digest.hexdigest()
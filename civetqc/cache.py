@@ -0,0 +1,166 @@
+from __future__ import annotations
+
+import hashlib
+import sqlite3
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from types import TracebackType
+
+import numpy as np
+
+from .data import CivetData, QCRatingsData
+from .exceptions import NonUniqueIDsError
+from .model import Model
+from .utils import get_non_unique
+
+
+class PredictionCache:
+    """persistent cache of parsed features and predicted probabilities for CIVET QC files
+
+    Entries are keyed by file path and validated against the file's modification time,
+    size and content hash, as well as the fingerprint of the model that scored them.
+    Ratings are derived from the cached probabilities on every run, so changing the
+    threshold never invalidates the cache.
+    """
+
+    filename = "civetqc_cache.sqlite"
+
+    def __init__(self, filepath: Path | str, model_fingerprint: str) -> None:
+        self.filepath = Path(filepath)
+        self.model_fingerprint = model_fingerprint
+        self.parsed_count = 0
+        self.scored_count = 0
+        self._connection = sqlite3.connect(self.filepath)
+        self._connection.executescript("""
+            CREATE TABLE IF NOT EXISTS entries (
+                filepath TEXT PRIMARY KEY,
+                directory TEXT NOT NULL,
+                subject_id TEXT NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                sha256 TEXT NOT NULL,
+                model TEXT NOT NULL,
+                features BLOB NOT NULL,
+                probabilities BLOB NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS entries_directory ON entries (directory);
+            """)
+
+    def __enter__(self) -> PredictionCache:
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def predict_output_files(
+        self,
+        dir_path: Path | str,
+        model: Model,
+        threshold: float | None = None,
+        prefix: str = "",
+        workers: int = 1,
+    ) -> QCRatingsData:
+        """predict ratings for the QC files in dir_path, only parsing and scoring files that changed"""
+
+        dir_path = Path(dir_path).resolve()
+        directory = str(dir_path)
+        scanned = list(CivetData._scan_output_files(dir_path, prefix))
+
+        non_unique_ids = get_non_unique(np.array([s for s, _ in scanned]))
+        if non_unique_ids.size != 0:
+            raise NonUniqueIDsError(non_unique_ids)
+
+        cached = {
+            row[0]: row[1:]
+            for row in self._connection.execute(
+                "SELECT filepath, mtime_ns, size, sha256, model, features, probabilities "
+                "FROM entries WHERE directory = ?",
+                (directory,),
+            )
+        }
+
+        n_subjects = len(scanned)
+        features = np.empty((n_subjects, len(CivetData.feature_names)), np.float64)
+        probabilities = np.empty((n_subjects, 2), np.float64)
+        filepaths = [entry.path for _, entry in scanned]
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            stats = list(executor.map(lambda item: item[1].stat(), scanned))
+
+        unchanged = np.zeros(n_subjects, dtype=bool)
+        modified = []
+        for row_index, (filepath, stat) in enumerate(zip(filepaths, stats)):
+            entry = cached.get(filepath)
+            if entry is None or entry[:2] != (stat.st_mtime_ns, stat.st_size):
+                modified.append(row_index)
+                continue
+            features[row_index] = np.frombuffer(entry[4])
+            if entry[3] == self.model_fingerprint:
+                probabilities[row_index] = np.frombuffer(entry[5])
+                unchanged[row_index] = True
+
+        def read_row(row_index: int) -> tuple[str, bool]:
+            """hash the file and parse it unless its content matches the cached entry"""
+            with open(filepaths[row_index], "rb") as file:
+                content = file.read()
+            digest = hashlib.sha256(content).hexdigest()
+            entry = cached.get(filepaths[row_index])
+            if entry is None or entry[2] != digest:
+                CivetData._parse_output_file(
+                    content.decode(), features[row_index], filepaths[row_index]
+                )
+                return digest, True
+            features[row_index] = np.frombuffer(entry[4])
+            if entry[3] == self.model_fingerprint:
+                probabilities[row_index] = np.frombuffer(entry[5])
+                unchanged[row_index] = True
+            return digest, False
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(read_row, modified))
+        digests = {i: digest for i, (digest, _) in zip(modified, results)}
+        self.parsed_count = sum(parsed for _, parsed in results)
+
+        to_score = np.flatnonzero(~unchanged)
+        self.scored_count = len(to_score)
+        if to_score.size != 0:
+            probabilities[to_score] = model.predict_probabilities(features[to_score])
+
+        self._connection.executemany(
+            "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    filepaths[i],
+                    directory,
+                    scanned[i][0],
+                    stats[i].st_mtime_ns,
+                    stats[i].st_size,
+                    digests[i] if i in digests else cached[filepaths[i]][2],
+                    self.model_fingerprint,
+                    features[i].tobytes(),
+                    probabilities[i].tobytes(),
+                )
+                for i in sorted(set(modified).union(to_score.tolist()))
+            ],
+        )
+        self._connection.executemany(
+            "DELETE FROM entries WHERE filepath = ?",
+            [(filepath,) for filepath in cached.keys() - set(filepaths)],
+        )
+        self._connection.commit()
+
+        subject_ids = np.array([subject_id for subject_id, _ in scanned], dtype=str)
+        return QCRatingsData(
+            subject_ids,
+            model.ratings_from_probabilities(probabilities, threshold),
+            probabilities,
+        )
@@ -0,0 +1,275 @@
+from __future__ import annotations
+
+import argparse
+import time
+
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+
+from .artifact import ModelArtifact
+from .data import QCRatingsData
+from .forest import CompiledForest
+from .model import Model
+from .registry import ModelRegistry
+from .thresholds import summarize, sweep_thresholds
+
+
+def select_trees(
+    forest: CompiledForest, features: np.ndarray, n_trees: int
+) -> np.ndarray:
+    """return the indices of n_trees trees whose average best matches the forest
+
+    Trees are added one at a time, each time choosing the tree that most reduces the
+    mean squared difference from the probabilities of failure of the whole forest, so
+    that no ratings are needed and any unrated features can be used. The indices are
+    in the order the trees were chosen, so each prefix is the best subset found of its
+    size.
+    """
+    if not 1 <= n_trees <= forest.n_trees:
+        raise ValueError(
+            f"Number of trees must be between 1 and {forest.n_trees}, got {n_trees}"
+        )
+    per_tree = forest.value[forest.apply(features), 1]
+    target = per_tree.mean(axis=1)
+    selected: list[int] = []
+    available = np.ones(forest.n_trees, dtype=bool)
+    total = np.zeros(len(features))
+    for size in range(1, n_trees + 1):
+        errors = (
+            ((total[:, np.newaxis] + per_tree) / size - target[:, np.newaxis]) ** 2
+        ).mean(axis=0)
+        errors[~available] = np.inf
+        best = int(np.argmin(errors))
+        selected.append(best)
+        available[best] = False
+        total += per_tree[:, best]
+    return np.array(selected, dtype=np.intp)
+
+
+def compare(
+    forest: CompiledForest,
+    reference: np.ndarray,
+    features: np.ndarray,
+    threshold: float,
+    ratings: np.ndarray | None = None,
+    beta: float = 2.0,
+) -> dict[str, Any]:
+    """return how closely the ratings of a forest at threshold agree with reference
+    probabilities of failure and, with ratings, its accuracy and F-beta"""
+    p_fail = forest.predict_probabilities(features)[:, 1]
+    comparison: dict[str, Any] = {
+        "n_trees": forest.n_trees,
+        "n_nodes": forest.n_nodes,
+        "agreement": float(np.mean((p_fail > threshold) == (reference > threshold))),
+        "max_difference": float(np.abs(p_fail - reference).max()),
+    }
+    if ratings is not None:
+        current = summarize(sweep_thresholds(p_fail, ratings, beta), threshold)[
+            "current"
+        ]
+        comparison["accuracy"] = (
+            current["true_positives"] + current["true_negatives"]
+        ) / len(ratings)
+        comparison[f"f{beta:g}"] = current["fbeta"]
+    return comparison
+
+
+def measure(
+    artifact_path: Path, features: np.ndarray, min_rows: int = 10000, repeats: int = 5
+) -> dict[str, float]:
+    """return the size of a saved model, the time to read it and its scoring throughput"""
+    artifact = ModelArtifact(artifact_path)
+    size = sum(path.stat().st_size for path in Path(artifact_path).iterdir())
+    load_times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        forest = artifact.load_forest(mmap=False)
+        load_times.append(time.perf_counter() - start)
+    batch = np.tile(features, (-(-min_rows // len(features)), 1))
+    batch_times = []
+    row_times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        forest.predict_probabilities(batch)
+        batch_times.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        forest.predict_probabilities(features[:1])
+        row_times.append(time.perf_counter() - start)
+    return {
+        "size_bytes": size,
+        "load_seconds": min(load_times),
+        "rows_per_second": len(batch) / min(batch_times),
+        "row_latency_seconds": min(row_times),
+    }
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="civetqc compress")
+    parser.add_argument(
+        "input_path",
+        type=Path,
+        help="path to file, directory or archive with CIVET QC outputs, or to saved features, used to choose trees and measure the models",
+    )
+    parser.add_argument(
+        "--ratings",
+        type=Path,
+        default=None,
+        metavar="",
+        help="CSV file of known ratings, to report accuracy and F-beta of both models",
+    )
+    parser.add_argument(
+        "--idvar",
+        type=str,
+        default="ID",
+        metavar="",
+        help="column of subject IDs in the ratings file (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--qcvar",
+        type=str,
+        default="QC",
+        metavar="",
+        help="column of ratings, 0 to pass and 1 to fail, in the ratings file (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--model",
+        type=str,
+        default=ModelRegistry.bundled_name,
+        metavar="",
+        help="model to compress as NAME or NAME@VERSION (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--model_dir",
+        type=Path,
+        default=None,
+        metavar="",
+        help="registry of named models (default: $CIVETQC_MODELS or ~/.civetqc/models)",
+    )
+    parser.add_argument(
+        "--n_trees",
+        type=int,
+        default=32,
+        metavar="",
+        help="number of trees kept (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--max_depth",
+        type=int,
+        default=None,
+        metavar="",
+        help="depth below which nodes of the kept trees are removed (default: no limit)",
+    )
+    parser.add_argument(
+        "--beta",
+        type=float,
+        default=2.0,
+        metavar="",
+        help="weight of recall in the reported F-beta score (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--output_dir",
+        type=Path,
+        default=Path.cwd(),
+        metavar="",
+        help="directory in which the model is saved as civetqc_model (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--register",
+        type=str,
+        default=None,
+        metavar="",
+        help="also save the model as the next version of this name in the model registry",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        metavar="",
+        help="number of threads used to read a directory of QC files (default: %(default)s)",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str] | None = None) -> None:
+    from .main import load_civet_data
+
+    args = parse_args(argv)
+    if not args.output_dir.is_dir():
+        raise NotADirectoryError(f"Output directory does not exist: {args.output_dir}")
+
+    registry = ModelRegistry(args.model_dir)
+    model_path = registry.resolve(args.model)
+    model = Model.load(model_path)
+    forest = model.forest
+    civet_data = load_civet_data(args.input_path, args.workers)
+    ratings = None
+    if args.ratings is not None:
+        civet_data, qc_data = civet_data.join(
+            QCRatingsData.from_csv(args.ratings, args.idvar, args.qcvar)
+        )
+        ratings = qc_data.ratings.astype(int)
+    if not len(civet_data):
+        raise ValueError("No subjects to choose trees with")
+    features = np.asarray(civet_data.features)
+
+    capped = forest.prune(max_depth=args.max_depth)
+    trees = select_trees(capped, features, args.n_trees)
+    compressed = capped.prune(trees)
+    threshold = model.default_threshold
+    reference = forest.predict_probabilities(features)[:, 1]
+
+    # the trade-off at smaller sizes, from prefixes of the order the trees were chosen in
+    sizes = sorted({*(2 ** np.arange(int(np.log2(args.n_trees)) + 1)), args.n_trees})
+    rows = {
+        "original": compare(forest, reference, features, threshold, ratings, args.beta)
+    }
+    for size in sizes[:-1]:
+        rows[f"first {size}"] = compare(
+            capped.prune(trees[:size]),
+            reference,
+            features,
+            threshold,
+            ratings,
+            args.beta,
+        )
+    rows["compressed"] = compare(
+        compressed, reference, features, threshold, ratings, args.beta
+    )
+    print(f"{len(features)} subjects at threshold {threshold:g}")
+    print_table(rows)
+
+    output_path = args.output_dir.joinpath("civetqc_model")
+    metadata = dict(model.metadata)
+    metadata["compression"] = {
+        "source": ModelArtifact(model_path).checksum,
+        "trees": trees.tolist(),
+        "max_depth": args.max_depth,
+        **rows["compressed"],
+    }
+    Model(None, threshold, forest=compressed, metadata=metadata).save(output_path)
+    print()
+    print_table(
+        {
+            "original": measure(model_path, features),
+            "compressed": measure(output_path, features),
+        }
+    )
+    print(f"\nmodel saved to {output_path}")
+    if args.register is not None:
+        registered_path = registry.register(args.register, Model.load(output_path))
+        print(f"model registered as {args.register}@{registered_path.name}")
+
+
+def print_table(rows: dict[str, dict[str, Any]]) -> None:
+    columns = list(next(iter(rows.values())))
+    widths = [max(len(name), 10) for name in columns]
+    label_width = max(len(label) for label in rows)
+    print(" " * label_width, *(f"{n:>{w}}" for n, w in zip(columns, widths)))
+    for label, row in rows.items():
+        values = [
+            f"{row[n]:>{w}d}" if isinstance(row[n], int) else f"{row[n]:>{w}.4g}"
+            for n, w in zip(columns, widths)
+        ]
+        print(f"{label:<{label_width}}", *values)
@@ -1,20 +1,182 @@
 from __future__ import annotations
 
 import csv
-import json
+import itertools
 import os
 
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Any, Iterable, Iterator, Sequence
 
 import numpy as np
 import numpy.typing as npt
 
+from . import profiling
 from .exceptions import ColumnNotFoundError, NonNumericValueError, NonUniqueIDsError
-from .utils import check_types, get_non_unique, get_index, joint_sort
+from .utils import (
+    check_types,
+    import_optional,
+    is_archive,
+    is_sorted,
+    get_shard,
+    iter_archive_members,
+    load_npz,
+    shard_mask,
+)
+
+
+class StringTable:
+    """immutable sequence of strings stored as concatenated UTF-8 bytes and offsets
+
+    Unlike a unicode array, which stores four bytes per character of the longest string
+    for every element, the table stores each string in as many bytes as it needs.
+    """
+
+    __slots__ = ("_data", "_offsets")
+
+    def __init__(self, data: np.ndarray, offsets: np.ndarray) -> None:
+        self._data = data
+        self._offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index: int | slice) -> str | StringTable:
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return StringTable.from_array(self.to_array()[index])
+            offsets = self._offsets[start : max(start, stop) + 1]
+            return StringTable(
+                self._data[offsets[0] : offsets[-1]], offsets - offsets[0]
+            )
+        start, stop = self._offsets[index], self._offsets[index + 1]
+        return self._data[start:stop].tobytes().decode("utf-8")
+
+    @property
+    def nbytes(self) -> int:
+        return self._data.nbytes + self._offsets.nbytes
+
+    @classmethod
+    def from_array(cls, strings: np.ndarray) -> StringTable:
+        strings = np.asarray(strings, dtype=str)
+        try:
+            encoded = strings.astype(bytes)
+        except UnicodeEncodeError:
+            encoded = np.char.encode(strings, "utf-8")
+        width = encoded.dtype.itemsize
+        lengths = np.char.str_len(encoded) if len(encoded) else np.zeros(0, int)
+        matrix = encoded.view(np.uint8).reshape(len(encoded), width)
+        data = matrix[np.arange(width) < lengths[:, None]]
+        offset_type = np.int32 if data.size < 2**31 else np.int64
+        offsets = np.zeros(len(encoded) + 1, dtype=offset_type)
+        np.cumsum(lengths, out=offsets[1:])
+        return cls(data, offsets)
+
+    def to_array(self) -> np.ndarray:
+        """return the strings as a unicode array"""
+        lengths = np.diff(self._offsets)
+        width = max(int(lengths.max(initial=0)), 1)
+        matrix = np.zeros((len(self), width), dtype=np.uint8)
+        matrix[np.arange(width) < lengths[:, None]] = self._data
+        encoded = matrix.view(f"S{width}").ravel()
+        if self._data.size and self._data.max() >= 128:
+            return np.char.decode(encoded, "utf-8")
+        return encoded.astype(str)
+
+
+class SubjectIndex:
+    """positions of subject IDs, for lookup, subsetting and joining without rescanning
+
+    The IDs are sorted once, or not at all if they are already in order, and looked up
+    by binary search. Single IDs are found through a dictionary built on first use.
+    """
+
+    __slots__ = ("_subject_ids", "_order", "_sorted_ids", "_positions")
+
+    def __init__(
+        self, subject_ids: np.ndarray, order: np.ndarray | None = None
+    ) -> None:
+        """order sorts subject_ids; it is computed unless given, and is None if already sorted"""
+        self._subject_ids = subject_ids
+        if order is None and not is_sorted(subject_ids):
+            order = np.argsort(subject_ids, kind="stable")
+        self._order = order
+        self._sorted_ids = subject_ids if order is None else subject_ids[order]
+        self._positions: dict[str, int] | None = None
+
+    def __len__(self) -> int:
+        return len(self._subject_ids)
+
+    def __contains__(self, subject_id: object) -> bool:
+        return subject_id in self._get_positions()
+
+    @property
+    def is_sorted(self) -> bool:
+        return self._order is None
+
+    @property
+    def order(self) -> np.ndarray:
+        """positions that sort the subject IDs"""
+        if self._order is None:
+            return np.arange(len(self))
+        return self._order
+
+    @property
+    def sorted_ids(self) -> np.ndarray:
+        return self._sorted_ids
+
+    def sorted(self) -> SubjectIndex:
+        """return the index of the sorted subject IDs, without checking their order again"""
+        return self if self._order is None else SubjectIndex(self._sorted_ids, None)
+
+    def get_duplicates(self) -> np.ndarray:
+        """return each subject ID that occurs more than once"""
+        sorted_ids = self._sorted_ids
+        return np.unique(sorted_ids[1:][sorted_ids[1:] == sorted_ids[:-1]])
+
+    def get_loc(self, subject_id: str) -> int:
+        """return the position of a subject ID, raising KeyError if it is not indexed"""
+        return self._get_positions()[subject_id]
+
+    def get_indexer(
+        self, subject_ids: npt.ArrayLike, missing_ok: bool = False
+    ) -> np.ndarray:
+        """return the position of each subject ID, or -1 for those not indexed if missing_ok"""
+        subject_ids = np.asarray(subject_ids)
+        if not len(self):
+            found = np.zeros(subject_ids.shape, dtype=bool)
+            positions = np.zeros(subject_ids.shape, dtype=np.intp)
+        else:
+            sorted_positions = np.searchsorted(self._sorted_ids, subject_ids)
+            np.minimum(sorted_positions, len(self) - 1, out=sorted_positions)
+            found = self._sorted_ids[sorted_positions] == subject_ids
+            positions = (
+                sorted_positions
+                if self._order is None
+                else self._order[sorted_positions]
+            )
+        if not missing_ok and not found.all():
+            raise KeyError(subject_ids[~found][0])
+        return np.where(found, positions, -1)
+
+    def _get_positions(self) -> dict[str, int]:
+        if self._positions is None:
+            self._positions = {
+                subject_id: position
+                for position, subject_id in enumerate(self._subject_ids.tolist())
+            }
+        return self._positions
 
 
 class CivetData:
-    """represents outputs from CIVET to be predicted by the model"""
+    """represents outputs from CIVET to be predicted by the model
+
+    If compact is True, subject IDs are stored in a StringTable and features as float32,
+    which is accurate to about seven significant digits.
+    """
+
+    __slots__ = ("_subject_ids", "_features", "_index")
 
     feature_names = np.array(
         [
@@ -50,9 +212,18 @@ class CivetData:
         ]
     )
 
-    def __init__(self, subject_ids: np.ndarray, features: np.ndarray) -> None:
+    feature_index = {str(name): index for index, name in enumerate(feature_names)}
+
+    def __init__(
+        self,
+        subject_ids: np.ndarray,
+        features: np.ndarray,
+        sort: bool = True,
+        compact: bool = False,
+    ) -> None:
         check_types((subject_ids, np.ndarray), (features, np.ndarray))
-        non_unique_ids = get_non_unique(subject_ids)
+        index = SubjectIndex(subject_ids)
+        non_unique_ids = index.get_duplicates()
         if non_unique_ids.size != 0:
             raise NonUniqueIDsError(non_unique_ids)
         expected_shape = (len(subject_ids), len(self.feature_names))
@@ -60,129 +231,726 @@ class CivetData:
             raise ValueError(
                 f"Unexpected shape of features {features.shape}, expected: {expected_shape}"
             )
-        self._subject_ids, self._features = joint_sort(subject_ids, features, axis=0)
+        if compact:
+            features = features.astype(np.float32, copy=False)
+        if sort and not index.is_sorted:
+            subject_ids, features = index.sorted_ids, features[index.order]
+            index = index.sorted()
+        self._subject_ids: np.ndarray | StringTable = subject_ids
+        self._features = features
+        self._index: SubjectIndex | None = index
+        if compact:
+            # the index refers to the unicode array, so it is rebuilt when needed
+            self._subject_ids = StringTable.from_array(subject_ids)
+            self._index = None
+
+    def __getitem__(self, subject_id: str) -> np.ndarray:
+        """return the features of a subject"""
+        return self._features[self.index.get_loc(subject_id)]
+
+    def __contains__(self, subject_id: object) -> bool:
+        return subject_id in self.index
 
     def __array__(self) -> np.ndarray:
         return self.features
 
+    def __len__(self) -> int:
+        return len(self._subject_ids)
+
     @property
     def features(self) -> np.ndarray:
         return self._features
 
     @property
     def subject_ids(self) -> np.ndarray:
+        """the subject IDs as an array, which is created on each access if compact"""
+        if isinstance(self._subject_ids, StringTable):
+            return self._subject_ids.to_array()
         return self._subject_ids
 
+    @property
+    def compact(self) -> bool:
+        return isinstance(self._subject_ids, StringTable)
+
+    @property
+    def index(self) -> SubjectIndex:
+        if self._index is None:
+            self._index = SubjectIndex(self.subject_ids)
+        return self._index
+
+    def subset(self, subject_ids: npt.ArrayLike) -> CivetData:
+        """return an instance with the rows of the given subject IDs that are present, in the same order"""
+        positions = self.index.get_indexer(subject_ids, missing_ok=True)
+        return self._take(np.unique(positions[positions >= 0]))
+
+    def join(self, qc_data: QCRatingsData) -> tuple[CivetData, QCRatingsData]:
+        """return both with only the subjects present in both, in the order of this instance"""
+        positions = qc_data.index.get_indexer(self.subject_ids, missing_ok=True)
+        found = positions >= 0
+        return self._take(np.flatnonzero(found)), qc_data._take(positions[found])
+
+    @classmethod
+    def concat(cls, cohorts: Sequence[CivetData]) -> CivetData:
+        """combine cohorts without overlapping subject IDs into one sorted instance
+
+        Rows are placed directly at their sorted positions, so features are copied once.
+        """
+        subject_ids = np.concatenate(
+            [cohort.subject_ids for cohort in cohorts] or [np.array([], dtype=str)]
+        )
+        index = SubjectIndex(subject_ids)
+        non_unique_ids = index.get_duplicates()
+        if non_unique_ids.size != 0:
+            raise NonUniqueIDsError(non_unique_ids)
+        ranks = np.empty(len(subject_ids), dtype=np.intp)
+        ranks[index.order] = np.arange(len(subject_ids))
+        features = np.empty(
+            (len(subject_ids), len(cls.feature_names)),
+            dtype=(
+                np.result_type(*[cohort.features for cohort in cohorts])
+                if cohorts
+                else np.float64
+            ),
+        )
+        start = 0
+        for cohort in cohorts:
+            features[ranks[start : start + len(cohort)]] = cohort.features
+            start += len(cohort)
+        return cls(index.sorted_ids, features, sort=False)
+
+    def _take(self, positions: np.ndarray) -> CivetData:
+        return type(self)(
+            self.subject_ids[positions],
+            self._features[positions],
+            sort=False,
+            compact=self.compact,
+        )
+
+    def to_compact(self) -> CivetData:
+        """return an instance with the compact layout"""
+        if self.compact:
+            return self
+        return type(self)(self._subject_ids, self._features, sort=False, compact=True)
+
+    def chunks(self, chunk_size: int) -> Iterator[CivetData]:
+        """yield unsorted instances viewing consecutive chunks of rows, never compact"""
+        for start in range(0, len(self), chunk_size):
+            subject_ids = self._subject_ids[start : start + chunk_size]
+            if isinstance(subject_ids, StringTable):
+                subject_ids = subject_ids.to_array()
+            yield type(self)(
+                subject_ids, self.features[start : start + chunk_size], sort=False
+            )
+
+    def select_shard(self, shard: tuple[int, int]) -> CivetData:
+        """return an instance with the rows whose subject IDs are in shard, given as (index, count)"""
+        mask = shard_mask(self.subject_ids, shard)
+        return type(self)(self.subject_ids[mask], self.features[mask], sort=False)
+
     @classmethod
     def from_output_files(
         cls,
         dir_path: Path | str,
         prefix: str = "",
-        subset_subject_ids: list | None = None,
+        subset_subject_ids: Iterable[str] | None = None,
+        workers: int = 1,
+        sort: bool = True,
+        shard: tuple[int, int] | None = None,
+        compact: bool = False,
     ) -> CivetData:
-        """create instance from raw QC files outputted by CIVET"""
+        """create instance from raw QC files outputted by CIVET, optionally reading files in parallel
+
+        If shard is given as (index, count), only subjects in that partition of the
+        subject IDs are read, so that a directory can be split between jobs. dir_path
+        may also be a tar or zip archive of QC files, which is read sequentially.
+        """
 
         dir_path = Path(dir_path)
+        if is_archive(dir_path) and dir_path.is_file():
+            chunks = list(
+                cls._iter_archive(
+                    dir_path, prefix, subset_subject_ids, shard=shard, compact=compact
+                )
+            )
+            if not chunks:
+                return cls(
+                    np.array([], dtype=str),
+                    np.empty((0, len(cls.feature_names))),
+                    sort,
+                    compact,
+                )
+            return cls(
+                np.concatenate([chunk_subject_ids for chunk_subject_ids, _ in chunks]),
+                np.concatenate([chunk_features for _, chunk_features in chunks]),
+                sort,
+                compact,
+            )
 
-        target_file_suffix = "civet_qc.txt"
         subject_ids = []
         filepaths = []
 
-        for filename in os.listdir(dir_path):
-            if filename.endswith(target_file_suffix):
-                subject_id = (
-                    filename.replace(prefix, "")
-                    .replace(target_file_suffix, "")
-                    .strip("_")
+        with profiling.span("list_output_files"):
+            for subject_id, entry in cls._scan_output_files(
+                dir_path, prefix, subset_subject_ids, shard
+            ):
+                subject_ids.append(subject_id)
+                filepaths.append(dir_path.joinpath(entry.name))
+
+        return cls.from_filepaths(subject_ids, filepaths, workers, sort, compact)
+
+    @classmethod
+    def from_filepaths(
+        cls,
+        subject_ids: Sequence[str],
+        filepaths: Sequence[Path | str],
+        workers: int = 1,
+        sort: bool = True,
+        compact: bool = False,
+    ) -> CivetData:
+        """create instance from raw QC files at the given paths, such as those found by a recursive walk"""
+        return cls(
+            np.array(subject_ids, dtype=str),
+            cls._read_output_files(list(filepaths), workers, compact),
+            sort,
+            compact,
+        )
+
+    @classmethod
+    def iter_output_files(
+        cls,
+        dir_path: Path | str,
+        prefix: str = "",
+        subset_subject_ids: Iterable[str] | None = None,
+        workers: int = 1,
+        chunk_size: int = 65536,
+        shard: tuple[int, int] | None = None,
+    ) -> Iterator[CivetData]:
+        """yield unsorted instances for consecutive chunks of the QC files in dir_path"""
+
+        dir_path = Path(dir_path)
+        if is_archive(dir_path) and dir_path.is_file():
+            for subject_ids, features in cls._iter_archive(
+                dir_path, prefix, subset_subject_ids, chunk_size, shard
+            ):
+                yield cls(subject_ids, features, sort=False)
+            return
+        scanned = cls._scan_output_files(dir_path, prefix, subset_subject_ids, shard)
+
+        while chunk := list(itertools.islice(scanned, chunk_size)):
+            filepaths = [dir_path.joinpath(entry.name) for _, entry in chunk]
+            yield cls(
+                np.array([subject_id for subject_id, _ in chunk], dtype=str),
+                cls._read_output_files(filepaths, workers),
+                sort=False,
+            )
+
+    @classmethod
+    def _read_output_files(
+        cls, filepaths: list[Path | str], workers: int = 1, compact: bool = False
+    ) -> npt.NDArray[np.floating]:
+        """return a matrix with one row of features parsed from each QC file"""
+
+        features: npt.NDArray[np.floating] = np.empty(
+            shape=(len(filepaths), len(cls.feature_names)),
+            dtype=np.float32 if compact else np.float64,
+        )
+
+        def read_rows(row_indices: range) -> None:
+            n_bytes = 0
+            for row_index in row_indices:
+                with open(filepaths[row_index], "r") as file:
+                    text = file.read()
+                n_bytes += len(text)
+                cls._parse_output_file(text, features[row_index], filepaths[row_index])
+            profiling.count("files_read", len(row_indices))
+            profiling.count("bytes_read", n_bytes)
+
+        with profiling.span("read_output_files"):
+            if workers > 1 and len(filepaths) > 1:
+                n_chunks = min(len(filepaths), workers * 4)
+                bounds = np.linspace(0, len(filepaths), n_chunks + 1, dtype=int)
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    for _ in executor.map(
+                        read_rows,
+                        [range(a, b) for a, b in zip(bounds[:-1], bounds[1:])],
+                    ):
+                        pass
+            else:
+                read_rows(range(len(filepaths)))
+
+        return features
+
+    @staticmethod
+    def _scan_output_files(
+        dir_path: Path,
+        prefix: str = "",
+        subset_subject_ids: Iterable[str] | None = None,
+        shard: tuple[int, int] | None = None,
+    ) -> Iterator[tuple[str, os.DirEntry]]:
+        """yield subject IDs and directory entries of the QC files in dir_path"""
+
+        if subset_subject_ids is not None:
+            # a set makes each membership test constant time
+            subset_subject_ids = set(subset_subject_ids)
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                subject_id = CivetData._select_output_file(
+                    entry.name, prefix, subset_subject_ids, shard
                 )
-                if subset_subject_ids is None or subject_id in subset_subject_ids:
+                if subject_id is not None:
+                    yield subject_id, entry
+
+    @staticmethod
+    def _select_output_file(
+        filename: str,
+        prefix: str = "",
+        subset_subject_ids: set[str] | None = None,
+        shard: tuple[int, int] | None = None,
+    ) -> str | None:
+        """return the subject ID of a QC file if it is in the subset and shard, or None"""
+        subject_id = CivetData.get_subject_id(filename, prefix)
+        if subject_id is None:
+            return None
+        if subset_subject_ids is not None and subject_id not in subset_subject_ids:
+            return None
+        if shard is not None and get_shard(subject_id, shard[1]) != shard[0]:
+            return None
+        return subject_id
+
+    @classmethod
+    def _iter_archive(
+        cls,
+        filepath: Path,
+        prefix: str = "",
+        subset_subject_ids: Iterable[str] | None = None,
+        chunk_size: int = 65536,
+        shard: tuple[int, int] | None = None,
+        compact: bool = False,
+    ) -> Iterator[tuple[np.ndarray, np.ndarray]]:
+        """yield subject IDs and features of consecutive chunks of the QC files in an archive
+
+        The archive is read in one pass and each selected member is parsed in memory,
+        so nothing is extracted to disk. Members are matched by their base name, with
+        the same prefix, subset and shard rules as files in a directory.
+        """
+
+        if subset_subject_ids is not None:
+            subset_subject_ids = set(subset_subject_ids)
+        members = iter_archive_members(filepath)
+        while True:
+            subject_ids = []
+            features = np.full(
+                (chunk_size, len(cls.feature_names)),
+                np.nan,
+                dtype=np.float32 if compact else np.float64,
+            )
+            n_bytes = 0
+            with profiling.span("read_output_files"):
+                for name, read in members:
+                    subject_id = cls._select_output_file(
+                        name, prefix, subset_subject_ids, shard
+                    )
+                    if subject_id is None:
+                        continue
+                    text = read().decode()
+                    n_bytes += len(text)
+                    cls._parse_output_file(
+                        text, features[len(subject_ids)], f"{filepath}:{name}"
+                    )
                     subject_ids.append(subject_id)
-                    filepaths.append(dir_path.joinpath(filename))
+                    if len(subject_ids) == chunk_size:
+                        break
+                profiling.count("files_read", len(subject_ids))
+                profiling.count("bytes_read", n_bytes)
+            if subject_ids:
+                yield np.array(subject_ids, dtype=str), features[: len(subject_ids)]
+            if len(subject_ids) < chunk_size:
+                return
+
+    @staticmethod
+    def get_subject_id(filename: str, prefix: str = "") -> str | None:
+        """return the subject ID in the name of a CIVET QC file, or None for other files"""
+        target_file_suffix = "civet_qc.txt"
+        if not filename.endswith(target_file_suffix):
+            return None
+        return filename.replace(prefix, "").replace(target_file_suffix, "").strip("_")
+
+    @classmethod
+    def _parse_output_file(
+        cls, text: str, row: np.ndarray, filepath: Path | str
+    ) -> None:
+        """parse the contents of a CIVET QC file into a row of the feature matrix"""
+        for line in text.splitlines():
+            key, value = [s.strip() for s in line.split("=")]
+            column_index = cls.feature_index.get(key)
+            if column_index is not None:
+                try:
+                    row[column_index] = float(value)
+                except ValueError as err:
+                    raise NonNumericValueError(key, value, filepath) from err
+
+    @classmethod
+    def from_csv(
+        cls,
+        filepath: Path | str,
+        idvar: str = "ID",
+        chunk_size: int = 65536,
+        sort: bool = True,
+        shard: tuple[int, int] | None = None,
+        compact: bool = False,
+    ) -> CivetData:
+        """create instance from aggregated QC file outputted by CIVET, optionally only the rows in shard"""
+
+        # every row ends with a newline, except perhaps the last, so this bounds the row count
+        with open(filepath, "rb") as file:
+            capacity = 1 + sum(
+                block.count(b"\n") for block in iter(lambda: file.read(1 << 20), b"")
+            )
+
+        subject_ids = []
+        features = np.empty(
+            (capacity, len(cls.feature_names)),
+            dtype=np.float32 if compact else np.float64,
+        )
+        n_rows = 0
 
-        features: npt.NDArray[np.float64] = np.ndarray(
-            shape=((len(filepaths), len(cls.feature_names))), dtype=np.float64
+        for chunk_subject_ids, chunk_features in cls._iter_csv(
+            filepath, idvar, chunk_size, shard
+        ):
+            subject_ids.append(chunk_subject_ids)
+            features[n_rows : n_rows + len(chunk_features)] = chunk_features
+            n_rows += len(chunk_features)
+
+        return cls(
+            np.concatenate(subject_ids) if subject_ids else np.array([], dtype=str),
+            features[:n_rows],
+            sort,
+            compact,
         )
 
-        for row_index, subject_id in enumerate(subject_ids):
-            with open(filepaths[row_index], "r") as file:
-                lines = file.read().splitlines()
-                for line in lines:
-                    key, value = [s.strip() for s in line.split("=")]
-                    if key in cls.feature_names:
-                        column_index = get_index(cls.feature_names, key)
-                        try:
-                            column_value = float(value)
-                        except ValueError as err:
-                            raise NonNumericValueError(
-                                key, value, filepaths[row_index]
-                            ) from err
-                        features.itemset((row_index, column_index), column_value)
-
-        return cls(np.array(subject_ids), features)
+    @classmethod
+    def iter_csv(
+        cls,
+        filepath: Path | str,
+        idvar: str = "ID",
+        chunk_size: int = 65536,
+        shard: tuple[int, int] | None = None,
+    ) -> Iterator[CivetData]:
+        """yield unsorted instances for consecutive chunks of rows of an aggregated QC file"""
+        for subject_ids, features in cls._iter_csv(filepath, idvar, chunk_size, shard):
+            yield cls(subject_ids, features, sort=False)
 
     @classmethod
-    def from_csv(cls, filepath: Path | str, idvar: str = "ID") -> CivetData:
-        """create instance from aggregated QC file outputted by CIVET"""
+    def _iter_csv(
+        cls,
+        filepath: Path | str,
+        idvar: str,
+        chunk_size: int,
+        shard: tuple[int, int] | None = None,
+    ) -> Iterator[tuple[np.ndarray, np.ndarray]]:
+        """yield subject IDs and features parsed column-wise from chunks of rows of a CSV file"""
+
+        with open(filepath, "r") as file:
+            header = next(csv.reader([file.readline()]), [])
+            positions = {name: index for index, name in enumerate(header)}
+            columns = []
+            for colname in (idvar, *cls.feature_names):
+                if colname not in positions:
+                    raise ColumnNotFoundError(colname, filepath)
+                columns.append(positions[colname])
+
+            options = dict(delimiter=",", quotechar='"', comments=None)
+            line_number = 1
+            while lines := list(itertools.islice(file, chunk_size)):
+                with profiling.span("parse_csv"):
+                    try:
+                        rows = lines
+                        subject_ids = np.loadtxt(
+                            rows, dtype=str, usecols=columns[0], ndmin=1, **options
+                        )
+                        if shard is not None:
+                            # select rows before parsing features, which is the costly part
+                            rows = [line for line in lines if line.strip()]
+                            mask = shard_mask(subject_ids, shard)
+                            subject_ids = subject_ids[mask]
+                            rows = list(itertools.compress(rows, mask))
+                        features = (
+                            np.loadtxt(
+                                rows,
+                                dtype=np.float64,
+                                usecols=columns[1:],
+                                ndmin=2,
+                                **options,
+                            )
+                            if rows
+                            else np.empty((0, len(cls.feature_names)))
+                        )
+                    except ValueError:
+                        subject_ids, features = cls._parse_csv_lines(
+                            lines, columns, filepath, line_number
+                        )
+                        if shard is not None:
+                            mask = shard_mask(subject_ids, shard)
+                            subject_ids, features = subject_ids[mask], features[mask]
+                profiling.count("rows_read", len(features))
+                yield subject_ids, features
+                line_number += len(lines)
+
+    @classmethod
+    def _parse_csv_lines(
+        cls,
+        lines: list[str],
+        columns: list[int],
+        filepath: Path | str,
+        line_number: int,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """parse rows one at a time, to locate values that could not be parsed in bulk"""
 
         subject_ids = []
         features = []
 
-        with open(filepath, "r") as file:
-            reader = csv.DictReader(file)
-            for row in reader:
+        reader = csv.reader(lines)
+        for row in reader:
+            if not row:
+                continue
+            values = []
+            for colname, column in zip(cls.feature_names, columns[1:]):
+                value = row[column] if column < len(row) else ""
                 try:
-                    subject_ids.append(row[idvar])
-                except KeyError as err:
-                    raise ColumnNotFoundError(idvar, filepath) from err
-                values = []
-                for feature_name in cls.feature_names:
-                    try:
-                        values.append(float(row[feature_name]))
-                    except KeyError as err:
-                        raise ColumnNotFoundError(feature_name, filepath) from err
-                    except ValueError as err:
-                        raise NonNumericValueError(
-                            feature_name, row[feature_name], filepath
-                        ) from err
-                features.append(values)
-        return cls(np.array(subject_ids), np.array(features, dtype=float))
+                    values.append(float(value))
+                except ValueError as err:
+                    raise NonNumericValueError(
+                        colname, value, filepath, line_number + reader.line_num
+                    ) from err
+            subject_ids.append(row[columns[0]] if columns[0] < len(row) else "")
+            features.append(values)
 
-    def to_output_files(self, dir_path: Path, prefix: str = "") -> None:
-        """write features to files in the row format outputted by CIVET"""
+        return np.array(subject_ids, dtype=str), np.array(
+            features, dtype=np.float64
+        ).reshape(-1, len(cls.feature_names))
 
-        for index, subject_id in enumerate(self.subject_ids):
+    @classmethod
+    def from_npz(
+        cls, filepath: Path | str, mmap: bool = True, sort: bool = True
+    ) -> CivetData:
+        """create instance from a file written by to_npz, memory-mapping its arrays unless mmap is False"""
+        arrays = load_npz(filepath, mmap)
+        for name in ("subject_ids", "features", "feature_names"):
+            if name not in arrays:
+                raise ColumnNotFoundError(name, filepath)
+        features = arrays["features"]
+        if not np.array_equal(arrays["feature_names"], cls.feature_names):
+            positions = {str(name): i for i, name in enumerate(arrays["feature_names"])}
+            for colname in cls.feature_names:
+                if colname not in positions:
+                    raise ColumnNotFoundError(colname, filepath)
+            features = features[:, [positions[name] for name in cls.feature_index]]
+        return cls(arrays["subject_ids"], features, sort)
+
+    @classmethod
+    def from_parquet(
+        cls, filepath: Path | str, idvar: str = "ID", sort: bool = True
+    ) -> CivetData:
+        """create instance from a Parquet file with the columns of the aggregated QC file"""
+        pq = import_optional("pyarrow.parquet", "arrow")
+        return cls._from_arrow_table(pq.read_table(filepath), idvar, filepath, sort)
+
+    @classmethod
+    def from_arrow(
+        cls, filepath: Path | str, idvar: str = "ID", sort: bool = True
+    ) -> CivetData:
+        """create instance from an Arrow IPC file with the columns of the aggregated QC file"""
+        pa = import_optional("pyarrow", "arrow")
+        with pa.memory_map(str(filepath)) as source:
+            table = pa.ipc.open_file(source).read_all()
+            return cls._from_arrow_table(table, idvar, filepath, sort)
+
+    @classmethod
+    def _from_arrow_table(
+        cls, table: Any, idvar: str, filepath: Path | str, sort: bool
+    ) -> CivetData:
+        for colname in (idvar, *cls.feature_names):
+            if colname not in table.column_names:
+                raise ColumnNotFoundError(colname, filepath)
+        features = np.empty((table.num_rows, len(cls.feature_names)), dtype=np.float64)
+        for index, colname in enumerate(cls.feature_names):
+            features[:, index] = table.column(colname).to_numpy()
+        subject_ids = np.asarray(table.column(idvar).to_numpy()).astype(str)
+        return cls(subject_ids, features, sort)
+
+    def to_npz(self, filepath: Path | str) -> None:
+        """write subject IDs and features uncompressed, so that from_npz can memory-map them"""
+        np.savez(
+            filepath,
+            subject_ids=self.subject_ids.astype(str),
+            features=np.ascontiguousarray(self.features, dtype=np.float64),
+            feature_names=self.feature_names,
+        )
+
+    def to_parquet(self, filepath: Path | str) -> None:
+        """write subject IDs and features with the columns of the aggregated QC file"""
+        pq = import_optional("pyarrow.parquet", "arrow")
+        pq.write_table(self._to_arrow_table(), filepath)
+
+    def to_arrow(self, filepath: Path | str) -> None:
+        """write subject IDs and features as an Arrow IPC file"""
+        pa = import_optional("pyarrow", "arrow")
+        table = self._to_arrow_table()
+        with pa.OSFile(str(filepath), "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+
+    def _to_arrow_table(self, idvar: str = "ID") -> Any:
+        pa = import_optional("pyarrow", "arrow")
+        columns = {idvar: pa.array(self.subject_ids.astype(str))}
+        for index, colname in enumerate(self.feature_names):
+            columns[colname] = pa.array(np.ascontiguousarray(self.features[:, index]))
+        return pa.table(columns)
+
+    def to_output_files(
+        self, dir_path: Path, prefix: str = "", workers: int = 1, chunk_size: int = 4096
+    ) -> None:
+        """write features to files in the row format outputted by CIVET, optionally in parallel
+
+        Values are formatted a chunk of rows at a time and each file is written in a
+        single call, so workers threads can overlap the cost of creating files.
+        """
+
+        dir_path = Path(dir_path)
+        keys = [f"{key}=" for key in self.feature_names]
+
+        def write_file(item: tuple[str, list[str]]) -> None:
+            subject_id, values = item
             filename = f"{subject_id}_civet_qc.txt"
             if prefix != "":
                 filename = prefix + "_" + filename
-            filepath = dir_path.joinpath(filename)
-            with open(filepath, "w") as file:
-                for key, value in zip(self.feature_names, self.features[index]):
-                    file.write(f"{key}={value}\n")
+            text = "".join([key + value + "\n" for key, value in zip(keys, values)])
+            with open(dir_path.joinpath(filename), "w") as file:
+                file.write(text)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for chunk in self.chunks(chunk_size):
+                items = zip(
+                    chunk.subject_ids.tolist(), chunk.features.astype(str).tolist()
+                )
+                if workers > 1:
+                    for _ in executor.map(write_file, items):
+                        pass
+                else:
+                    for item in items:
+                        write_file(item)
 
 
 class QCRatingsData:
-    """contains subject IDs and QC ratings, either for development or to format predictions for user"""
+    """contains subject IDs and QC ratings, either for development or to format predictions for user
+
+    If compact is True, subject IDs are stored in a StringTable, ratings as int8 and only
+    the probability of failure as float32, from which the probability of passing is
+    computed when the probabilities are accessed.
+    """
+
+    __slots__ = (
+        "_subject_ids",
+        "_ratings",
+        "_probabilities",
+        "_models",
+        "_explanations",
+        "_index",
+    )
 
     rating_labels = {0: "PASS", 1: "FAIL"}
 
+    column_names = ("ID", "RATING", "P(PASS)", "P(FAIL)")
+
     def __init__(
         self,
-        subject_ids: np.ndarray,
+        subject_ids: np.ndarray | StringTable,
         ratings: np.ndarray,
         probabilities: np.ndarray | None = None,
+        sort: bool = True,
+        models: dict[str, tuple[np.ndarray, np.ndarray]] | None = None,
+        compact: bool = False,
+        explanations: tuple[np.ndarray, np.ndarray] | None = None,
     ) -> None:
-        if probabilities is None:
-            probabilities = np.full((len(subject_ids), 2), np.NaN)
-        if not len(subject_ids) == len(ratings) == len(probabilities):
+        """models optionally maps the names of further models to their ratings and probabilities
+
+        explanations optionally holds, in two arrays with one row per subject, the indices
+        in CivetData.feature_names of the features contributing most to the probability
+        of failure and their contributions, in decreasing order.
+        """
+        n_probabilities = len(ratings) if probabilities is None else len(probabilities)
+        if not len(subject_ids) == len(ratings) == n_probabilities:
             raise AssertionError(
-                f"False: {len(subject_ids)} == {len(ratings)} == {len(probabilities)}"
+                f"False: {len(subject_ids)} == {len(ratings)} == {n_probabilities}"
             )
-        self._subject_ids, self._ratings, self._probabilities = joint_sort(
-            subject_ids, ratings, probabilities
+        models = models or {}
+        arrays = [ratings] if probabilities is None else [ratings, probabilities]
+        for model_ratings, model_probabilities in models.values():
+            arrays += [model_ratings, model_probabilities]
+        n_arrays = len(arrays)
+        if explanations is not None:
+            arrays += list(explanations)
+        if isinstance(subject_ids, StringTable) and sort:
+            subject_ids = subject_ids.to_array()
+        index = None
+        if sort:
+            index = SubjectIndex(subject_ids)
+            if not index.is_sorted:
+                subject_ids = index.sorted_ids
+                arrays = [array[index.order] for array in arrays]
+                index = index.sorted()
+        arrays, explanation_arrays = arrays[:n_arrays], arrays[n_arrays:]
+        if probabilities is None:
+            # missing probabilities are created as NaN when accessed
+            arrays.insert(1, None)
+        if compact:
+            if not isinstance(subject_ids, StringTable):
+                subject_ids = StringTable.from_array(subject_ids)
+            arrays = [
+                _compact_probabilities(array) if index % 2 else _compact_ratings(array)
+                for index, array in enumerate(arrays)
+            ]
+        self._subject_ids: np.ndarray | StringTable = subject_ids
+        self._ratings, self._probabilities = arrays[:2]
+        self._models = {
+            name: (arrays[2 + 2 * position], arrays[3 + 2 * position])
+            for position, name in enumerate(models)
+        }
+        self._explanations = (
+            (explanation_arrays[0], explanation_arrays[1])
+            if explanation_arrays
+            else None
+        )
+        self._index = None if compact else index
+
+    def __len__(self) -> int:
+        return len(self._subject_ids)
+
+    @property
+    def index(self) -> SubjectIndex:
+        if self._index is None:
+            self._index = SubjectIndex(self.subject_ids)
+        return self._index
+
+    def _take(self, positions: np.ndarray) -> QCRatingsData:
+        return type(self)(
+            self.subject_ids[positions],
+            self._ratings[positions],
+            _slice_rows(self._probabilities, positions),
+            sort=False,
+            models={
+                name: (ratings[positions], probabilities[positions])
+                for name, (ratings, probabilities) in self._models.items()
+            },
+            compact=self.compact,
+            explanations=self._slice_explanations(positions),
         )
 
     @property
     def subject_ids(self) -> np.ndarray:
+        """the subject IDs as an array, which is created on each access if compact"""
+        if isinstance(self._subject_ids, StringTable):
+            return self._subject_ids.to_array()
         return self._subject_ids
 
     @property
@@ -191,51 +959,144 @@ class QCRatingsData:
 
     @property
     def probabilities(self) -> np.ndarray:
-        return self._probabilities
+        """the probability of each rating in two columns, created on each access if compact"""
+        return _expand_probabilities(self._probabilities, len(self))
+
+    @property
+    def models(self) -> dict[str, tuple[np.ndarray, np.ndarray]]:
+        return {
+            name: (ratings, _expand_probabilities(probabilities, len(self)))
+            for name, (ratings, probabilities) in self._models.items()
+        }
+
+    @property
+    def explanations(self) -> tuple[np.ndarray, np.ndarray] | None:
+        return self._explanations
+
+    @property
+    def n_explained(self) -> int:
+        """the number of features explaining the probability of failure of each subject"""
+        return 0 if self._explanations is None else self._explanations[0].shape[1]
+
+    @property
+    def compact(self) -> bool:
+        return isinstance(self._subject_ids, StringTable)
+
+    def _slice_explanations(
+        self, rows: slice | np.ndarray
+    ) -> tuple[np.ndarray, np.ndarray] | None:
+        if self._explanations is None:
+            return None
+        features, contributions = self._explanations
+        return features[rows], contributions[rows]
+
+    def to_compact(self) -> QCRatingsData:
+        """return an instance with the compact layout"""
+        if self.compact:
+            return self
+        return type(self)(
+            self._subject_ids,
+            self._ratings,
+            self._probabilities,
+            sort=False,
+            models=self._models,
+            compact=True,
+            explanations=self._explanations,
+        )
+
+    def chunks(self, chunk_size: int) -> Iterator[QCRatingsData]:
+        """yield unsorted instances for consecutive chunks of rows, never compact"""
+        if not self.compact and len(self) <= chunk_size:
+            yield self
+            return
+        for start in range(0, len(self), chunk_size):
+            rows = slice(start, start + chunk_size)
+            subject_ids = self._subject_ids[rows]
+            if isinstance(subject_ids, StringTable):
+                subject_ids = subject_ids.to_array()
+            n_rows = len(subject_ids)
+            yield type(self)(
+                subject_ids,
+                self._ratings[rows],
+                _expand_probabilities(_slice_rows(self._probabilities, rows), n_rows),
+                sort=False,
+                models={
+                    name: (
+                        ratings[rows],
+                        _expand_probabilities(probabilities[rows], n_rows),
+                    )
+                    for name, (ratings, probabilities) in self._models.items()
+                },
+                explanations=self._slice_explanations(rows),
+            )
+
+    def get_column_names(self) -> list[str]:
+        """return the columns of tabular output, with three more for each further model
+        and two more for each explaining feature"""
+        column_names = list(self.column_names)
+        for name in self._models:
+            column_names += [f"{column}[{name}]" for column in self.column_names[1:]]
+        for rank in range(1, self.n_explained + 1):
+            column_names += [f"FEATURE[{rank}]", f"CONTRIBUTION[{rank}]"]
+        return column_names
 
     def to_dict(self) -> dict:
         d = {}
+        probabilities, models = self.probabilities, self.models
         for index, subject_id in enumerate(self.subject_ids):
-            d[subject_id] = {
-                "rating": self.rating_labels[self.ratings[index]],
-                "probabilities": {
-                    self.rating_labels[0]: round(self.probabilities[index][0], 3),
-                    self.rating_labels[1]: round(self.probabilities[index][1], 3),
-                },
-            }
+            d[subject_id] = self._entry(self.ratings[index], probabilities[index])
+            if models:
+                d[subject_id]["models"] = {
+                    name: self._entry(model_ratings[index], model_probabilities[index])
+                    for name, (model_ratings, model_probabilities) in models.items()
+                }
+            if self._explanations is not None:
+                d[subject_id]["explanation"] = [
+                    {
+                        "feature": CivetData.feature_names[feature_index],
+                        "contribution": round(contribution, 3),
+                    }
+                    for feature_index, contribution in zip(
+                        self._explanations[0][index].tolist(),
+                        self._explanations[1][index].tolist(),
+                    )
+                ]
         return d
 
+    @classmethod
+    def _entry(cls, qc_rating: int, probabilities: np.ndarray) -> dict:
+        return {
+            "rating": cls.rating_labels[qc_rating],
+            "probabilities": {
+                cls.rating_labels[0]: round(probabilities[0], 3),
+                cls.rating_labels[1]: round(probabilities[1], 3),
+            },
+        }
+
     def to_csv(self, filepath: Path | str) -> None:
-        with open(filepath, "w", newline="") as file:
-            writer = csv.DictWriter(
-                file,
-                fieldnames=[
-                    "ID",
-                    "RATING",
-                    f"P({self.rating_labels[0]})",
-                    f"P({self.rating_labels[1]})",
-                ],
-            )
-            writer.writeheader()
-            for index, (subject_id, qc_rating) in enumerate(
-                zip(self.subject_ids, self.ratings)
-            ):
-                writer.writerow(
-                    {
-                        "ID": subject_id,
-                        "RATING": self.rating_labels[qc_rating],
-                        f"P({self.rating_labels[0]})": round(
-                            self.probabilities[index][0], 3
-                        ),
-                        f"P({self.rating_labels[1]})": round(
-                            self.probabilities[index][1], 3
-                        ),
-                    }
-                )
+        self.write(filepath, "csv")
 
     def to_json(self, filepath: Path | str) -> None:
-        with open(filepath, "w") as file:
-            json.dump(self.to_dict(), file, indent=2)
+        self.write(filepath, "json")
+
+    def to_ndjson(self, filepath: Path | str) -> None:
+        self.write(filepath, "ndjson")
+
+    def to_npz(self, filepath: Path | str) -> None:
+        self.write(filepath, "npz")
+
+    def to_parquet(self, filepath: Path | str) -> None:
+        self.write(filepath, "parquet")
+
+    def to_arrow(self, filepath: Path | str) -> None:
+        self.write(filepath, "arrow")
+
+    def write(self, filepath: Path | str, output_format: str) -> None:
+        """write ratings to filepath in one of the formats supported by RatingsWriter"""
+        from .writers import RatingsWriter
+
+        with RatingsWriter.open(filepath, output_format) as writer:
+            writer.write(self)
 
     @classmethod
     def from_csv(
@@ -269,3 +1130,139 @@ class QCRatingsData:
                 ratings.append(qc_rating)
 
         return cls(np.array(subject_ids), np.array(ratings))
+
+    @classmethod
+    def from_npz(
+        cls, filepath: Path | str, mmap: bool = True, sort: bool = True
+    ) -> QCRatingsData:
+        """create instance from a file written by to_npz, memory-mapping its arrays unless mmap is False"""
+        arrays = load_npz(filepath, mmap)
+        for name in ("subject_ids", "ratings", "probabilities"):
+            if name not in arrays:
+                raise ColumnNotFoundError(name, filepath)
+        names = [key[8:-1] for key in arrays if key.startswith("ratings[")]
+        models = {
+            name: (arrays[f"ratings[{name}]"], arrays[f"probabilities[{name}]"])
+            for name in names
+        }
+        explanations = None
+        if "explanation_features" in arrays:
+            explanations = (
+                SubjectIndex(CivetData.feature_names)
+                .get_indexer(arrays["explanation_features"].ravel())
+                .reshape(arrays["explanation_features"].shape),
+                arrays["explanation_contributions"],
+            )
+        return cls(
+            arrays["subject_ids"],
+            arrays["ratings"],
+            arrays["probabilities"],
+            sort,
+            models,
+            explanations=explanations,
+        )
+
+    @classmethod
+    def from_parquet(cls, filepath: Path | str, sort: bool = True) -> QCRatingsData:
+        """create instance from a Parquet file written by to_parquet"""
+        pq = import_optional("pyarrow.parquet", "arrow")
+        return cls._from_arrow_table(pq.read_table(filepath), filepath, sort)
+
+    @classmethod
+    def from_arrow(cls, filepath: Path | str, sort: bool = True) -> QCRatingsData:
+        """create instance from an Arrow IPC file written by to_arrow"""
+        pa = import_optional("pyarrow", "arrow")
+        with pa.memory_map(str(filepath)) as source:
+            table = pa.ipc.open_file(source).read_all()
+            return cls._from_arrow_table(table, filepath, sort)
+
+    @classmethod
+    def _from_arrow_table(
+        cls, table: Any, filepath: Path | str, sort: bool
+    ) -> QCRatingsData:
+        for colname in cls.column_names:
+            if colname not in table.column_names:
+                raise ColumnNotFoundError(colname, filepath)
+        idvar, qcvar, *probability_columns = cls.column_names
+        labels = np.asarray(table.column(qcvar).to_numpy()).astype(str)
+        ratings = np.full(len(labels), -1)
+        for qc_rating, label in cls.rating_labels.items():
+            ratings[labels == label] = qc_rating
+        if (ratings == -1).any():
+            value = labels[ratings == -1][0]
+            raise NonNumericValueError(qcvar, value, filepath)
+        probabilities = np.column_stack(
+            [table.column(colname).to_numpy() for colname in probability_columns]
+        )
+        subject_ids = np.asarray(table.column(idvar).to_numpy()).astype(str)
+        return cls(subject_ids, ratings, probabilities.reshape(-1, 2), sort)
+
+    @classmethod
+    def _arrow_schema(cls, column_names: Sequence[str] | None = None) -> Any:
+        pa = import_optional("pyarrow", "arrow")
+        column_names = column_names or cls.column_names
+        return pa.schema(
+            [
+                (
+                    colname,
+                    (
+                        pa.float64()
+                        if colname.startswith(("P(", "CONTRIBUTION["))
+                        else pa.string()
+                    ),
+                )
+                for colname in column_names
+            ]
+        )
+
+    def _to_arrow_table(self) -> Any:
+        """return a table with the columns of the CSV output and unrounded probabilities"""
+        pa = import_optional("pyarrow", "arrow")
+        labels = np.array([self.rating_labels[0], self.rating_labels[1]])
+        columns = [pa.array(self.subject_ids.astype(str))]
+        for ratings, probabilities in [
+            (self.ratings, self.probabilities),
+            *self.models.values(),
+        ]:
+            columns += [
+                pa.array(labels[np.asarray(ratings, dtype=int)]),
+                pa.array(np.ascontiguousarray(probabilities[:, 0], dtype=np.float64)),
+                pa.array(np.ascontiguousarray(probabilities[:, 1], dtype=np.float64)),
+            ]
+        if self._explanations is not None:
+            features, contributions = self._explanations
+            for rank in range(self.n_explained):
+                columns += [
+                    pa.array(CivetData.feature_names[features[:, rank]]),
+                    pa.array(np.asarray(contributions[:, rank], dtype=np.float64)),
+                ]
+        return pa.Table.from_arrays(
+            columns, schema=self._arrow_schema(self.get_column_names())
+        )
+
+
+def _compact_ratings(ratings: np.ndarray) -> np.ndarray:
+    return np.asarray(ratings).astype(np.int8, copy=False)
+
+
+def _compact_probabilities(probabilities: np.ndarray | None) -> np.ndarray | None:
+    """keep only the probability of failure, as float32"""
+    if probabilities is None or probabilities.ndim == 1:
+        return probabilities
+    return np.ascontiguousarray(probabilities[:, 1], dtype=np.float32)
+
+
+def _expand_probabilities(probabilities: np.ndarray | None, n_rows: int) -> np.ndarray:
+    """return the probability of each rating from probabilities stored in either layout"""
+    if probabilities is None:
+        return np.full((n_rows, 2), np.NaN)
+    elif probabilities.ndim == 2:
+        return probabilities
+    p_fail = probabilities.astype(np.float64)
+    return np.column_stack([1 - p_fail, p_fail])
+
+
+def _slice_rows(
+    array: np.ndarray | None, rows: slice | np.ndarray
+) -> np.ndarray | None:
+    return None if array is None else array[rows]
@@ -0,0 +1,220 @@
+from __future__ import annotations
+
+import fnmatch
+import json
+import os
+import sqlite3
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from types import TracebackType
+from typing import Iterable
+
+from . import profiling
+from .data import CivetData
+
+# subject ID, path, modification time and size of a QC file
+IndexedFile = tuple[str, str, int, int]
+
+# modification time, subdirectory names and QC files (name, mtime, size) of a directory
+DirectoryRecord = tuple[int, list[str], list[tuple[str, int, int]]]
+
+# directories modified this recently are listed again on the next walk, since a change
+# within the resolution of the modification time would not be noticed
+_racy_seconds = 2
+
+
+class OutputFileIndex:
+    """index of the CIVET QC files found by walking one or more directory trees
+
+    Each directory is recorded with its modification time, the names of its
+    subdirectories and the path, modification time and size of its QC files. Adding,
+    removing or renaming an entry changes the modification time of its directory, so
+    a later walk lists only directories whose time changed and takes the rest from the
+    index at the cost of one stat each. Files rewritten in place keep their recorded
+    time and size until their directory is listed again, which does not affect reading
+    them. Without a filepath, the index is held in memory for a single walk.
+    """
+
+    filename = "civetqc_index.sqlite"
+
+    def __init__(self, filepath: Path | str | None = None) -> None:
+        self.filepath = None if filepath is None else Path(filepath)
+        self.listed_count = 0
+        self._connection = sqlite3.connect(
+            ":memory:" if self.filepath is None else self.filepath
+        )
+        self._connection.executescript("""
+            CREATE TABLE IF NOT EXISTS directories (
+                path TEXT PRIMARY KEY,
+                mtime_ns INTEGER NOT NULL,
+                subdirectories TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                directory TEXT NOT NULL,
+                name TEXT NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                size INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS files_directory ON files (directory);
+            """)
+
+    def __enter__(self) -> OutputFileIndex:
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def walk(
+        self,
+        roots: Iterable[Path | str],
+        pattern: str = "*civet_qc.txt",
+        max_depth: int | None = None,
+        prefix: str = "",
+        shard: tuple[int, int] | None = None,
+        workers: int = 1,
+    ) -> list[IndexedFile]:
+        """return the QC files under roots whose path relative to its root matches pattern
+
+        Directories are listed in parallel one level at a time, descending at most
+        max_depth levels below each root, and symbolic links to directories are not
+        followed. The pattern is matched with fnmatch, where '*' also matches '/'.
+        """
+
+        roots = [Path(root).resolve() for root in roots]
+        known = self._load()
+        visited: dict[str, DirectoryRecord] = {}
+        relisted: set[str] = set()
+        found = []
+
+        def visit(path: str) -> tuple[str, DirectoryRecord | None, bool]:
+            try:
+                mtime_ns = os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                return path, None, False
+            record = known.get(path)
+            if record is not None and record[0] == mtime_ns:
+                return path, record, False
+            return path, self._list(path, mtime_ns), True
+
+        with (
+            profiling.span("list_output_files"),
+            ThreadPoolExecutor(max_workers=workers) as executor,
+        ):
+            for root in roots:
+                level = [str(root)]
+                depth = 0
+                while level:
+                    next_level = []
+                    for path, record, listed in executor.map(visit, level):
+                        if record is None or path in visited:
+                            continue
+                        visited[path] = record
+                        if listed:
+                            relisted.add(path)
+                        relative = os.path.relpath(path, root) if depth else ""
+                        for name, mtime_ns, size in record[2]:
+                            if not fnmatch.fnmatchcase(
+                                os.path.join(relative, name).replace(os.sep, "/"),
+                                pattern,
+                            ):
+                                continue
+                            subject_id = CivetData._select_output_file(
+                                name, prefix, shard=shard
+                            )
+                            if subject_id is not None:
+                                found.append(
+                                    (
+                                        subject_id,
+                                        os.path.join(path, name),
+                                        mtime_ns,
+                                        size,
+                                    )
+                                )
+                        if max_depth is None or depth < max_depth:
+                            next_level.extend(
+                                os.path.join(path, name) for name in record[1]
+                            )
+                    level = next_level
+                    depth += 1
+            self.listed_count = len(relisted)
+            profiling.count("directories_listed", len(relisted))
+
+        stale = []
+        if max_depth is None:
+            # directories under a root that were not reached have been removed
+            stale = [
+                path
+                for path in known
+                if path not in visited
+                and any(
+                    path == str(root) or path.startswith(str(root) + os.sep)
+                    for root in roots
+                )
+            ]
+        self._save({path: visited[path] for path in relisted}, stale)
+        return found
+
+    @staticmethod
+    def _list(path: str, mtime_ns: int) -> DirectoryRecord:
+        subdirectories = []
+        files = []
+        started = time.time_ns()
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirectories.append(entry.name)
+                    elif CivetData.get_subject_id(entry.name) is not None:
+                        stat = entry.stat()
+                        files.append((entry.name, stat.st_mtime_ns, stat.st_size))
+                except FileNotFoundError:
+                    continue
+        if started - mtime_ns < _racy_seconds * 10**9:
+            mtime_ns = -1
+        return mtime_ns, subdirectories, files
+
+    def _load(self) -> dict[str, DirectoryRecord]:
+        records: dict[str, DirectoryRecord] = {
+            path: (mtime_ns, json.loads(subdirectories), [])
+            for path, mtime_ns, subdirectories in self._connection.execute(
+                "SELECT path, mtime_ns, subdirectories FROM directories"
+            )
+        }
+        for directory, name, mtime_ns, size in self._connection.execute(
+            "SELECT directory, name, mtime_ns, size FROM files"
+        ):
+            if directory in records:
+                records[directory][2].append((name, mtime_ns, size))
+        return records
+
+    def _save(self, records: dict[str, DirectoryRecord], stale: list[str]) -> None:
+        removed = [(path,) for path in [*records, *stale]]
+        self._connection.executemany("DELETE FROM files WHERE directory = ?", removed)
+        self._connection.executemany("DELETE FROM directories WHERE path = ?", removed)
+        self._connection.executemany(
+            "INSERT INTO directories VALUES (?, ?, ?)",
+            [
+                (path, mtime_ns, json.dumps(subdirectories))
+                for path, (mtime_ns, subdirectories, _) in records.items()
+            ],
+        )
+        self._connection.executemany(
+            "INSERT INTO files VALUES (?, ?, ?, ?, ?)",
+            [
+                (os.path.join(path, name), path, name, mtime_ns, size)
+                for path, (_, _, files) in records.items()
+                for name, mtime_ns, size in files
+            ],
+        )
+        self._connection.commit()
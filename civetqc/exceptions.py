@@ -18,10 +18,13 @@ class ColumnNotFoundError(CivetQCError):
 class NonNumericValueError(CivetQCError):
     """raised when a value that cannot be converted to float is encountered while reading CSV file"""
 
-    def __init__(self, colname: str, value: str, filepath: Path | str) -> None:
-        super().__init__(
-            f"Unexpected non-numeric value '{value}' for column '{colname}' in file: {filepath}"
-        )
+    def __init__(
+        self, colname: str, value: str, filepath: Path | str, line: int | None = None
+    ) -> None:
+        message = f"Unexpected non-numeric value '{value}' for column '{colname}' in file: {filepath}"
+        if line is not None:
+            message += f", line {line}"
+        super().__init__(message)
 
 
 class NonUniqueIDsError(CivetQCError):
@@ -29,3 +32,33 @@ class NonUniqueIDsError(CivetQCError):
 
     def __init__(self, subject_ids: np.ndarray) -> None:
         super().__init__(f"Non-unique value for subject IDs: {subject_ids}")
+
+
+class InvalidModelArtifactError(CivetQCError):
+    """raised when a model artifact is missing files, has an unsupported format or fails verification"""
+
+    def __init__(self, path: Path | str, reason: str) -> None:
+        super().__init__(f"Invalid model artifact ({reason}): {path}")
+
+
+class IncompleteShardsError(CivetQCError):
+    """raised when merging partial results that do not cover every shard exactly once"""
+
+    def __init__(self, path: Path | str, reason: str) -> None:
+        super().__init__(f"Cannot merge partial results ({reason}): {path}")
+
+
+class CheckpointMismatchError(CivetQCError):
+    """raised when resuming a search from a checkpoint created with different settings or data"""
+
+    def __init__(self, path: Path | str) -> None:
+        super().__init__(
+            f"Checkpoint was created with different settings or data, remove it or use another directory: {path}"
+        )
+
+
+class ModelNotFoundError(CivetQCError):
+    """raised when a model reference does not match an artifact in the registry"""
+
+    def __init__(self, reference: str, path: Path | str) -> None:
+        super().__init__(f"Model '{reference}' not found in registry: {path}")
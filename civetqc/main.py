@@ -1,28 +1,89 @@
 from __future__ import annotations
 
 import argparse
+import contextlib
+import importlib
+import json
+import sys
 
 from importlib.metadata import version
 from pathlib import Path
+from typing import Iterator
 
+import numpy as np
+
+from civetqc import profiling
+from civetqc.cache import PredictionCache
 from civetqc.data import CivetData, QCRatingsData
+from civetqc.discovery import IndexedFile, OutputFileIndex
+from civetqc.merge import PARTIAL_FORMATS, parse_shard, partial_filename
 from civetqc.model import Model
+from civetqc.registry import ModelRegistry
+from civetqc.utils import is_archive
+from civetqc.writers import RATINGS_WRITERS, RatingsWriter
+
+INPUT_READERS = {
+    ".npz": CivetData.from_npz,
+    ".parquet": CivetData.from_parquet,
+    ".arrow": CivetData.from_arrow,
+}
+
+DEFAULT_PATTERN = "*civet_qc.txt"
+
+SUBCOMMANDS = {
+    "serve": ("civetqc.server", "serve predictions over HTTP or a unix socket"),
+    "merge": ("civetqc.merge", "merge partial results of sharded runs into one file"),
+    "thresholds": ("civetqc.thresholds", "report predictions for every threshold"),
+    "compress": ("civetqc.compress", "save a smaller and faster version of a model"),
+    "train": ("civetqc.train", "search for and save a new model from rated subjects"),
+    "update": ("civetqc.update", "add trees fitted on newly rated subjects to a model"),
+    "watch": ("civetqc.watch", "score QC files as they are written to a directory"),
+}
 
 
 def parse_args() -> argparse.Namespace:
-    parser = argparse.ArgumentParser(prog="civetqc")
+    parser = argparse.ArgumentParser(
+        prog="civetqc",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="commands:\n"
+        + "\n".join(f"  {name:<16}{help}" for name, (_, help) in SUBCOMMANDS.items())
+        + "\n\nrun 'civetqc COMMAND --help' for the options of a command",
+    )
     parser.add_argument(
         "-v", "--version", action="version", version=f"%(prog)s {version('civetqc')}"
     )
     parser.add_argument(
-        "input_path", type=Path, help="path to file or directory with CIVET QC outputs"
+        "input_path",
+        type=Path,
+        help="path to file, directory or .tar, .tar.gz or .zip archive with CIVET QC outputs, or to features saved as .npz, .parquet or .arrow",
     )
     parser.add_argument(
         "--threshold",
         type=float,
-        default=Model.get_default_threshold(),
+        default=None,
+        metavar="",
+        help=f"probability above which a failure will be predicted (default: the threshold saved with each model, {Model.get_default_threshold()} for the bundled model)",
+    )
+    parser.add_argument(
+        "--model",
+        type=str,
+        default=ModelRegistry.bundled_name,
+        metavar="",
+        help="comma-separated models as NAME or NAME@VERSION; models after the first add columns to the output (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--model_dir",
+        type=Path,
+        default=None,
+        metavar="",
+        help="registry of named models (default: $CIVETQC_MODELS or ~/.civetqc/models)",
+    )
+    parser.add_argument(
+        "--explain",
+        type=int,
+        default=0,
         metavar="",
-        help="probability above which a failure will be predicted (default: %(default)s)",
+        help="add the K features contributing most to the probability of failure of each subject to the output",
     )
     parser.add_argument(
         "--output_dir",
@@ -35,9 +96,102 @@ def parse_args() -> argparse.Namespace:
         "--output_format",
         type=str,
         default="csv",
-        choices=["csv", "json"],
+        choices=list(RATINGS_WRITERS),
+        metavar="",
+        help=f"format for output file: {', '.join(RATINGS_WRITERS)} (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        metavar="",
+        help="number of threads used to read a directory of QC files (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        metavar="",
+        help="number of processes used to score subjects, which share the model and features in memory (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help="reuse features and probabilities cached in the output directory for unchanged QC files",
+    )
+    parser.add_argument(
+        "--recursive",
+        action="store_true",
+        help="find QC files in subdirectories of input_path, such as SUBJECT/verify/PREFIX_ID_civet_qc.txt",
+    )
+    parser.add_argument(
+        "--root",
+        type=Path,
+        action="append",
+        default=[],
+        metavar="",
+        help="with --recursive, another directory in which to find QC files; may be repeated",
+    )
+    parser.add_argument(
+        "--pattern",
+        type=str,
+        default=DEFAULT_PATTERN,
+        metavar="",
+        help="with --recursive, glob matched against the path of each QC file relative to its root, where * also matches / (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--max_depth",
+        type=int,
+        default=None,
+        metavar="",
+        help="with --recursive, number of levels of subdirectories to descend (default: no limit)",
+    )
+    parser.add_argument(
+        "--index",
+        action="store_true",
+        help="with --recursive, keep an index of the directories walked in the output directory, so later runs only list directories that changed",
+    )
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=0,
         metavar="",
-        help="format for output file: csv, json (default: %(default)s)",
+        help="stream subjects through prediction and output in chunks of this many rows, in input order",
+    )
+    parser.add_argument(
+        "--no_sort",
+        action="store_true",
+        help="write subjects in input order rather than sorted by ID",
+    )
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="hold features as float32 and results without P(PASS), which is recomputed on output, to reduce memory",
+    )
+    parser.add_argument(
+        "--save_features",
+        action="store_true",
+        help="also write parsed features to civetqc_features.npz in the output directory, for use as input_path",
+    )
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        default=None,
+        metavar="",
+        help="only score shard i/N of the subject IDs, counting from zero, and write a partial result for 'civetqc merge'",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="write the time spent in each stage and counts of files and rows to civetqc_profile.json in the output directory",
+    )
+    parser.add_argument(
+        "--profile_capture",
+        action="append",
+        default=[],
+        choices=["cprofile", "tracemalloc"],
+        metavar="",
+        help="with --profile, also capture function statistics (cprofile) or memory allocations (tracemalloc); may be repeated",
     )
     return parser.parse_args()
 
@@ -47,37 +201,287 @@ def verify_args(args: argparse.Namespace) -> None:
         raise FileNotFoundError(f"Input path does not exist: {args.input_path}")
     elif not args.output_dir.is_dir():
         raise NotADirectoryError(f"Output directory does not exist: {args.output_dir}")
-    if not 1 > args.threshold > 0:
+    if args.threshold is not None and not 1 > args.threshold > 0:
         raise ValueError(
             f"Threshold must be greater than zero and less than one, got {args.threshold}"
         )
+    if args.workers < 1:
+        raise ValueError(f"Number of workers must be at least one, got {args.workers}")
+    if args.jobs < 1:
+        raise ValueError(f"Number of jobs must be at least one, got {args.jobs}")
+    if args.chunk_size < 0:
+        raise ValueError(f"Chunk size must not be negative, got {args.chunk_size}")
+    elif args.chunk_size and args.cache:
+        raise ValueError("The cache cannot be used when streaming in chunks")
+    elif args.chunk_size and args.compact:
+        # chunks already bound memory use, and are never compact
+        raise ValueError("The compact layout cannot be used when streaming in chunks")
+    if args.cache and not args.input_path.is_dir():
+        raise ValueError("The cache can only be used with a directory of QC files")
+    elif args.cache and (args.no_sort or args.compact):
+        # cached results are always sorted and never compact
+        raise ValueError("The cache cannot be used without sorting or with --compact")
+    if args.save_features and (args.chunk_size or args.cache):
+        raise ValueError(
+            "Features cannot be saved when streaming in chunks or using the cache"
+        )
+    if args.shard is not None:
+        if args.chunk_size or args.cache or args.no_sort:
+            raise ValueError(
+                "Shards cannot be scored in chunks, with the cache or without sorting"
+            )
+        elif args.explain:
+            # partial results are merged from the rating and probability columns only
+            raise ValueError("Explanations cannot be computed for shards")
+        elif args.output_format not in PARTIAL_FORMATS:
+            raise ValueError(
+                f"Partial results must be written as {' or '.join(PARTIAL_FORMATS)}, got {args.output_format}"
+            )
+    references = args.model.split(",")
+    if len(set(references)) < len(references) or "" in references:
+        raise ValueError(f"Models must be distinct and non-empty, got '{args.model}'")
+    elif len(references) > 1 and (args.cache or args.shard is not None):
+        raise ValueError("Only one model can be used with the cache or with shards")
+    if args.recursive:
+        if not args.input_path.is_dir():
+            raise NotADirectoryError(
+                f"Input path must be a directory with --recursive: {args.input_path}"
+            )
+        for root in args.root:
+            if not root.is_dir():
+                raise NotADirectoryError(f"Root directory does not exist: {root}")
+        if args.cache:
+            raise ValueError("The cache cannot be used with --recursive")
+        if args.max_depth is not None and args.max_depth < 0:
+            raise ValueError(
+                f"Maximum depth must not be negative, got {args.max_depth}"
+            )
+    elif (
+        args.root
+        or args.pattern != DEFAULT_PATTERN
+        or args.max_depth is not None
+        or args.index
+    ):
+        raise ValueError("Root, pattern, depth and index options require --recursive")
+    if args.explain < 0 or args.explain > len(CivetData.feature_names):
+        raise ValueError(
+            f"Number of explaining features must be between 0 and {len(CivetData.feature_names)}, got {args.explain}"
+        )
+    elif args.explain and args.cache:
+        raise ValueError("Explanations cannot be computed with the cache")
+    if args.profile_capture and not args.profile:
+        raise ValueError("Profile capture options require --profile")
 
 
-def load_civet_data(input_path: Path) -> CivetData:
-    if input_path.is_file():
-        return CivetData.from_csv(input_path)
-    return CivetData.from_output_files(input_path)
+def walk_output_files(args: argparse.Namespace) -> list[IndexedFile]:
+    """return the QC files under input_path and the other roots in args"""
+    index_filepath = None
+    if args.index:
+        index_filepath = args.output_dir.joinpath(OutputFileIndex.filename)
+    with OutputFileIndex(index_filepath) as index:
+        return index.walk(
+            [args.input_path, *args.root],
+            args.pattern,
+            args.max_depth,
+            shard=args.shard,
+            workers=args.workers,
+        )
 
 
-def main() -> None:
+def load_civet_data(
+    input_path: Path,
+    workers: int = 1,
+    sort: bool = True,
+    shard: tuple[int, int] | None = None,
+    compact: bool = False,
+    indexed_files: list[IndexedFile] | None = None,
+) -> CivetData:
+    with profiling.span("load_civet_data"):
+        if indexed_files is not None:
+            # the walk already selected the files in shard
+            return CivetData.from_filepaths(
+                [subject_id for subject_id, *_ in indexed_files],
+                [filepath for _, filepath, *_ in indexed_files],
+                workers,
+                sort,
+                compact,
+            )
+        elif input_path.suffix in INPUT_READERS and input_path.is_file():
+            civet_data = INPUT_READERS[input_path.suffix](input_path, sort=sort)
+            if shard is not None:
+                civet_data = civet_data.select_shard(shard)
+            return civet_data.to_compact() if compact else civet_data
+        elif input_path.is_file() and not is_archive(input_path):
+            return CivetData.from_csv(
+                input_path, sort=sort, shard=shard, compact=compact
+            )
+        return CivetData.from_output_files(
+            input_path, workers=workers, sort=sort, shard=shard, compact=compact
+        )
+
+
+def iter_civet_data(
+    input_path: Path,
+    workers: int = 1,
+    chunk_size: int = 65536,
+    indexed_files: list[IndexedFile] | None = None,
+) -> Iterator[CivetData]:
+    if indexed_files is not None:
+        return (
+            CivetData.from_filepaths(
+                [subject_id for subject_id, *_ in chunk],
+                [filepath for _, filepath, *_ in chunk],
+                workers,
+                sort=False,
+            )
+            for chunk in (
+                indexed_files[start : start + chunk_size]
+                for start in range(0, len(indexed_files), chunk_size)
+            )
+        )
+    elif input_path.suffix in INPUT_READERS and input_path.is_file():
+        return INPUT_READERS[input_path.suffix](input_path, sort=False).chunks(
+            chunk_size
+        )
+    elif input_path.is_file() and not is_archive(input_path):
+        return CivetData.iter_csv(input_path, chunk_size=chunk_size)
+    return CivetData.iter_output_files(
+        input_path, workers=workers, chunk_size=chunk_size
+    )
 
-    args = parse_args()
-    verify_args(args)
 
-    civet_data = load_civet_data(args.input_path)
-    model = Model.load()
+def predict_ratings(
+    model: Model,
+    civet_data: CivetData,
+    threshold: float | None = None,
+    sort: bool = True,
+    extra_models: dict[str, Model] | None = None,
+    compact: bool = False,
+    explain: int = 0,
+) -> QCRatingsData:
+    """score civet_data with model, and with each of extra_models for added columns
 
-    predicted_ratings = model.predict(civet_data.features, threshold=args.threshold)
+    If explain is positive, the features contributing most to the probability of
+    failure under model are added for each subject, at most explain of them.
+    """
     probabilities = model.predict_probabilities(civet_data.features)
+    predicted_ratings = model.ratings_from_probabilities(probabilities, threshold)
+    models = {}
+    for name, extra_model in (extra_models or {}).items():
+        extra_probabilities = extra_model.predict_probabilities(civet_data.features)
+        models[name] = (
+            extra_model.ratings_from_probabilities(extra_probabilities, threshold),
+            extra_probabilities,
+        )
+    explanations = None
+    if explain:
+        contributions = model.explain(civet_data.features)
+        top = np.argsort(-contributions, axis=1, kind="stable")[:, :explain]
+        explanations = (top, np.take_along_axis(contributions, top, axis=1))
+    # compact subject IDs are passed on without being expanded into an array
+    subject_ids = civet_data._subject_ids if compact else civet_data.subject_ids
+    return QCRatingsData(
+        subject_ids,
+        predicted_ratings,
+        probabilities,
+        sort,
+        models,
+        compact,
+        explanations,
+    )
+
+
+def run(args: argparse.Namespace) -> None:
+    registry = ModelRegistry(args.model_dir)
+    model_paths = {
+        reference: registry.resolve(reference) for reference in args.model.split(",")
+    }
+    models = {reference: Model.load(path) for reference, path in model_paths.items()}
+    model_path, *_ = model_paths.values()
+    model, *_ = models.values()
+    extra_models = dict(list(models.items())[1:])
+    if args.shard is not None:
+        output_filepath = args.output_dir.joinpath(
+            partial_filename(args.shard, args.output_format)
+        )
+    else:
+        output_filepath = args.output_dir.joinpath(f"civetqc.{args.output_format}")
 
-    qc_data = QCRatingsData(civet_data.subject_ids, predicted_ratings, probabilities)
+    with contextlib.ExitStack() as stack:
+        for loaded_model in models.values():
+            stack.enter_context(loaded_model.parallel(args.jobs))
+        indexed_files = walk_output_files(args) if args.recursive else None
+
+        if args.chunk_size:
+            with RatingsWriter.open(output_filepath, args.output_format) as writer:
+                for civet_data in iter_civet_data(
+                    args.input_path, args.workers, args.chunk_size, indexed_files
+                ):
+                    writer.write(
+                        predict_ratings(
+                            model,
+                            civet_data,
+                            args.threshold,
+                            False,
+                            extra_models,
+                            explain=args.explain,
+                        )
+                    )
+            return
+
+        if args.cache:
+            with PredictionCache(
+                args.output_dir.joinpath(PredictionCache.filename),
+                Model.get_fingerprint(model_path),
+            ) as cache:
+                qc_data = cache.predict_output_files(
+                    args.input_path, model, args.threshold, workers=args.workers
+                )
+        else:
+            civet_data = load_civet_data(
+                args.input_path,
+                args.workers,
+                sort=not args.no_sort,
+                shard=args.shard,
+                compact=args.compact,
+                indexed_files=indexed_files,
+            )
+            # civet_data is already in the requested order
+            qc_data = predict_ratings(
+                model,
+                civet_data,
+                args.threshold,
+                False,
+                extra_models,
+                args.compact,
+                args.explain,
+            )
+            if args.save_features:
+                civet_data.to_npz(args.output_dir.joinpath("civetqc_features.npz"))
+
+        qc_data.write(output_filepath, args.output_format)
+
+
+def main() -> None:
+
+    if len(sys.argv) > 1 and sys.argv[1] in SUBCOMMANDS:
+        module = importlib.import_module(SUBCOMMANDS[sys.argv[1]][0])
+        return module.main(sys.argv[2:])
+
+    args = parse_args()
+    verify_args(args)
 
-    output_filepath = args.output_dir.joinpath(f"civetqc.{args.output_format}")
-    if args.output_format == "csv":
-        qc_data.to_csv(output_filepath)
+    if not args.profile:
+        return run(args)
 
-    elif args.output_format == "json":
-        qc_data.to_json(output_filepath)
+    with profiling.profile(
+        cprofile="cprofile" in args.profile_capture,
+        trace_memory="tracemalloc" in args.profile_capture,
+    ) as profiler:
+        run(args)
+    with open(args.output_dir.joinpath("civetqc_profile.json"), "w") as file:
+        json.dump(profiler.report(), file, indent=2)
+    profiler.dump_stats(args.output_dir.joinpath("civetqc_profile.pstats"))
 
 
 if __name__ == "__main__":
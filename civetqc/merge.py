@@ -0,0 +1,188 @@
+from __future__ import annotations
+
+import argparse
+import csv
+import heapq
+import itertools
+import json
+import re
+
+from pathlib import Path
+from typing import Iterator
+
+import numpy as np
+
+from .data import QCRatingsData
+from .exceptions import IncompleteShardsError, NonUniqueIDsError
+from .utils import load_npz
+from .writers import RATINGS_WRITERS, RatingsWriter
+
+PARTIAL_FORMATS = ("csv", "ndjson", "npz")
+
+# probabilities in these partials are rounded to three decimals
+ROUNDED_FORMATS = ("csv", "ndjson")
+
+# output formats that hold probabilities unrounded
+UNROUNDED_FORMATS = ("npz", "parquet", "arrow")
+
+_partial_pattern = re.compile(r"^civetqc_shard_(\d+)_of_(\d+)\.(\w+)$")
+
+
+def parse_shard(value: str) -> tuple[int, int]:
+    """parse a shard given as 'index/count', where index counts from zero"""
+    try:
+        index, count = map(int, value.split("/"))
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(
+            f"Shard must be given as index/count, got '{value}'"
+        ) from err
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(
+            f"Shard index must be at least zero and less than the count, got '{value}'"
+        )
+    return index, count
+
+
+def partial_filename(shard: tuple[int, int], output_format: str) -> str:
+    return f"civetqc_shard_{shard[0]}_of_{shard[1]}.{output_format}"
+
+
+def find_partials(dir_path: Path) -> list[Path]:
+    """return the partial results in dir_path, checking that every shard is present"""
+    shards: dict[int, Path] = {}
+    counts = set()
+    for filepath in sorted(dir_path.iterdir()):
+        match = _partial_pattern.match(filepath.name)
+        if match is None or match.group(3) not in PARTIAL_FORMATS:
+            continue
+        index, count = int(match.group(1)), int(match.group(2))
+        if index in shards:
+            raise IncompleteShardsError(
+                dir_path, f"more than one result for shard {index}"
+            )
+        shards[index] = filepath
+        counts.add(count)
+    if len(counts) != 1:
+        raise IncompleteShardsError(
+            dir_path,
+            "no partial results" if not counts else "results for different counts",
+        )
+    missing = set(range(counts.pop())) - shards.keys()
+    if missing:
+        raise IncompleteShardsError(
+            dir_path, f"missing shards {', '.join(map(str, sorted(missing)))}"
+        )
+    return [shards[index] for index in sorted(shards)]
+
+
+def iter_partial(filepath: Path) -> Iterator[tuple[str, int, float, float]]:
+    """yield the subject ID, rating and probabilities of each row of a partial result"""
+    if filepath.suffix == ".npz":
+        arrays = load_npz(filepath)
+        for start in range(0, len(arrays["subject_ids"]), 65536):
+            rows = slice(start, start + 65536)
+            yield from zip(
+                arrays["subject_ids"][rows].tolist(),
+                arrays["ratings"][rows].tolist(),
+                arrays["probabilities"][rows, 0].tolist(),
+                arrays["probabilities"][rows, 1].tolist(),
+            )
+        return
+    ratings = {
+        label: qc_rating for qc_rating, label in QCRatingsData.rating_labels.items()
+    }
+    with open(filepath, "r", newline="") as file:
+        if filepath.suffix == ".csv":
+            reader = csv.reader(file)
+            next(reader, None)
+            for subject_id, label, p_pass, p_fail in reader:
+                yield subject_id, ratings[label], float(p_pass), float(p_fail)
+        else:
+            for line in file:
+                entry = json.loads(line)
+                probabilities = entry["probabilities"]
+                yield (
+                    entry["subject_id"],
+                    ratings[entry["rating"]],
+                    probabilities[QCRatingsData.rating_labels[0]],
+                    probabilities[QCRatingsData.rating_labels[1]],
+                )
+
+
+def merge_partials(
+    filepaths: list[Path],
+    output_filepath: Path,
+    output_format: str,
+    chunk_size: int = 65536,
+) -> int:
+    """merge partial results, each sorted by subject ID, into one sorted output file
+
+    Rows are streamed through a k-way merge and written in chunks, so memory does not
+    grow with the number of subjects. Returns the number of subjects written.
+    """
+    merged = heapq.merge(*map(iter_partial, filepaths), key=lambda row: row[0])
+    previous_id = None
+    with RatingsWriter.open(output_filepath, output_format) as writer:
+        while chunk := list(itertools.islice(merged, chunk_size)):
+            subject_ids = np.array([row[0] for row in chunk], dtype=str)
+            if previous_id is not None and subject_ids[0] <= previous_id:
+                raise NonUniqueIDsError(subject_ids[:1])
+            if subject_ids.size > 1 and not np.all(subject_ids[:-1] < subject_ids[1:]):
+                raise NonUniqueIDsError(
+                    np.unique(subject_ids[1:][subject_ids[:-1] >= subject_ids[1:]])
+                )
+            writer.write(
+                QCRatingsData(
+                    subject_ids,
+                    np.array([row[1] for row in chunk]),
+                    np.array([row[2:] for row in chunk], dtype=np.float64),
+                    sort=False,
+                )
+            )
+            previous_id = subject_ids[-1]
+        return writer.count
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="civetqc merge")
+    parser.add_argument(
+        "input_path",
+        type=Path,
+        help="directory with the partial results of every shard",
+    )
+    parser.add_argument(
+        "--output_dir",
+        type=Path,
+        default=Path.cwd(),
+        metavar="",
+        help="directory for results (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--output_format",
+        type=str,
+        default="csv",
+        choices=list(RATINGS_WRITERS),
+        metavar="",
+        help=f"format for output file: {', '.join(RATINGS_WRITERS)}, where {', '.join(UNROUNDED_FORMATS)} require npz partial results, since csv and ndjson partials are rounded to three decimals (default: %(default)s)",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str] | None = None) -> None:
+    args = parse_args(argv)
+    if not args.input_path.is_dir():
+        raise NotADirectoryError(f"Input directory does not exist: {args.input_path}")
+    elif not args.output_dir.is_dir():
+        raise NotADirectoryError(f"Output directory does not exist: {args.output_dir}")
+    filepaths = find_partials(args.input_path)
+    if args.output_format in UNROUNDED_FORMATS and any(
+        filepath.suffix[1:] in ROUNDED_FORMATS for filepath in filepaths
+    ):
+        raise ValueError(
+            f"Partial results rounded to three decimals cannot be merged as {args.output_format}, write them as npz instead"
+        )
+    merge_partials(
+        filepaths,
+        args.output_dir.joinpath(f"civetqc.{args.output_format}"),
+        args.output_format,
+    )
@@ -1,42 +1,143 @@
 from __future__ import annotations
 
-import pickle
+import contextlib
+import functools
 
-from pkg_resources import resource_filename
+from importlib.resources import files
+from pathlib import Path
+from typing import Any, Iterator
 
 import numpy as np
 
-from sklearn.ensemble import RandomForestClassifier
-from sklearn.utils.validation import check_is_fitted
+from . import profiling
+from .artifact import ModelArtifact
+from .data import CivetData
+from .forest import CompiledForest
+from .parallel import ParallelScorer
 
 
 class Model:
 
-    resource_path = resource_filename(__name__, "resources/model.pkl")
+    resource_path = Path(str(files("civetqc") / "resources" / "model"))
 
-    def __init__(self, clf: RandomForestClassifier, default_threshold: float) -> None:
-        check_is_fitted(clf)
+    def __init__(
+        self,
+        clf: Any | None,
+        default_threshold: float,
+        forest: CompiledForest | None = None,
+        metadata: dict[str, Any] | None = None,
+    ) -> None:
+        if clf is not None:
+            from sklearn.utils.validation import check_is_fitted
+
+            check_is_fitted(clf)
+        elif forest is None:
+            raise ValueError("Either a fitted classifier or a forest is required")
         self.clf = clf
         self.default_threshold = default_threshold
+        self.forest = forest
+        self.metadata = metadata or {}
+        self._scorer: ParallelScorer | None = None
 
     def predict(self, data: np.ndarray, threshold: float | None = None) -> np.ndarray:
         if threshold is None:
             threshold = self.default_threshold
-        return np.where(self.predict_probabilities(data)[:, 1] > threshold, 1, 0)
+        return self.ratings_from_probabilities(
+            self.predict_probabilities(data), threshold
+        )
 
     def predict_probabilities(self, data: np.ndarray) -> np.ndarray:
-        return self.clf.predict_proba(data)
+        with profiling.span("predict_probabilities"):
+            profiling.count("rows_scored", len(data))
+            if self._scorer is not None:
+                return self._scorer.predict_probabilities(data)
+            elif self.forest is not None:
+                return self.forest.predict_probabilities(data)
+            return self.clf.predict_proba(data)
+
+    def explain(self, data: np.ndarray) -> np.ndarray:
+        """return the contribution of each feature to the probability of failure of each subject
+
+        Columns are in the order of CivetData.feature_names, and the contributions of a
+        subject sum to its probability of failure minus expected_value.
+        """
+        with profiling.span("explain"):
+            return self.compile().forest.explain(data, class_index=1)
+
+    @property
+    def expected_value(self) -> float:
+        """the probability of failure before any split, from which contributions are measured"""
+        return float(self.compile().forest.expected_value[1])
+
+    @contextlib.contextmanager
+    def parallel(self, jobs: int) -> Iterator[Model]:
+        """within the block, score large batches in jobs processes that share the node arrays"""
+        if jobs < 2:
+            yield self
+            return
+        with ParallelScorer(self.compile().forest, jobs) as scorer:
+            self._scorer = scorer
+            try:
+                yield self
+            finally:
+                self._scorer = None
+
+    def compile(self) -> Model:
+        """flatten the classifier into node arrays used for all subsequent predictions"""
+        if self.forest is None:
+            self.forest = CompiledForest.from_estimator(self.clf)
+        return self
+
+    def ratings_from_probabilities(
+        self, probabilities: np.ndarray, threshold: float | None = None
+    ) -> np.ndarray:
+        """return predicted ratings for probabilities computed by predict_probabilities"""
+        if threshold is None:
+            threshold = self.default_threshold
+        return np.where(probabilities[:, 1] > threshold, 1, 0)
 
-    def save(self) -> None:
-        with open(self.resource_path, "wb") as file:
-            pickle.dump(self, file)
+    def save(self, path: Path | str | None = None) -> ModelArtifact:
+        """save the compiled model as an artifact, by default replacing the bundled model"""
+        metadata = dict(self.metadata)
+        if self.clf is not None:
+            import sklearn
+
+            metadata["sklearn_version"] = sklearn.__version__
+        self.compile()
+        artifact = ModelArtifact.save(
+            path or self.resource_path,
+            self.forest,
+            self.default_threshold,
+            list(CivetData.feature_names),
+            metadata,
+        )
+        _load.cache_clear()
+        return artifact
 
     @classmethod
-    def load(cls) -> Model:
-        with open(cls.resource_path, "rb") as file:
-            return pickle.load(file)
+    def load(cls, path: Path | str | None = None) -> Model:
+        """load the artifact at path, or the bundled model, reusing recently loaded models"""
+        return _load(Path(path or cls.resource_path).resolve())
 
     @classmethod
-    def get_default_threshold(cls) -> float:
-        model = Model.load()
-        return model.default_threshold
+    def get_fingerprint(cls, path: Path | str | None = None) -> str:
+        """return a digest identifying the saved model, without loading it"""
+        return ModelArtifact(path or cls.resource_path).checksum
+
+    @classmethod
+    def get_default_threshold(cls, path: Path | str | None = None) -> float:
+        """return the default threshold of the saved model, without loading it"""
+        return ModelArtifact(path or cls.resource_path).default_threshold
+
+
+# the least recently used models are dropped once more than eight are loaded
+@functools.lru_cache(maxsize=8)
+@profiling.timed("load_model")
+def _load(path: Path) -> Model:
+    artifact = ModelArtifact(path)
+    return Model(
+        None,
+        artifact.default_threshold,
+        forest=artifact.load_forest(),
+        metadata=artifact.metadata,
+    )
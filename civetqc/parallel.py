@@ -0,0 +1,159 @@
+from __future__ import annotations
+
+import multiprocessing
+import os
+import tempfile
+
+from types import TracebackType
+from typing import Any
+
+import numpy as np
+
+from .artifact import ModelArtifact
+from .forest import CompiledForest
+
+# path of the file and the name, dtype, shape and offset of each array in it
+SharedSpec = tuple[str, list[tuple[str, str, tuple[int, ...], int]]]
+
+
+class SharedArrays:
+    """arrays stored one after another in a file that other processes map into memory
+
+    On linux the file is created in /dev/shm, which is held in shared memory and never
+    written to disk, so every process that maps it reads and writes the same pages.
+    Other processes attach with the spec, which is small enough to send with each task.
+    """
+
+    alignment = 64
+
+    def __init__(self, arrays: dict[str, np.ndarray]) -> None:
+        layout = []
+        size = 0
+        for name, array in arrays.items():
+            layout.append((name, array.dtype.str, array.shape, size))
+            size += -(-array.nbytes // self.alignment) * self.alignment
+        shared_dir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+        fd, self.path = tempfile.mkstemp(prefix="civetqc_", dir=shared_dir)
+        try:
+            os.ftruncate(fd, max(size, 1))
+        finally:
+            os.close(fd)
+        self.spec: SharedSpec = (self.path, layout)
+        self.arrays = self.attach(self.spec)
+        for name, array in arrays.items():
+            self.arrays[name][...] = array
+
+    def __enter__(self) -> SharedArrays:
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """remove the file, which is freed once no process maps it"""
+        self.arrays = {}
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    @staticmethod
+    def attach(spec: SharedSpec, writeable: bool = True) -> dict[str, np.ndarray]:
+        """return views of the arrays described by spec, mapping the file once"""
+        path, layout = spec
+        buffer = np.memmap(path, dtype=np.uint8, mode="r+" if writeable else "r")
+        return {
+            name: np.ndarray(shape, np.dtype(dtype), buffer, offset)
+            for name, dtype, shape, offset in layout
+        }
+
+
+class ParallelScorer:
+    """scores samples with a compiled forest in a pool of processes sharing its node arrays
+
+    The node arrays are placed in shared memory once, when the pool is started, and
+    each call places the features and an output array there, so that processes are
+    given row ranges rather than copies of their rows. Batches with too few rows to
+    give each process at least min_rows are scored in the calling process.
+    """
+
+    min_rows = 4096
+
+    def __init__(self, forest: CompiledForest, jobs: int) -> None:
+        if jobs < 1:
+            raise ValueError(f"Number of jobs must be at least one, got {jobs}")
+        self.forest = forest
+        self.jobs = jobs
+        self._forest_arrays: SharedArrays | None = None
+        self._pool: Any = None
+
+    def __enter__(self) -> ParallelScorer:
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        if self._forest_arrays is not None:
+            self._forest_arrays.close()
+            self._forest_arrays = None
+
+    def predict_probabilities(self, data: np.ndarray) -> np.ndarray:
+        n_tasks = min(4 * self.jobs, len(data) // self.min_rows)
+        if self.jobs < 2 or n_tasks < 2:
+            return self.forest.predict_probabilities(data)
+        pool = self._get_pool()
+        output_shape = (len(data), len(self.forest.classes))
+        with SharedArrays(
+            {"features": np.asarray(data), "probabilities": np.empty(output_shape)}
+        ) as shared:
+            bounds = np.linspace(0, len(data), n_tasks + 1, dtype=int).tolist()
+            pool.starmap(
+                _score_rows,
+                [(shared.spec, a, b) for a, b in zip(bounds[:-1], bounds[1:])],
+            )
+            return np.array(shared.arrays["probabilities"])
+
+    def _get_pool(self) -> Any:
+        if self._pool is None:
+            self._forest_arrays = SharedArrays(
+                {name: getattr(self.forest, name) for name in ModelArtifact.array_names}
+            )
+            # forked from a server process, so that threads of the caller are not copied
+            if "forkserver" in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context("forkserver")
+                context.set_forkserver_preload([__name__])
+            else:
+                context = multiprocessing.get_context("spawn")
+            self._pool = context.Pool(
+                self.jobs, _init_worker, (self._forest_arrays.spec,)
+            )
+        return self._pool
+
+
+_worker_forest: CompiledForest | None = None
+
+
+def _init_worker(forest_spec: SharedSpec) -> None:
+    global _worker_forest
+    _worker_forest = CompiledForest(**SharedArrays.attach(forest_spec, writeable=False))
+
+
+def _score_rows(spec: SharedSpec, start: int, stop: int) -> None:
+    assert _worker_forest is not None
+    arrays = SharedArrays.attach(spec)
+    arrays["probabilities"][start:stop] = _worker_forest.predict_probabilities(
+        arrays["features"][start:stop]
+    )
@@ -0,0 +1,188 @@
+from __future__ import annotations
+
+import collections
+import contextlib
+import cProfile
+import functools
+import pstats
+import threading
+import time
+import tracemalloc
+
+from pathlib import Path
+from types import TracebackType
+from typing import Any, Callable, Iterator
+
+# rates reported when both the counter and the span were recorded
+RATES = {
+    "rows_scored_per_second": ("rows_scored", "predict_probabilities"),
+    "files_read_per_second": ("files_read", "read_output_files"),
+    "rows_written_per_second": ("rows_written", "write_output"),
+}
+
+_active: Profiler | None = None
+
+
+class Profiler:
+    """accumulates the time spent in named spans and the totals of named counters"""
+
+    def __init__(self, cprofile: bool = False, trace_memory: bool = False) -> None:
+        self.spans: dict[str, list[float]] = collections.defaultdict(lambda: [0, 0.0])
+        self.counters: dict[str, int] = collections.defaultdict(int)
+        self.cprofile = cProfile.Profile() if cprofile else None
+        self.trace_memory = trace_memory
+        self.elapsed = 0.0
+        self._lock = threading.Lock()
+        self._memory_snapshot: tracemalloc.Snapshot | None = None
+        self._peak_memory = 0
+
+    def add_span(self, name: str, seconds: float) -> None:
+        with self._lock:
+            totals = self.spans[name]
+            totals[0] += 1
+            totals[1] += seconds
+
+    def count(self, name: str, value: int = 1) -> None:
+        with self._lock:
+            self.counters[name] += value
+
+    def start(self) -> None:
+        if self.trace_memory:
+            tracemalloc.start()
+        if self.cprofile is not None:
+            self.cprofile.enable()
+        self._start_time = time.perf_counter()
+
+    def stop(self) -> None:
+        self.elapsed = time.perf_counter() - self._start_time
+        if self.cprofile is not None:
+            self.cprofile.disable()
+        if self.trace_memory:
+            _, self._peak_memory = tracemalloc.get_traced_memory()
+            self._memory_snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+
+    def report(self, top: int = 20) -> dict[str, Any]:
+        """return the totals as a dictionary that can be serialized to JSON"""
+        report: dict[str, Any] = {
+            "elapsed_seconds": self.elapsed,
+            "spans": {
+                name: {"calls": calls, "seconds": seconds}
+                for name, (calls, seconds) in self.spans.items()
+            },
+            "counters": dict(self.counters),
+            "rates": {},
+        }
+        for rate_name, (counter_name, span_name) in RATES.items():
+            if counter_name in self.counters and self.spans.get(span_name, [0, 0])[1]:
+                report["rates"][rate_name] = (
+                    self.counters[counter_name] / self.spans[span_name][1]
+                )
+        if self.cprofile is not None:
+            stats = pstats.Stats(self.cprofile)
+            entries = sorted(
+                stats.stats.items(),  # type: ignore[attr-defined]
+                key=lambda item: item[1][3],
+                reverse=True,
+            )
+            report["cprofile"] = []
+            for (filename, line, name), stat in entries[:top]:
+                _, calls, own_time, cumulative_time, _ = stat
+                report["cprofile"].append(
+                    {
+                        "function": f"{filename}:{line}({name})",
+                        "calls": calls,
+                        "own_seconds": own_time,
+                        "cumulative_seconds": cumulative_time,
+                    }
+                )
+        if self._memory_snapshot is not None:
+            report["memory"] = {
+                "peak_mb": self._peak_memory / 2**20,
+                "top_allocations": [
+                    {"location": str(stat.traceback), "size_mb": stat.size / 2**20}
+                    for stat in self._memory_snapshot.statistics("lineno")[:top]
+                ],
+            }
+        return report
+
+    def dump_stats(self, filepath: Path | str) -> None:
+        """write the raw cProfile statistics, for use with pstats or snakeviz"""
+        if self.cprofile is not None:
+            self.cprofile.dump_stats(filepath)
+
+
+class _Span:
+    __slots__ = ("profiler", "name", "start_time")
+
+    def __init__(self, profiler: Profiler, name: str) -> None:
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self) -> _Span:
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        self.profiler.add_span(self.name, time.perf_counter() - self.start_time)
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self) -> _NullSpan:
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(name: str) -> _Span | _NullSpan:
+    """return a context manager that adds its duration to the named span while profiling"""
+    if _active is None:
+        return _NULL_SPAN
+    return _Span(_active, name)
+
+
+def count(name: str, value: int = 1) -> None:
+    """add value to the named counter while profiling"""
+    if _active is not None:
+        _active.count(name, value)
+
+
+def timed(name: str) -> Callable[[Callable], Callable]:
+    """used as a decorator to record each call of a function as the named span"""
+
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            if _active is None:
+                return func(*args, **kwargs)
+            with _Span(_active, name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@contextlib.contextmanager
+def profile(cprofile: bool = False, trace_memory: bool = False) -> Iterator[Profiler]:
+    """record spans and counters within the block, which are otherwise not collected"""
+    global _active
+    profiler = Profiler(cprofile, trace_memory)
+    previous, _active = _active, profiler
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+        _active = previous
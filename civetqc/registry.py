@@ -0,0 +1,110 @@
+from __future__ import annotations
+
+import os
+import re
+
+from pathlib import Path
+
+from .artifact import ModelArtifact
+from .exceptions import ModelNotFoundError
+from .model import Model
+
+_name_pattern = re.compile(r"^[A-Za-z0-9_.-]+$")
+
+
+class ModelRegistry:
+    """directory of named model artifacts, each saved under a version subdirectory
+
+    A model is referenced as NAME, for its latest version, or NAME@VERSION. The bundled
+    model is always available as 'bundled'. Loaded models are shared through the LRU
+    cache of Model.load, so resolving the same artifact twice does not read it again.
+    """
+
+    bundled_name = "bundled"
+
+    def __init__(self, path: Path | str | None = None) -> None:
+        self.path = Path(path) if path is not None else self.default_path()
+
+    @staticmethod
+    def default_path() -> Path:
+        """return $CIVETQC_MODELS, or ~/.civetqc/models if it is not set"""
+        env_path = os.environ.get("CIVETQC_MODELS")
+        if env_path:
+            return Path(env_path)
+        return Path.home().joinpath(".civetqc", "models")
+
+    def names(self) -> list[str]:
+        if not self.path.is_dir():
+            return []
+        return sorted(
+            dir_path.name
+            for dir_path in self.path.iterdir()
+            if dir_path.is_dir()
+            and (self._is_artifact(dir_path) or self.versions(dir_path.name))
+        )
+
+    def versions(self, name: str) -> list[str]:
+        """return the saved versions of a model, oldest first"""
+        dir_path = self.path.joinpath(name)
+        if not dir_path.is_dir():
+            return []
+        return sorted(
+            (
+                version_path.name
+                for version_path in dir_path.iterdir()
+                if self._is_artifact(version_path)
+            ),
+            key=_version_key,
+        )
+
+    def resolve(self, reference: str) -> Path:
+        """return the artifact path of a reference given as NAME or NAME@VERSION"""
+        name, _, version = reference.partition("@")
+        if name == self.bundled_name and not version:
+            return Model.resource_path
+        dir_path = self.path.joinpath(name)
+        if not _name_pattern.match(name):
+            raise ModelNotFoundError(reference, self.path)
+        if not version:
+            # a model saved without versions is its own artifact
+            if self._is_artifact(dir_path):
+                return dir_path
+            versions = self.versions(name)
+            if not versions:
+                raise ModelNotFoundError(reference, self.path)
+            version = versions[-1]
+        if not _name_pattern.match(version) or not self._is_artifact(
+            dir_path.joinpath(version)
+        ):
+            raise ModelNotFoundError(reference, self.path)
+        return dir_path.joinpath(version)
+
+    def load(self, reference: str) -> Model:
+        return Model.load(self.resolve(reference))
+
+    def register(self, name: str, model: Model, version: str | None = None) -> Path:
+        """save model as a new version of name, by default one more than the latest integer"""
+        if not _name_pattern.match(name) or name == self.bundled_name:
+            raise ValueError(f"Invalid model name: {name}")
+        if version is None:
+            numbers = [int(v) for v in self.versions(name) if v.isdigit()]
+            version = str(max(numbers, default=0) + 1)
+        elif not _name_pattern.match(version):
+            raise ValueError(f"Invalid model version: {version}")
+        path = self.path.joinpath(name, version)
+        if path.exists():
+            raise FileExistsError(f"Model version already exists: {path}")
+        model.save(path)
+        return path
+
+    @staticmethod
+    def _is_artifact(path: Path) -> bool:
+        return path.joinpath(ModelArtifact.header_filename).is_file()
+
+
+def _version_key(version: str) -> tuple:
+    # compare numeric parts as numbers, so that version 10 follows version 9
+    return tuple(
+        (0, int(part), "") if part.isdigit() else (1, 0, part)
+        for part in re.split(r"[.-]", version)
+    )
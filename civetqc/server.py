@@ -0,0 +1,343 @@
+from __future__ import annotations
+
+import argparse
+import collections
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+from .data import CivetData, QCRatingsData
+from .exceptions import CivetQCError
+from .model import Model
+
+
+class MicroBatcher:
+    """groups concurrent prediction requests into a single call to predict_probabilities
+
+    The first queued request opens a batch, which is scored once it holds max_batch_size
+    rows or max_delay seconds have passed, whichever comes first.
+    """
+
+    def __init__(
+        self, model: Model, max_batch_size: int = 256, max_delay: float = 0.002
+    ) -> None:
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.batch_count = 0
+        self.row_count = 0
+        self._queue: queue.Queue[tuple[np.ndarray, Future] | None] = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def predict_probabilities(self, features: np.ndarray) -> np.ndarray:
+        future: Future = Future()
+        self._queue.put((features, future))
+        return future.result()
+
+    def close(self) -> None:
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            n_rows = len(item[0])
+            deadline = time.monotonic() + self.max_delay
+            while n_rows < self.max_batch_size:
+                try:
+                    item = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)
+                    break
+                batch.append(item)
+                n_rows += len(item[0])
+            self._predict(batch)
+
+    def _predict(self, batch: list[tuple[np.ndarray, Future]]) -> None:
+        try:
+            probabilities = self.model.predict_probabilities(
+                np.concatenate([features for features, _ in batch])
+            )
+        except Exception as err:
+            for _, future in batch:
+                future.set_exception(err)
+            return
+        self.batch_count += 1
+        self.row_count += len(probabilities)
+        offset = 0
+        for features, future in batch:
+            future.set_result(probabilities[offset : offset + len(features)])
+            offset += len(features)
+
+
+class LatencyTracker:
+    """records request latencies and reports percentiles over the most recent requests"""
+
+    def __init__(self, window: int = 10000) -> None:
+        self.request_count = 0
+        self.error_count = 0
+        self._latencies: collections.deque[float] = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, latency: float, error: bool = False) -> None:
+        with self._lock:
+            self.request_count += 1
+            self.error_count += error
+            self._latencies.append(latency)
+
+    def summary(self) -> dict[str, Any]:
+        with self._lock:
+            latencies = np.array(self._latencies) * 1000
+        p50, p99 = np.percentile(latencies, [50, 99]) if latencies.size else (0, 0)
+        return {
+            "requests": self.request_count,
+            "errors": self.error_count,
+            "latency_ms": {"p50": round(p50, 3), "p99": round(p99, 3)},
+        }
+
+
+class PredictionServer:
+    """long-lived prediction service that keeps the model loaded between requests
+
+    POST /predict accepts either the body of a civet_qc.txt file, with the subject ID in
+    the 'id' query parameter, or a JSON object (or list of objects) with 'subject_id' and
+    'features', given as a list in the order of CivetData.feature_names or as a mapping
+    of feature names to values. The threshold may be overridden with the 'threshold'
+    query parameter. GET /metrics reports request counts, batching and latency.
+    """
+
+    def __init__(
+        self,
+        model: Model,
+        threshold: float | None = None,
+        max_batch_size: int = 256,
+        max_delay: float = 0.002,
+    ) -> None:
+        self.model = model
+        self.threshold = model.default_threshold if threshold is None else threshold
+        self.batcher = MicroBatcher(model, max_batch_size, max_delay)
+        self.latency = LatencyTracker()
+
+    def predict(
+        self, subject_ids: np.ndarray, features: np.ndarray, threshold: float | None
+    ) -> QCRatingsData:
+        if threshold is not None and not 1 > threshold > 0:
+            raise ValueError(
+                f"Threshold must be greater than zero and less than one, got {threshold}"
+            )
+        probabilities = self.batcher.predict_probabilities(features)
+        ratings = self.model.ratings_from_probabilities(
+            probabilities, self.threshold if threshold is None else threshold
+        )
+        return QCRatingsData(subject_ids, ratings, probabilities)
+
+    def metrics(self) -> dict[str, Any]:
+        batch_count = self.batcher.batch_count
+        return {
+            **self.latency.summary(),
+            "batches": batch_count,
+            "rows": self.batcher.row_count,
+            "mean_batch_size": (
+                self.batcher.row_count / batch_count if batch_count else 0
+            ),
+        }
+
+    def serve_tcp(self, host: str, port: int) -> ThreadingHTTPServer:
+        httpd = ThreadingHTTPServer((host, port), _RequestHandler)
+        httpd.prediction_server = self  # type: ignore[attr-defined]
+        return httpd
+
+    def serve_unix(self, socket_path: Path | str) -> _UnixHTTPServer:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        httpd = _UnixHTTPServer(str(socket_path), _RequestHandler)
+        httpd.prediction_server = self  # type: ignore[attr-defined]
+        return httpd
+
+    def close(self) -> None:
+        self.batcher.close()
+
+
+def parse_request_text(text: str) -> np.ndarray:
+    """return a feature row parsed from the contents of a civet_qc.txt file"""
+    features = np.full((1, len(CivetData.feature_names)), np.nan)
+    CivetData._parse_output_file(text, features[0], "<request body>")
+    missing = CivetData.feature_names[np.isnan(features[0])]
+    if missing.size != 0:
+        raise ValueError(f"Missing features: {', '.join(missing)}")
+    return features
+
+
+def parse_request_json(payload: Any) -> tuple[np.ndarray, np.ndarray]:
+    """return subject IDs and feature rows parsed from a JSON object or list of objects"""
+    records = payload if isinstance(payload, list) else [payload]
+    subject_ids = []
+    features = np.empty((len(records), len(CivetData.feature_names)))
+    for index, record in enumerate(records):
+        if not isinstance(record, dict):
+            raise ValueError(
+                f"Expected a JSON object per subject, got {type(record).__name__}"
+            )
+        subject_ids.append(str(record.get("subject_id", index)))
+        values = record["features"]
+        if isinstance(values, dict):
+            values = [values[name] for name in CivetData.feature_names]
+        if len(values) != len(CivetData.feature_names):
+            raise ValueError(
+                f"Expected {len(CivetData.feature_names)} features, got {len(values)}"
+            )
+        features[index] = values
+    return np.array(subject_ids), features
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    server_version = "civetqc"
+
+    def do_GET(self) -> None:
+        path = urlparse(self.path).path
+        if path == "/metrics":
+            self._send_json(200, self._prediction_server.metrics())
+        elif path == "/health":
+            self._send_json(200, {"status": "ok"})
+        else:
+            self._send_json(404, {"error": f"Not found: {path}"})
+
+    def do_POST(self) -> None:
+        start_time = time.perf_counter()
+        url = urlparse(self.path)
+        if url.path != "/predict":
+            self._send_json(404, {"error": f"Not found: {url.path}"})
+            return
+        query = parse_qs(url.query)
+        try:
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            threshold = float(query["threshold"][0]) if "threshold" in query else None
+            if self.headers.get_content_type() == "application/json":
+                subject_ids, features = parse_request_json(json.loads(body))
+            else:
+                subject_ids = np.array(query.get("id", ["subject"])[:1])
+                features = parse_request_text(body.decode())
+            qc_data = self._prediction_server.predict(subject_ids, features, threshold)
+        except (CivetQCError, KeyError, TypeError, ValueError) as err:
+            self._send_json(400, {"error": str(err)})
+            self._prediction_server.latency.record(
+                time.perf_counter() - start_time, error=True
+            )
+            return
+        self._send_json(200, qc_data.to_dict())
+        self._prediction_server.latency.record(time.perf_counter() - start_time)
+
+    def address_string(self) -> str:
+        # unix sockets have no client address
+        return str(self.client_address[0]) if self.client_address else "unix"
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    @property
+    def _prediction_server(self) -> PredictionServer:
+        return self.server.prediction_server  # type: ignore[attr-defined]
+
+    def _send_json(self, status: int, content: Any) -> None:
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self) -> tuple[Any, Any]:
+        request, _ = super().get_request()
+        return request, ""
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="civetqc serve")
+    parser.add_argument(
+        "--host",
+        type=str,
+        default="127.0.0.1",
+        metavar="",
+        help="address to listen on (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=8765,
+        metavar="",
+        help="port to listen on (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--socket",
+        type=Path,
+        default=None,
+        metavar="",
+        help="listen on this unix socket instead of a TCP port",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=Model.get_default_threshold(),
+        metavar="",
+        help="probability above which a failure will be predicted (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--max_batch_size",
+        type=int,
+        default=256,
+        metavar="",
+        help="maximum number of rows scored together (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--max_delay",
+        type=float,
+        default=2.0,
+        metavar="",
+        help="milliseconds to wait for more requests to join a batch (default: %(default)s)",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str] | None = None) -> None:
+    args = parse_args(argv)
+    if not 1 > args.threshold > 0:
+        raise ValueError(
+            f"Threshold must be greater than zero and less than one, got {args.threshold}"
+        )
+    server = PredictionServer(
+        Model.load(), args.threshold, args.max_batch_size, args.max_delay / 1000
+    )
+    if args.socket is not None:
+        httpd: socketserver.BaseServer = server.serve_unix(args.socket)
+        print(f"Serving on unix socket {args.socket}")
+    else:
+        httpd = server.serve_tcp(args.host, args.port)
+        print(f"Serving on http://{args.host}:{httpd.server_address[1]}")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        server.close()
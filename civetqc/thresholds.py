@@ -0,0 +1,253 @@
+from __future__ import annotations
+
+import argparse
+import json
+
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+
+from .cache import PredictionCache
+from .data import QCRatingsData
+from .model import Model
+
+
+def sweep_thresholds(
+    probabilities: np.ndarray, labels: np.ndarray | None = None, beta: float = 2.0
+) -> dict[str, np.ndarray]:
+    """return counts and metrics for every distinct probability of failure used as threshold
+
+    A subject is predicted to fail if its probability is greater than the threshold, as
+    in Model.ratings_from_probabilities. The probabilities are sorted once and counts for
+    all thresholds are read from cumulative sums, so the sweep takes O(n log n) time.
+    """
+    p_fail = probabilities[:, 1] if probabilities.ndim == 2 else probabilities
+    if p_fail.size == 0:
+        raise ValueError("Cannot sweep thresholds without any probabilities")
+    order = np.argsort(-p_fail, kind="stable")
+    descending = p_fail[order]
+    # the first position of each run of equal values is the number of greater values
+    starts = np.flatnonzero(np.r_[True, descending[1:] != descending[:-1]])
+    thresholds = descending[starts]
+    if descending[-1] > 0:
+        # a threshold of zero predicts that every subject fails
+        starts = np.r_[starts, len(descending)]
+        thresholds = np.r_[thresholds, 0.0]
+    table = {"threshold": thresholds, "fail_count": starts}
+    if labels is None:
+        return table
+
+    positives = np.r_[0, np.cumsum(np.asarray(labels)[order] == 1)]
+    n_positives = positives[-1]
+    n_negatives = len(p_fail) - n_positives
+    tp = positives[starts]
+    fp = starts - tp
+    table.update(
+        true_positives=tp,
+        false_positives=fp,
+        true_negatives=n_negatives - fp,
+        false_negatives=n_positives - tp,
+    )
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # no predicted failures is treated as perfect precision, as in train.py
+        precision = np.where(starts > 0, tp / starts, 1.0)
+        recall = tp / n_positives if n_positives else np.ones(len(starts))
+        beta2 = beta**2
+        fbeta = (1 + beta2) * precision * recall / (beta2 * precision + recall)
+    table.update(
+        precision=precision, recall=recall, fbeta=np.nan_to_num(fbeta, nan=0.0)
+    )
+    return table
+
+
+def calibration_bins(
+    probabilities: np.ndarray, labels: np.ndarray, n_bins: int = 10
+) -> dict[str, np.ndarray]:
+    """return the mean probability of failure and the observed failure rate in equal-width bins"""
+    p_fail = probabilities[:, 1] if probabilities.ndim == 2 else probabilities
+    bins = np.minimum((p_fail * n_bins).astype(int), n_bins - 1)
+    counts = np.bincount(bins, minlength=n_bins)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return {
+            "lower": np.arange(n_bins) / n_bins,
+            "upper": np.arange(1, n_bins + 1) / n_bins,
+            "count": counts,
+            "mean_probability": np.bincount(bins, p_fail, n_bins) / counts,
+            "failure_rate": np.bincount(bins, np.asarray(labels) == 1, n_bins) / counts,
+        }
+
+
+def summarize(
+    table: dict[str, np.ndarray], threshold: float
+) -> dict[str, dict[str, Any]]:
+    """return the row used at threshold and, with labels, the row with the best F-beta"""
+
+    def row(index: int) -> dict[str, Any]:
+        return {name: column[index].item() for name, column in table.items()}
+
+    # the row of the greatest value not above threshold has the same predictions
+    index = int(np.searchsorted(-table["threshold"], -threshold, "left"))
+    index = min(index, len(table["threshold"]) - 1)
+    summary = {"current": dict(row(index), threshold=threshold)}
+    if "fbeta" in table:
+        summary["best"] = row(int(np.argmax(table["fbeta"])))
+    return summary
+
+
+def best_threshold(
+    probabilities: np.ndarray, labels: np.ndarray, beta: float = 2.0
+) -> tuple[float, float]:
+    """return the threshold with the best F-beta score, and that score"""
+    table = sweep_thresholds(probabilities, labels, beta)
+    best = int(np.argmax(table["fbeta"]))
+    # a threshold of zero would fail every subject
+    threshold = float(np.clip(table["threshold"][best], 0.001, 0.999))
+    return threshold, float(table["fbeta"][best])
+
+
+def write_table(table: dict[str, np.ndarray], filepath: Path, beta: float) -> None:
+    names = [f"f{beta:g}" if name == "fbeta" else name for name in table]
+    np.savetxt(
+        filepath,
+        np.column_stack(list(table.values())),
+        fmt=["%.6g" if column.dtype.kind == "f" else "%d" for column in table.values()],
+        delimiter=",",
+        header=",".join(names),
+        comments="",
+    )
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="civetqc thresholds")
+    parser.add_argument(
+        "input_path",
+        type=Path,
+        help="path to file, directory or archive with CIVET QC outputs, or to saved features",
+    )
+    parser.add_argument(
+        "--labels",
+        type=Path,
+        default=None,
+        metavar="",
+        help="CSV file with a QC rating per subject, 0 to pass and 1 to fail, to compute precision and recall",
+    )
+    parser.add_argument(
+        "--idvar",
+        type=str,
+        default="ID",
+        metavar="",
+        help="column of subject IDs in the labels file (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--qcvar",
+        type=str,
+        default="QC",
+        metavar="",
+        help="column of ratings in the labels file (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--beta",
+        type=float,
+        default=2.0,
+        metavar="",
+        help="weight of recall in the F-beta score (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--output_dir",
+        type=Path,
+        default=Path.cwd(),
+        metavar="",
+        help="directory for results (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--output_format",
+        type=str,
+        default="csv",
+        choices=["csv", "json"],
+        metavar="",
+        help="format for output file: csv, json (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        metavar="",
+        help="number of threads used to read a directory of QC files (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help="reuse probabilities cached in the output directory for unchanged QC files",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str] | None = None) -> None:
+    from .main import load_civet_data
+
+    args = parse_args(argv)
+    if not args.input_path.exists():
+        raise FileNotFoundError(f"Input path does not exist: {args.input_path}")
+    elif not args.output_dir.is_dir():
+        raise NotADirectoryError(f"Output directory does not exist: {args.output_dir}")
+    elif args.cache and not args.input_path.is_dir():
+        raise ValueError("The cache can only be used with a directory of QC files")
+
+    model = Model.load()
+    if args.cache:
+        with PredictionCache(
+            args.output_dir.joinpath(PredictionCache.filename), Model.get_fingerprint()
+        ) as cache:
+            qc_data = cache.predict_output_files(
+                args.input_path, model, workers=args.workers
+            )
+        subject_ids, probabilities = qc_data.subject_ids, qc_data.probabilities
+    else:
+        civet_data = load_civet_data(args.input_path, args.workers)
+        subject_ids = civet_data.subject_ids
+        probabilities = model.predict_probabilities(civet_data.features)
+
+    labels = None
+    if args.labels is not None:
+        label_data = QCRatingsData.from_csv(args.labels, args.idvar, args.qcvar)
+        label_rows = label_data.index.get_indexer(subject_ids, missing_ok=True)
+        rows = np.flatnonzero(label_rows >= 0)
+        if rows.size == 0:
+            raise ValueError("No subjects have both features and a label")
+        probabilities = probabilities[rows]
+        labels = label_data.ratings[label_rows[rows]].astype(int)
+
+    table = sweep_thresholds(probabilities, labels, args.beta)
+    summary = summarize(table, model.default_threshold)
+    output_filepath = args.output_dir.joinpath(
+        f"civetqc_thresholds.{args.output_format}"
+    )
+    if args.output_format == "csv":
+        write_table(table, output_filepath, args.beta)
+    else:
+        report: dict[str, Any] = {
+            "n_subjects": len(probabilities),
+            "beta": args.beta,
+            "summary": summary,
+            "thresholds": {name: column.tolist() for name, column in table.items()},
+        }
+        if labels is not None:
+            report["calibration"] = {
+                name: np.nan_to_num(column, nan=0.0).tolist()
+                for name, column in calibration_bins(probabilities, labels).items()
+            }
+        with open(output_filepath, "w") as file:
+            json.dump(report, file, indent=2)
+
+    for name, row in summary.items():
+        print(
+            f"{name:<8} threshold {row['threshold']:.4f}: {row['fail_count']} of "
+            f"{len(probabilities)} subjects fail"
+            + (
+                f", precision {row['precision']:.3f}, recall {row['recall']:.3f},"
+                f" F{args.beta:g} {row['fbeta']:.3f}"
+                if "fbeta" in row
+                else ""
+            )
+        )
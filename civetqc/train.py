@@ -1,5 +1,14 @@
 from __future__ import annotations
 
+import argparse
+import hashlib
+import json
+import math
+import os
+
+from pathlib import Path
+from typing import Any
+
 import numpy as np
 
 from imblearn.pipeline import Pipeline
@@ -7,52 +16,471 @@ from imblearn.over_sampling import SMOTE
 
 from scipy.stats.distributions import uniform
 
+from sklearn.base import BaseEstimator, clone
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.feature_selection import SelectPercentile, f_regression
-from sklearn.metrics import balanced_accuracy_score, fbeta_score, make_scorer, precision_score, recall_score
-from sklearn.model_selection import RandomizedSearchCV
+from sklearn.metrics import (
+    balanced_accuracy_score,
+    fbeta_score,
+    make_scorer,
+    precision_score,
+    recall_score,
+)
+from sklearn.model_selection import (
+    GridSearchCV,
+    ParameterSampler,
+    RandomizedSearchCV,
+    StratifiedKFold,
+    cross_val_predict,
+    train_test_split,
+)
 from sklearn.preprocessing import StandardScaler
 from sklearn.svm import SVC
 
+from .data import QCRatingsData
+from .exceptions import CheckpointMismatchError
+from .model import Model
+from .registry import ModelRegistry
+from .thresholds import best_threshold
+
 balanced_accuracy_scorer = make_scorer(balanced_accuracy_score)
 f2_scorer = make_scorer(fbeta_score, beta=2)
 
-search = RandomizedSearchCV(
-    estimator=Pipeline(
+scoring = {
+    "balanced_accuracy": balanced_accuracy_scorer,
+    "f2": f2_scorer,
+    "precision_acceptable_scans": make_scorer(
+        precision_score, zero_division=1, pos_label=0
+    ),
+    "recall_acceptable_scans": make_scorer(recall_score, pos_label=0),
+    "precision_unacceptable_scans": make_scorer(
+        precision_score, zero_division=1, pos_label=1
+    ),
+    "recall_unacceptable_scans": make_scorer(recall_score, pos_label=1),
+}
+
+forest_distribution = {
+    "clf": (RandomForestClassifier(),),
+    "clf__max_features": uniform(0.01, 0.5),
+    "clf__min_samples_split": np.arange(2, 6),
+    "clf__min_samples_leaf": np.arange(1, 6),
+    "fs__percentile": [50, 60, 70, 80, 90, 100],
+}
+
+param_distributions = [
+    forest_distribution,
+    {
+        "clf": (SVC(),),
+        "clf__C": uniform(0.1, 10.0),
+        "clf__gamma": uniform(0.001, 0.5),
+        "clf__kernel": ["linear", "poly", "rbf"],
+        "fs__percentile": [50, 60, 70, 80, 90, 100],
+    },
+]
+
+
+def make_pipeline(
+    memory: str | None = None, random_state: int | None = None
+) -> Pipeline:
+    """return the unfitted pipeline, caching fitted transformers in memory if given"""
+    return Pipeline(
         [
             ("scaler", StandardScaler()),
             ("fs", SelectPercentile(score_func=f_regression)),
-            ("sampler", SMOTE()),
+            ("sampler", SMOTE(random_state=random_state)),
             ("clf", None),
+        ],
+        memory=memory,
+    )
+
+
+search = RandomizedSearchCV(
+    estimator=make_pipeline(),
+    param_distributions=param_distributions,
+    cv=5,
+    scoring=scoring,
+    n_iter=500,
+    n_jobs=-1,
+    refit="f2",
+)
+
+
+class CheckpointedSearch:
+    """random or successive-halving search that records every completed evaluation
+
+    Candidates are sampled deterministically from random_state, and the mean CV scores
+    of each candidate are appended to a file in checkpoint_dir as soon as its batch
+    completes, so that an interrupted search resumes without repeating them. With
+    method 'halving', candidates are first scored on a stratified subsample of the
+    subjects, and only the best 1/factor are scored on factor times as many subjects,
+    as in HalvingRandomSearchCV with n_samples as the resource. Progress is printed
+    only if verbose is positive.
+    """
+
+    results_filename = "results.jsonl"
+    settings_filename = "search.json"
+    min_class_samples = 6
+
+    def __init__(
+        self,
+        pipeline: BaseEstimator,
+        param_distributions: dict | list[dict],
+        checkpoint_dir: Path | str,
+        method: str = "halving",
+        n_iter: int = 500,
+        cv: int = 5,
+        factor: int = 3,
+        refit: str = "f2",
+        n_jobs: int | None = None,
+        batch_size: int = 16,
+        random_state: int = 0,
+        verbose: int = 0,
+    ) -> None:
+        if method not in ("random", "halving"):
+            raise ValueError(f"Unsupported search method: {method}")
+        self.pipeline = pipeline
+        self.param_distributions = param_distributions
+        self.checkpoint_dir = Path(checkpoint_dir)
+        self.method = method
+        self.n_iter = n_iter
+        self.cv = cv
+        self.factor = factor
+        self.refit = refit
+        self.n_jobs = n_jobs
+        self.batch_size = batch_size
+        self.random_state = random_state
+        self.verbose = verbose
+        self.evaluated_count = 0
+
+    def fit(self, X: np.ndarray, y: np.ndarray) -> CheckpointedSearch:
+        self.candidates_ = list(
+            ParameterSampler(
+                self.param_distributions, self.n_iter, random_state=self.random_state
+            )
+        )
+        results = self._load_checkpoint(X, y)
+        remaining = list(range(len(self.candidates_)))
+        schedule = self._schedule(y)
+        for iteration, n_resources in enumerate(schedule):
+            if self.verbose > 0:
+                print(
+                    f"iteration {iteration}: {len(remaining)} candidates on {n_resources} subjects"
+                )
+            scores = self._evaluate(iteration, n_resources, remaining, X, y, results)
+            remaining.sort(
+                key=lambda i: _score_key(scores[i][self.refit]), reverse=True
+            )
+            if iteration < len(schedule) - 1:
+                remaining = remaining[: max(1, math.ceil(len(remaining) / self.factor))]
+        self.best_index_ = remaining[0]
+        self.best_params_ = self.candidates_[self.best_index_]
+        self.best_scores_ = scores[self.best_index_]
+        self.best_estimator_ = (
+            clone(self.pipeline).set_params(memory=None, **self.best_params_).fit(X, y)
+        )
+        return self
+
+    def _schedule(self, y: np.ndarray) -> list[int]:
+        """return the number of subjects used to score candidates in each iteration"""
+        n_samples = len(y)
+        if self.method == "random":
+            return [n_samples]
+        # SMOTE needs k_neighbors + 1 subjects of each class in every training fold
+        min_class_fraction = np.unique(y, return_counts=True)[1].min() / n_samples
+        min_resources = min(
+            n_samples,
+            math.ceil(
+                (self.min_class_samples * self.cv / (self.cv - 1)) / min_class_fraction
+            ),
+        )
+        n_iterations = 1 + min(
+            int(math.log(len(self.candidates_), self.factor)),
+            int(math.log(n_samples / min_resources, self.factor)),
+        )
+        return [
+            n_samples // self.factor ** (n_iterations - 1 - iteration)
+            for iteration in range(n_iterations)
         ]
-    ),
-    param_distributions = [
-        {
-            "clf": (RandomForestClassifier(),),
-            "clf__max_features": uniform(0.01, 0.5),
-            "clf__min_samples_split": np.arange(2, 6),
-            "clf__min_samples_leaf": np.arange(1, 6),
-            "fs__percentile":  [50, 60, 70, 80, 90, 100]
-        },
-        {
-            "clf": (SVC(),),
-            "clf__C": uniform(0.1, 10.0),
-            "clf__gamma": uniform(0.001, 0.5),
-            "clf__kernel": ['linear', 'poly', 'rbf'],
-            "fs__percentile": [50, 60, 70, 80, 90, 100]
-        },
-        
-    ],
-    cv = 5,
-    scoring = {
-        "balanced_accuracy": balanced_accuracy_scorer,
-        "f2": f2_scorer,
-        "precision_acceptable_scans": make_scorer(precision_score, zero_division=1, pos_label=0),
-        "recall_acceptable_scans":  make_scorer(recall_score, pos_label=0),
-        "precision_unacceptable_scans": make_scorer(precision_score, zero_division=1, pos_label=1),
-        "recall_unacceptable_scans":  make_scorer(recall_score, pos_label=1),
-    },
-    n_iter = 500,
-    n_jobs = -1,
-    refit = "f2",
-)
\ No newline at end of file
+
+    def _evaluate(
+        self,
+        iteration: int,
+        n_resources: int,
+        candidates: list[int],
+        X: np.ndarray,
+        y: np.ndarray,
+        results: dict[tuple[int, int], dict[str, float]],
+    ) -> dict[int, dict[str, float]]:
+        """return the scores of candidates, evaluating those not found in the checkpoint"""
+        pending = [i for i in candidates if (iteration, i) not in results]
+        if pending and n_resources < len(y):
+            X, _, y, _ = train_test_split(
+                X,
+                y,
+                train_size=n_resources,
+                stratify=y,
+                random_state=self.random_state + iteration,
+            )
+        cv = StratifiedKFold(self.cv, shuffle=True, random_state=self.random_state)
+        for start in range(0, len(pending), self.batch_size):
+            batch = pending[start : start + self.batch_size]
+            grid = GridSearchCV(
+                self.pipeline,
+                [
+                    {name: [value] for name, value in self.candidates_[i].items()}
+                    for i in batch
+                ],
+                scoring=scoring,
+                cv=cv,
+                refit=False,
+                n_jobs=self.n_jobs,
+            ).fit(X, y)
+            with open(self.checkpoint_dir.joinpath(self.results_filename), "a") as file:
+                for index, candidate in enumerate(batch):
+                    scores = {
+                        name: float(grid.cv_results_[f"mean_test_{name}"][index])
+                        for name in scoring
+                    }
+                    results[iteration, candidate] = scores
+                    file.write(
+                        json.dumps(
+                            {
+                                "iteration": iteration,
+                                "candidate": candidate,
+                                "n_resources": n_resources,
+                                "params": describe_params(self.candidates_[candidate]),
+                                "scores": scores,
+                            }
+                        )
+                        + "\n"
+                    )
+                file.flush()
+                os.fsync(file.fileno())
+            self.evaluated_count += len(batch)
+        return {i: results[iteration, i] for i in candidates}
+
+    def _load_checkpoint(
+        self, X: np.ndarray, y: np.ndarray
+    ) -> dict[tuple[int, int], dict[str, float]]:
+        """return the scores recorded by a previous run with the same settings and data"""
+        digest = hashlib.sha256(np.ascontiguousarray(X).tobytes())
+        digest.update(np.ascontiguousarray(y).tobytes())
+        settings = {
+            "method": self.method,
+            "n_iter": self.n_iter,
+            "cv": self.cv,
+            "factor": self.factor,
+            "random_state": self.random_state,
+            "candidates": [describe_params(params) for params in self.candidates_],
+            "data": digest.hexdigest(),
+        }
+        self.checkpoint_dir.mkdir(parents=True, exist_ok=True)
+        settings_path = self.checkpoint_dir.joinpath(self.settings_filename)
+        if settings_path.exists():
+            with open(settings_path, "r") as file:
+                if json.load(file) != settings:
+                    raise CheckpointMismatchError(self.checkpoint_dir)
+        else:
+            with open(settings_path, "w") as file:
+                json.dump(settings, file)
+        results = {}
+        results_path = self.checkpoint_dir.joinpath(self.results_filename)
+        if results_path.exists():
+            with open(results_path, "r") as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # the last line is incomplete if the run was killed while writing
+                        continue
+                    results[entry["iteration"], entry["candidate"]] = entry["scores"]
+        return results
+
+
+def describe_params(params: dict[str, Any]) -> dict[str, Any]:
+    """return parameters as values that can be serialized to JSON"""
+    described = {}
+    for name, value in sorted(params.items()):
+        if isinstance(value, BaseEstimator):
+            value = type(value).__name__
+        elif isinstance(value, np.generic):
+            value = value.item()
+        described[name] = value
+    return described
+
+
+def _score_key(score: float) -> float:
+    return -math.inf if math.isnan(score) else score
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="civetqc train")
+    parser.add_argument(
+        "input_path",
+        type=Path,
+        help="path to file, directory or archive with CIVET QC outputs, or to saved features",
+    )
+    parser.add_argument(
+        "ratings_path", type=Path, help="path to CSV file with a QC rating per subject"
+    )
+    parser.add_argument(
+        "--idvar",
+        type=str,
+        default="ID",
+        metavar="",
+        help="column of subject IDs in the ratings file (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--qcvar",
+        type=str,
+        default="QC",
+        metavar="",
+        help="column of ratings, 0 to pass and 1 to fail, in the ratings file (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--output_dir",
+        type=Path,
+        default=Path.cwd(),
+        metavar="",
+        help="directory in which the model is saved as civetqc_model (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--search",
+        type=str,
+        default="halving",
+        choices=["halving", "random"],
+        metavar="",
+        help="search method: halving, random (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--n_iter",
+        type=int,
+        default=500,
+        metavar="",
+        help="number of sampled candidates (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--cv",
+        type=int,
+        default=5,
+        metavar="",
+        help="number of cross-validation folds (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--factor",
+        type=int,
+        default=3,
+        metavar="",
+        help="proportion of candidates kept in each halving iteration (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--n_jobs",
+        type=int,
+        default=-1,
+        metavar="",
+        help="number of jobs used to fit candidates in parallel (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        metavar="",
+        help="seed used to sample candidates, folds and subsamples (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=None,
+        metavar="",
+        help="default threshold saved with the model (default: the threshold with the best F2 on cross-validated probabilities of the best candidate)",
+    )
+    parser.add_argument(
+        "--checkpoint_dir",
+        type=Path,
+        default=None,
+        metavar="",
+        help="directory for completed results and cached transformers, reused to resume (default: OUTPUT_DIR/civetqc_train)",
+    )
+    parser.add_argument(
+        "--register",
+        type=str,
+        default=None,
+        metavar="",
+        help="also save the model as the next version of this name in the model registry, for use with 'civetqc --model'",
+    )
+    parser.add_argument(
+        "--model_dir",
+        type=Path,
+        default=None,
+        metavar="",
+        help="registry of named models (default: $CIVETQC_MODELS or ~/.civetqc/models)",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str] | None = None) -> None:
+    from .main import load_civet_data
+
+    args = parse_args(argv)
+    if not args.output_dir.is_dir():
+        raise NotADirectoryError(f"Output directory does not exist: {args.output_dir}")
+    if args.threshold is not None and not 1 > args.threshold > 0:
+        raise ValueError(
+            f"Threshold must be greater than zero and less than one, got {args.threshold}"
+        )
+    checkpoint_dir = args.checkpoint_dir or args.output_dir.joinpath("civetqc_train")
+
+    civet_data, qc_data = load_civet_data(args.input_path).join(
+        QCRatingsData.from_csv(args.ratings_path, args.idvar, args.qcvar)
+    )
+    if not len(civet_data):
+        raise ValueError("No subjects have both features and a rating")
+    features = civet_data.features
+    ratings = qc_data.ratings.astype(int)
+
+    # the model artifact holds a compiled forest, so only forests are searched
+    distribution = dict(
+        forest_distribution, clf=(RandomForestClassifier(random_state=args.seed),)
+    )
+    trainer = CheckpointedSearch(
+        make_pipeline(str(checkpoint_dir.joinpath("transformers")), args.seed),
+        distribution,
+        checkpoint_dir,
+        method=args.search,
+        n_iter=args.n_iter,
+        cv=args.cv,
+        factor=args.factor,
+        n_jobs=args.n_jobs,
+        random_state=args.seed,
+        verbose=1,
+    ).fit(features, ratings)
+
+    training = {
+        "n_subjects": len(civet_data),
+        "params": describe_params(trainer.best_params_),
+        "cv_scores": trainer.best_scores_,
+    }
+    threshold = args.threshold
+    if threshold is None:
+        probabilities = cross_val_predict(
+            clone(trainer.best_estimator_),
+            features,
+            ratings,
+            cv=StratifiedKFold(args.cv, shuffle=True, random_state=args.seed),
+            method="predict_proba",
+            n_jobs=args.n_jobs,
+        )
+        threshold, f2 = best_threshold(probabilities, ratings)
+        training["threshold_cv_f2"] = f2
+        print(f"threshold {threshold:.3f} with cross-validated f2 {f2:.3f}")
+
+    model_path = args.output_dir.joinpath("civetqc_model")
+    model = Model(trainer.best_estimator_, threshold, metadata={"training": training})
+    model.save(model_path)
+    print(
+        f"best f2 {trainer.best_scores_['f2']:.3f} with {describe_params(trainer.best_params_)}"
+    )
+    print(f"model saved to {model_path}")
+    if args.register is not None:
+        registered_path = ModelRegistry(args.model_dir).register(args.register, model)
+        print(f"model registered as {args.register}@{registered_path.name}")
@@ -0,0 +1,320 @@
+from __future__ import annotations
+
+import argparse
+
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+
+from .data import QCRatingsData
+from .model import Model
+from .registry import ModelRegistry
+from .thresholds import best_threshold
+from .utils import load_npz
+
+
+class OutOfBagCache:
+    """rated subjects kept with a model, with the summed probability of failure from the
+    trees that were not fitted on them
+
+    Each update adds the probabilities of its new trees to the sums of the subjects
+    already kept, so the probabilities of every rated subject stay out-of-sample and
+    the threshold can be tuned on all of them without scoring them again.
+    """
+
+    filename = "oob.npz"
+
+    def __init__(
+        self,
+        subject_ids: np.ndarray,
+        features: np.ndarray,
+        ratings: np.ndarray,
+        p_fail_sum: np.ndarray,
+        n_trees: np.ndarray,
+    ) -> None:
+        self.subject_ids = subject_ids
+        self.features = features
+        self.ratings = ratings
+        self.p_fail_sum = p_fail_sum
+        self.n_trees = n_trees
+
+    def __len__(self) -> int:
+        return len(self.subject_ids)
+
+    @property
+    def probabilities(self) -> np.ndarray:
+        """the out-of-bag probability of failure of each subject"""
+        return self.p_fail_sum / self.n_trees
+
+    @classmethod
+    def load(cls, model_path: Path | str) -> OutOfBagCache | None:
+        """return the cache saved with the model at model_path, or None if there is none"""
+        filepath = Path(model_path, cls.filename)
+        if not filepath.is_file():
+            return None
+        arrays = load_npz(filepath, mmap=False)
+        return cls(
+            arrays["subject_ids"],
+            arrays["features"],
+            arrays["ratings"],
+            arrays["p_fail_sum"],
+            arrays["n_trees"],
+        )
+
+    def save(self, model_path: Path | str) -> None:
+        np.savez(
+            Path(model_path, self.filename),
+            subject_ids=self.subject_ids,
+            features=self.features,
+            ratings=self.ratings,
+            p_fail_sum=self.p_fail_sum,
+            n_trees=self.n_trees,
+        )
+
+    def _take(self, rows: np.ndarray) -> OutOfBagCache:
+        return OutOfBagCache(
+            self.subject_ids[rows],
+            self.features[rows],
+            self.ratings[rows],
+            self.p_fail_sum[rows],
+            self.n_trees[rows],
+        )
+
+    @classmethod
+    def _concat(cls, caches: list[OutOfBagCache]) -> OutOfBagCache:
+        return cls(
+            *[
+                np.concatenate([getattr(cache, name) for cache in caches])
+                for name in ("subject_ids", "features", "ratings", "p_fail_sum")
+            ],
+            np.concatenate([cache.n_trees for cache in caches]),
+        )
+
+
+def get_tree_params(model: Model) -> dict[str, Any]:
+    """return the parameters of the trees of a model, from its training metadata if saved"""
+    params: dict[str, Any] = {
+        "max_features": "sqrt",
+        "min_samples_split": 2,
+        "min_samples_leaf": 1,
+    }
+    trained = model.metadata.get("training", {}).get("params", {})
+    for name in params:
+        if f"clf__{name}" in trained:
+            params[name] = trained[f"clf__{name}"]
+    # new trees are no deeper than the existing ones
+    params["max_depth"] = int(model.compile().forest.depths.max())
+    # in place of the oversampling of the training pipeline
+    params["class_weight"] = "balanced"
+    return params
+
+
+def update_model(
+    model: Model,
+    subject_ids: np.ndarray,
+    features: np.ndarray,
+    ratings: np.ndarray,
+    cache: OutOfBagCache | None = None,
+    n_trees: int = 50,
+    beta: float = 2.0,
+    seed: int = 0,
+) -> tuple[Model, OutOfBagCache, dict[str, Any]]:
+    """return the model with trees fitted on newly rated subjects added, and its threshold
+    tuned for the best F-beta on the out-of-bag probabilities of every rated subject
+
+    The preprocessing steps of the model are kept, so the new trees are fitted on
+    features as the existing trees see them. Each new tree is fitted on a bootstrap
+    sample, and the subjects left out of it add its probabilities to their sums, as do
+    the subjects in cache, which no new tree is fitted on. Subjects in cache that are
+    rated again are replaced by their new rating.
+    """
+    from sklearn.tree import DecisionTreeClassifier
+
+    forest = model.compile().forest
+    ratings = np.asarray(ratings).astype(int)
+    if not np.array_equal(np.unique(ratings), forest.classes):
+        raise ValueError(
+            f"New ratings must include every class of the model: {forest.classes.tolist()}"
+        )
+    params = get_tree_params(model)
+    rng = np.random.default_rng(seed)
+    transformed = forest.transform(features)
+    n_subjects = len(ratings)
+
+    # the existing trees were not fitted on the new subjects
+    added = OutOfBagCache(
+        np.asarray(subject_ids),
+        np.asarray(features, dtype=np.float64),
+        ratings,
+        forest.predict_probabilities(features)[:, 1] * forest.n_trees,
+        np.full(n_subjects, forest.n_trees),
+    )
+    kept = None
+    if cache is not None:
+        kept = cache._take(np.flatnonzero(~np.isin(cache.subject_ids, subject_ids)))
+        kept_transformed = forest.transform(kept.features)
+
+    trees = []
+    for _ in range(n_trees):
+        in_bag = np.bincount(
+            rng.integers(0, n_subjects, n_subjects), minlength=n_subjects
+        )
+        tree = DecisionTreeClassifier(
+            **params, random_state=int(rng.integers(np.iinfo(np.int32).max))
+        ).fit(transformed, ratings, sample_weight=in_bag)
+        trees.append(tree)
+        out_of_bag = np.flatnonzero(in_bag == 0)
+        if out_of_bag.size:
+            added.p_fail_sum[out_of_bag] += tree.predict_proba(transformed[out_of_bag])[
+                :, 1
+            ]
+            added.n_trees[out_of_bag] += 1
+        if kept is not None and len(kept):
+            kept.p_fail_sum += tree.predict_proba(kept_transformed)[:, 1]
+            kept.n_trees += 1
+
+    updated_cache = added if kept is None else OutOfBagCache._concat([kept, added])
+    threshold, fbeta = best_threshold(
+        updated_cache.probabilities, updated_cache.ratings, beta
+    )
+    summary = {
+        "n_subjects": n_subjects,
+        "n_trees_added": n_trees,
+        "n_out_of_bag": len(updated_cache),
+        "threshold": threshold,
+        f"f{beta:g}": fbeta,
+        "params": params,
+    }
+    metadata = dict(model.metadata)
+    metadata["updates"] = [*metadata.get("updates", []), summary]
+    updated = Model(None, threshold, forest=forest.add_trees(trees), metadata=metadata)
+    return updated, updated_cache, summary
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="civetqc update")
+    parser.add_argument(
+        "input_path",
+        type=Path,
+        help="path to file, directory or archive with CIVET QC outputs, or to saved features",
+    )
+    parser.add_argument(
+        "ratings_path",
+        type=Path,
+        help="path to CSV file with a QC rating per newly rated subject",
+    )
+    parser.add_argument(
+        "--idvar",
+        type=str,
+        default="ID",
+        metavar="",
+        help="column of subject IDs in the ratings file (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--qcvar",
+        type=str,
+        default="QC",
+        metavar="",
+        help="column of ratings, 0 to pass and 1 to fail, in the ratings file (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--model",
+        type=str,
+        default=ModelRegistry.bundled_name,
+        metavar="",
+        help="model to update as NAME or NAME@VERSION (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--model_dir",
+        type=Path,
+        default=None,
+        metavar="",
+        help="registry of named models (default: $CIVETQC_MODELS or ~/.civetqc/models)",
+    )
+    parser.add_argument(
+        "--n_trees",
+        type=int,
+        default=50,
+        metavar="",
+        help="number of trees fitted on the new ratings and added to the model (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--beta",
+        type=float,
+        default=2.0,
+        metavar="",
+        help="weight of recall in the F-beta score maximized by the new threshold (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        metavar="",
+        help="seed used to sample the subjects of each tree (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--output_dir",
+        type=Path,
+        default=Path.cwd(),
+        metavar="",
+        help="directory in which the model is saved as civetqc_model (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--register",
+        type=str,
+        default=None,
+        metavar="",
+        help="also save the model as the next version of this name in the model registry",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        metavar="",
+        help="number of threads used to read a directory of QC files (default: %(default)s)",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str] | None = None) -> None:
+    from .main import load_civet_data
+
+    args = parse_args(argv)
+    if not args.output_dir.is_dir():
+        raise NotADirectoryError(f"Output directory does not exist: {args.output_dir}")
+    if args.n_trees < 1:
+        raise ValueError(f"Number of trees must be at least one, got {args.n_trees}")
+
+    registry = ModelRegistry(args.model_dir)
+    model_path = registry.resolve(args.model)
+    model = Model.load(model_path)
+    civet_data, qc_data = load_civet_data(args.input_path, args.workers).join(
+        QCRatingsData.from_csv(args.ratings_path, args.idvar, args.qcvar)
+    )
+    if not len(civet_data):
+        raise ValueError("No subjects have both features and a rating")
+
+    updated, cache, summary = update_model(
+        model,
+        civet_data.subject_ids,
+        civet_data.features,
+        qc_data.ratings,
+        OutOfBagCache.load(model_path),
+        args.n_trees,
+        args.beta,
+        args.seed,
+    )
+    output_path = args.output_dir.joinpath("civetqc_model")
+    updated.save(output_path)
+    cache.save(output_path)
+    print(
+        f"added {args.n_trees} trees to {model.forest.n_trees} from {len(civet_data)}"
+        f" rated subjects, threshold {model.default_threshold:.3f} -> {updated.default_threshold:.3f}"
+        f" (F{args.beta:g} {summary[f'f{args.beta:g}']:.3f} on {len(cache)} out-of-bag subjects)"
+    )
+    print(f"model saved to {output_path}")
+    if args.register is not None:
+        registered_path = registry.register(args.register, updated)
+        cache.save(registered_path)
+        print(f"model registered as {args.register}@{registered_path.name}")
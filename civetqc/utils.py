@@ -1,22 +1,20 @@
 from __future__ import annotations
 
-import time
+import functools
+import importlib
+import posixpath
+import struct
+import tarfile
+import zipfile
+import zlib
 
 import numpy as np
 
-from typing import Any, Callable
+from pathlib import Path
+from types import ModuleType
+from typing import Any, Callable, Iterator
 
-
-def use_timer(func: Callable) -> Callable:
-    """used as a decorator to time function execution"""
-
-    def wrapper(*args: Any, **kwargs: Any) -> Any:
-        start_time = time.perf_counter()
-        return_value = func(*args, **kwargs)
-        print(f"Completed in {time.perf_counter() - start_time:.3f}s")
-        return return_value
-
-    return wrapper
+ARCHIVE_SUFFIXES = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz", ".zip")
 
 
 def get_non_unique(arr: np.ndarray) -> np.ndarray:
@@ -59,3 +57,121 @@ def joint_sort(
             )
     indices = np.argsort(a)
     return np.take(a, indices), *[np.take(arr, indices, axis) for arr in args]
+
+
+def is_sorted(arr: np.ndarray) -> bool:
+    """return True if a one-dimensional array is in ascending order"""
+    return arr.size < 2 or bool(np.all(arr[:-1] <= arr[1:]))
+
+
+def get_shard(subject_id: str, n_shards: int) -> int:
+    """return the shard of a subject ID, which is stable across processes and machines"""
+    return zlib.crc32(subject_id.encode()) % n_shards
+
+
+def shard_mask(subject_ids: np.ndarray, shard: tuple[int, int]) -> np.ndarray:
+    """return a boolean array selecting the subject IDs in shard, given as (index, count)"""
+    index, n_shards = shard
+    shards = np.fromiter(
+        (zlib.crc32(str(s).encode()) for s in subject_ids),
+        dtype=np.int64,
+        count=len(subject_ids),
+    )
+    return shards % n_shards == index
+
+
+def import_optional(name: str, extra: str) -> ModuleType:
+    """import an optional dependency, raising ImportError naming the extra that provides it"""
+    try:
+        return importlib.import_module(name)
+    except ImportError as err:
+        raise ImportError(
+            f"Optional dependency '{name}' is required, install it with: pip install civetqc[{extra}]"
+        ) from err
+
+
+def load_npz(filepath: Path | str, mmap: bool = True) -> dict[str, np.ndarray]:
+    """load the arrays of an .npz file, memory-mapping those stored without compression"""
+    arrays = {}
+    with open(filepath, "rb") as file, zipfile.ZipFile(file) as archive:
+        for info in archive.infolist():
+            name = info.filename.removesuffix(".npy")
+            if mmap and info.compress_type == zipfile.ZIP_STORED:
+                arr = _memmap_npz_member(filepath, file, info)
+                if arr is not None:
+                    arrays[name] = arr
+                    continue
+            with archive.open(info) as member:
+                arrays[name] = np.lib.format.read_array(member)
+    return arrays
+
+
+def _memmap_npz_member(
+    filepath: Path | str, file: Any, info: zipfile.ZipInfo
+) -> np.ndarray | None:
+    """return a memory-mapped view of an uncompressed .npy member, if it can be mapped"""
+    # the data follows the local header, whose extra field may differ in length
+    # from the one recorded in the central directory
+    file.seek(info.header_offset + 26)
+    name_length, extra_length = struct.unpack("<HH", file.read(4))
+    file.seek(name_length + extra_length, 1)
+    read_header = {
+        (1, 0): np.lib.format.read_array_header_1_0,
+        (2, 0): np.lib.format.read_array_header_2_0,
+    }.get(np.lib.format.read_magic(file))
+    if read_header is None:
+        return None
+    shape, fortran_order, dtype = read_header(file)
+    if dtype.hasobject or 0 in shape:
+        return None
+    return np.asarray(
+        np.memmap(
+            filepath,
+            dtype=dtype,
+            mode="r",
+            shape=shape,
+            order="F" if fortran_order else "C",
+            offset=file.tell(),
+        )
+    )
+
+
+def is_archive(path: Path | str) -> bool:
+    """return True if path names a tar or zip archive"""
+    return Path(path).name.lower().endswith(ARCHIVE_SUFFIXES)
+
+
+def iter_archive_members(
+    filepath: Path | str,
+) -> Iterator[tuple[str, Callable[[], bytes]]]:
+    """yield the base name of each file in a tar or zip archive and a function reading it
+
+    Members are yielded in the order they are stored, so the archive is read once from
+    start to end and members that are not read are skipped without being decompressed.
+    Each function must be called before the next member is yielded.
+    """
+    if zipfile.is_zipfile(filepath):
+        with zipfile.ZipFile(filepath) as archive:
+            infos = sorted(archive.infolist(), key=lambda info: info.header_offset)
+            for info in infos:
+                if not info.is_dir():
+                    yield posixpath.basename(info.filename), functools.partial(
+                        archive.read, info
+                    )
+        return
+    # a stream of members, which tarfile decompresses as it goes
+    with tarfile.open(filepath, mode="r|*") as archive:
+        for member in archive:
+            if member.isfile():
+                yield posixpath.basename(member.name), _tar_reader(archive, member)
+
+
+def _tar_reader(
+    archive: tarfile.TarFile, member: tarfile.TarInfo
+) -> Callable[[], bytes]:
+    def read() -> bytes:
+        file = archive.extractfile(member)
+        assert file is not None
+        return file.read()
+
+    return read
@@ -0,0 +1,388 @@
+from __future__ import annotations
+
+import argparse
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+
+from pathlib import Path
+from typing import Iterator
+
+import numpy as np
+
+from . import profiling
+from .data import CivetData
+from .exceptions import CivetQCError
+from .merge import PARTIAL_FORMATS
+from .model import Model
+from .registry import ModelRegistry
+from .writers import RatingsWriter
+
+# signature of a file used to decide whether it is still being written
+Signature = tuple[int, int]
+
+
+class PollingWatcher:
+    """reports files in a directory that are new or changed since the previous poll
+
+    Each poll lists the directory once, so it is used only where inotify is unavailable.
+    """
+
+    def __init__(self, dir_path: Path, interval: float = 1.0) -> None:
+        self.dir_path = dir_path
+        self.interval = interval
+        self._signatures: dict[str, Signature] = {}
+        self._next_poll = 0.0
+        # files already present are scheduled by OutputFileScorer.add_existing
+        self.read_events(0)
+
+    def read_events(self, timeout: float | None) -> list[tuple[str, bool]]:
+        """return the names of changed files, and whether each is known to be closed"""
+        delay = self._next_poll - time.monotonic()
+        if delay > 0:
+            if timeout is not None and timeout < delay:
+                time.sleep(timeout)
+                return []
+            time.sleep(delay)
+        self._next_poll = time.monotonic() + self.interval
+        changed = []
+        signatures = {}
+        with os.scandir(self.dir_path) as entries:
+            for entry in entries:
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                signatures[entry.name] = (stat.st_mtime_ns, stat.st_size)
+                if self._signatures.get(entry.name) != signatures[entry.name]:
+                    changed.append((entry.name, False))
+        self._signatures = signatures
+        return changed
+
+    def close(self) -> None:
+        pass
+
+
+class InotifyWatcher:
+    """reports files in a directory as the kernel signals that they were written or moved in"""
+
+    IN_MODIFY = 0x2
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_Q_OVERFLOW = 0x4000
+
+    _event_header = struct.Struct("iIII")
+
+    def __init__(self, dir_path: Path) -> None:
+        self.dir_path = dir_path
+        self._libc = _load_libc()
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        if self._libc.inotify_add_watch(self._fd, os.fsencode(dir_path), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(errno, f"inotify_add_watch failed: {dir_path}")
+        self._overflowed = False
+
+    def read_events(self, timeout: float | None) -> list[tuple[str, bool]]:
+        """return the names of changed files, and whether each is known to be closed"""
+        if self._overflowed:
+            # events were dropped by the kernel, so every file is reported once
+            self._overflowed = False
+            with os.scandir(self.dir_path) as entries:
+                return [(entry.name, False) for entry in entries]
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            buffer = os.read(self._fd, 65536)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(buffer):
+            _, mask, _, length = self._event_header.unpack_from(buffer, offset)
+            offset += self._event_header.size
+            name = buffer[offset : offset + length].rstrip(b"\0")
+            offset += length
+            if mask & self.IN_Q_OVERFLOW:
+                self._overflowed = True
+            elif name:
+                closed = bool(mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO))
+                events.append((os.fsdecode(name), closed))
+        return events
+
+    def close(self) -> None:
+        os.close(self._fd)
+
+
+def _load_libc() -> ctypes.CDLL:
+    if not sys.platform.startswith("linux"):
+        raise OSError("inotify is only available on linux")
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    if not hasattr(libc, "inotify_init1"):
+        raise OSError("inotify is not available in the C library")
+    return libc
+
+
+class OutputFileScorer:
+    """scores CIVET QC files as they are finished and appends the ratings to an output file
+
+    A file is scored once its size and modification time have not changed for settle
+    seconds, or as soon as it is closed after writing when inotify is used. Files that
+    are found to be incomplete are scored again when they next change. Files that become
+    ready together are scored as one batch of at most batch_size rows.
+    """
+
+    def __init__(
+        self,
+        dir_path: Path | str,
+        model: Model,
+        writer: RatingsWriter,
+        prefix: str = "",
+        threshold: float | None = None,
+        settle: float = 2.0,
+        batch_size: int = 256,
+        poll_interval: float | None = None,
+    ) -> None:
+        self.dir_path = Path(dir_path)
+        self.model = model
+        self.writer = writer
+        self.prefix = prefix
+        self.threshold = threshold
+        self.settle = settle
+        self.batch_size = batch_size
+        self.watcher: InotifyWatcher | PollingWatcher
+        if poll_interval is None:
+            try:
+                self.watcher = InotifyWatcher(self.dir_path)
+            except OSError:
+                self.watcher = PollingWatcher(self.dir_path)
+        else:
+            self.watcher = PollingWatcher(self.dir_path, poll_interval)
+        self._pending: dict[str, tuple[float, Signature | None]] = {}
+
+    def add_existing(self, modified_after: float = 0.0) -> int:
+        """schedule the QC files in the directory modified after a time in seconds since the epoch"""
+        count = 0
+        for _, entry in CivetData._scan_output_files(self.dir_path, self.prefix):
+            if entry.stat().st_mtime > modified_after:
+                self._pending[entry.name] = (time.monotonic(), None)
+                count += 1
+        return count
+
+    def step(self, timeout: float | None = None) -> int:
+        """wait at most timeout seconds for changes, then score the files that are ready"""
+        if self._pending:
+            next_due = min(due for due, _ in self._pending.values())
+            wait = max(0.0, next_due - time.monotonic())
+            timeout = wait if timeout is None else min(timeout, wait)
+        for name, closed in self.watcher.read_events(timeout):
+            if CivetData.get_subject_id(name, self.prefix) is None:
+                continue
+            signature = self._get_signature(name)
+            if signature is not None:
+                delay = 0.0 if closed else self.settle
+                self._pending[name] = (time.monotonic() + delay, signature)
+        return self._score(list(self._ready()))
+
+    def close(self) -> None:
+        self.watcher.close()
+
+    def _ready(self) -> Iterator[str]:
+        now = time.monotonic()
+        for name, (due, signature) in list(self._pending.items()):
+            if due > now:
+                continue
+            current = self._get_signature(name)
+            if current is None:
+                del self._pending[name]
+            elif signature is not None and current != signature:
+                # still being written, so wait until it has settled
+                self._pending[name] = (now + self.settle, current)
+            else:
+                del self._pending[name]
+                yield name
+
+    def _get_signature(self, name: str) -> Signature | None:
+        try:
+            stat = self.dir_path.joinpath(name).stat()
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _score(self, names: list[str]) -> int:
+        from .main import predict_ratings
+
+        count = 0
+        for start in range(0, len(names), self.batch_size):
+            subject_ids, features = self._read(names[start : start + self.batch_size])
+            if not subject_ids:
+                continue
+            civet_data = CivetData(np.array(subject_ids), features, sort=False)
+            self.writer.write(
+                predict_ratings(self.model, civet_data, self.threshold, sort=False)
+            )
+            self.writer.flush()
+            count += len(subject_ids)
+        return count
+
+    def _read(self, names: list[str]) -> tuple[list[str], np.ndarray]:
+        subject_ids = []
+        features = np.full((len(names), len(CivetData.feature_names)), np.nan)
+        with profiling.span("read_output_files"):
+            for name in names:
+                filepath = self.dir_path.joinpath(name)
+                row = features[len(subject_ids)]
+                try:
+                    with open(filepath, "r") as file:
+                        CivetData._parse_output_file(file.read(), row, filepath)
+                except (OSError, ValueError, CivetQCError) as err:
+                    print(
+                        f"skipped {filepath} until it changes: {err}", file=sys.stderr
+                    )
+                    row[:] = np.nan
+                    continue
+                if np.isnan(row).any():
+                    print(
+                        f"skipped incomplete {filepath} until it changes",
+                        file=sys.stderr,
+                    )
+                    row[:] = np.nan
+                    continue
+                subject_ids.append(CivetData.get_subject_id(name, self.prefix))
+            profiling.count("files_read", len(names))
+        return subject_ids, features[: len(subject_ids)]
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="civetqc watch")
+    parser.add_argument(
+        "input_path",
+        type=Path,
+        help="directory to which CIVET writes QC files",
+    )
+    parser.add_argument(
+        "--prefix",
+        type=str,
+        default="",
+        metavar="",
+        help="prefix of QC file names, removed to get the subject ID",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=None,
+        metavar="",
+        help="probability above which a failure will be predicted (default: the threshold saved with the model)",
+    )
+    parser.add_argument(
+        "--model",
+        type=str,
+        default=ModelRegistry.bundled_name,
+        metavar="",
+        help="model as NAME or NAME@VERSION (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--model_dir",
+        type=Path,
+        default=None,
+        metavar="",
+        help="registry of named models (default: $CIVETQC_MODELS or ~/.civetqc/models)",
+    )
+    parser.add_argument(
+        "--output_dir",
+        type=Path,
+        default=Path.cwd(),
+        metavar="",
+        help="directory for results, appended to civetqc_watch.OUTPUT_FORMAT (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--output_format",
+        type=str,
+        default="ndjson",
+        choices=list(PARTIAL_FORMATS),
+        metavar="",
+        help=f"format for output file: {', '.join(PARTIAL_FORMATS)} (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--settle",
+        type=float,
+        default=2.0,
+        metavar="",
+        help="seconds a file must be unchanged before it is scored, unless closed after writing (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=256,
+        metavar="",
+        help="maximum number of files scored together (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--poll_interval",
+        type=float,
+        default=None,
+        metavar="",
+        help="list the directory every this many seconds instead of using inotify",
+    )
+    parser.add_argument(
+        "--rescore",
+        action="store_true",
+        help="score every QC file already in the directory, not only those changed since the output file was written",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str] | None = None) -> None:
+    args = parse_args(argv)
+    if not args.input_path.is_dir():
+        raise NotADirectoryError(f"Input directory does not exist: {args.input_path}")
+    elif not args.output_dir.is_dir():
+        raise NotADirectoryError(f"Output directory does not exist: {args.output_dir}")
+    if args.threshold is not None and not 1 > args.threshold > 0:
+        raise ValueError(
+            f"Threshold must be greater than zero and less than one, got {args.threshold}"
+        )
+    if args.batch_size < 1:
+        raise ValueError(f"Batch size must be at least one, got {args.batch_size}")
+
+    model = ModelRegistry(args.model_dir).load(args.model)
+    output_filepath = args.output_dir.joinpath(f"civetqc_watch.{args.output_format}")
+    # files not changed since the output file was last written have been scored
+    modified_after = 0.0
+    if output_filepath.exists() and not args.rescore:
+        modified_after = output_filepath.stat().st_mtime
+
+    with RatingsWriter.open(output_filepath, args.output_format, append=True) as writer:
+        scorer = OutputFileScorer(
+            args.input_path,
+            model,
+            writer,
+            args.prefix,
+            args.threshold,
+            args.settle,
+            args.batch_size,
+            args.poll_interval,
+        )
+        print(
+            f"Watching {args.input_path} with {type(scorer.watcher).__name__},"
+            f" writing to {output_filepath}"
+        )
+        try:
+            scorer.add_existing(modified_after)
+            while True:
+                count = scorer.step()
+                if count:
+                    print(f"scored {count} subjects")
+        except KeyboardInterrupt:
+            pass
+        finally:
+            scorer.close()
@@ -0,0 +1,368 @@
+from __future__ import annotations
+
+import csv
+import json
+
+from pathlib import Path
+from types import TracebackType
+from typing import Any
+
+import numpy as np
+
+from . import profiling
+from .data import CivetData, QCRatingsData
+from .utils import import_optional
+
+
+class RatingsWriter:
+    """writes QC ratings to a file incrementally, so results can be written chunk by chunk"""
+
+    mode = "w"
+    newline: str | None = None
+    appendable = False
+    # compact instances are expanded this many rows at a time
+    chunk_size = 65536
+
+    def __init__(self, filepath: Path | str, append: bool = False) -> None:
+        if append and not self.appendable:
+            raise ValueError(f"Cannot append to output file: {filepath}")
+        self.filepath = Path(filepath)
+        self.count = 0
+        self.file = open(filepath, "a" if append else self.mode, newline=self.newline)
+        self._begin()
+
+    def __enter__(self) -> RatingsWriter:
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        self.close()
+
+    @staticmethod
+    def open(
+        filepath: Path | str, output_format: str, append: bool = False
+    ) -> RatingsWriter:
+        """return a writer for the given output format, adding to the end of filepath if append is True"""
+        try:
+            writer_class = RATINGS_WRITERS[output_format]
+        except KeyError as err:
+            raise ValueError(f"Unsupported output format: {output_format}") from err
+        return writer_class(filepath, append)
+
+    def write(self, qc_data: QCRatingsData) -> None:
+        with profiling.span("write_output"):
+            for chunk in qc_data.chunks(self.chunk_size):
+                self._write(chunk)
+                self.count += len(chunk)
+        profiling.count("rows_written", len(qc_data))
+
+    def flush(self) -> None:
+        """make rows written so far visible to readers of the file"""
+        self.file.flush()
+
+    def close(self) -> None:
+        if not self.file.closed:
+            with profiling.span("write_output"):
+                self._end()
+                self.file.close()
+
+    def _begin(self) -> None:
+        pass
+
+    def _write(self, qc_data: QCRatingsData) -> None:
+        raise NotImplementedError
+
+    def _end(self) -> None:
+        pass
+
+
+class CSVRatingsWriter(RatingsWriter):
+    """writes one row per subject with the rating and the probability of each rating"""
+
+    newline = ""
+    appendable = True
+
+    def _begin(self) -> None:
+        self._writer = csv.writer(self.file)
+        # a file being appended to already has a header
+        self._has_header = self.file.tell() > 0
+
+    def _write(self, qc_data: QCRatingsData) -> None:
+        # the header depends on the models of the first chunk
+        if not self._has_header:
+            self._writer.writerow(qc_data.get_column_names())
+            self._has_header = True
+        subject_ids = qc_data.subject_ids.astype(str).tolist()
+        columns = [subject_ids]
+        for ratings, probabilities in _iter_results(qc_data):
+            columns += [
+                format_labels(ratings),
+                format_rounded(probabilities[:, 0]),
+                format_rounded(probabilities[:, 1]),
+            ]
+        for features, contributions in _iter_explanations(qc_data):
+            columns += [features, format_rounded(contributions)]
+        # only subject IDs can contain characters that the csv module would quote
+        if any(char in "".join(subject_ids) for char in ',"\r\n'):
+            self._writer.writerows(zip(*columns))
+        elif subject_ids:
+            self.file.write("\r\n".join(map(",".join, zip(*columns))) + "\r\n")
+
+    def _end(self) -> None:
+        if not self._has_header:
+            self._writer.writerow(QCRatingsData.column_names)
+
+
+class JSONRatingsWriter(RatingsWriter):
+    """writes a single object keyed by subject ID, formatted like json.dump with indent=2"""
+
+    def _begin(self) -> None:
+        self.file.write("{")
+
+    def _write(self, qc_data: QCRatingsData) -> None:
+        if not len(qc_data):
+            return
+        template = "%s: " + _entry_template(
+            list(qc_data.models), indent=2, n_explained=qc_data.n_explained
+        ).replace("\n", "\n  ")
+        self.file.write(
+            (",\n  " if self.count else "\n  ")
+            + ",\n  ".join(
+                [template % row for row in zip(*_format_entry_columns(qc_data))]
+            )
+        )
+
+    def _end(self) -> None:
+        self.file.write("\n}" if self.count else "}")
+
+
+class NDJSONRatingsWriter(RatingsWriter):
+    """writes one JSON object per line, so output can be consumed while it is written"""
+
+    appendable = True
+
+    def _write(self, qc_data: QCRatingsData) -> None:
+        template = (
+            _entry_template(
+                list(qc_data.models), subject_id=True, n_explained=qc_data.n_explained
+            )
+            + "\n"
+        )
+        self.file.write(
+            "".join([template % row for row in zip(*_format_entry_columns(qc_data))])
+        )
+
+
+class NPZRatingsWriter(RatingsWriter):
+    """writes subject IDs, ratings and unrounded probabilities as arrays that can be memory-mapped
+
+    The archive cannot be appended to, so chunks are held until the writer is closed.
+    """
+
+    mode = "wb"
+
+    def _begin(self) -> None:
+        self._chunks: list[QCRatingsData] = []
+
+    def _write(self, qc_data: QCRatingsData) -> None:
+        self._chunks.append(qc_data)
+
+    def _end(self) -> None:
+        models: dict[str, np.ndarray] = {}
+        for name in self._chunks[0].models if self._chunks else ():
+            models[f"ratings[{name}]"] = np.concatenate(
+                [qc_data.models[name][0] for qc_data in self._chunks]
+            )
+            models[f"probabilities[{name}]"] = np.concatenate(
+                [qc_data.models[name][1] for qc_data in self._chunks]
+            )
+        if self._chunks and self._chunks[0].explanations is not None:
+            # feature names rather than indices, so the file does not depend on their order
+            models["explanation_features"] = CivetData.feature_names[
+                np.concatenate([qc_data.explanations[0] for qc_data in self._chunks])
+            ]
+            models["explanation_contributions"] = np.concatenate(
+                [qc_data.explanations[1] for qc_data in self._chunks]
+            )
+        np.savez(
+            self.file,
+            **models,
+            subject_ids=np.concatenate(
+                [qc_data.subject_ids.astype(str) for qc_data in self._chunks]
+                or [np.array([], dtype=str)]
+            ),
+            ratings=np.concatenate(
+                [np.asarray(qc_data.ratings, dtype=int) for qc_data in self._chunks]
+                or [np.array([], dtype=int)]
+            ),
+            probabilities=np.concatenate(
+                [qc_data.probabilities for qc_data in self._chunks]
+                or [np.empty((0, 2))]
+            ),
+        )
+
+
+class ArrowRatingsWriter(RatingsWriter):
+    """writes an Arrow IPC file with the columns of the CSV output and unrounded probabilities"""
+
+    mode = "wb"
+
+    def __init__(self, filepath: Path | str, append: bool = False) -> None:
+        # fail before the output file is created if pyarrow is not installed
+        self._pa = import_optional("pyarrow", "arrow")
+        super().__init__(filepath, append)
+
+    def _begin(self) -> None:
+        self._writer: Any = None
+
+    def _write(self, qc_data: QCRatingsData) -> None:
+        table = qc_data._to_arrow_table()
+        # the schema depends on the models of the first chunk
+        if self._writer is None:
+            self._writer = self._new_writer(table.schema)
+        self._writer.write_table(table)
+
+    def _end(self) -> None:
+        if self._writer is None:
+            self._writer = self._new_writer(QCRatingsData._arrow_schema())
+        self._writer.close()
+
+    def _new_writer(self, schema: Any) -> Any:
+        return self._pa.ipc.new_file(self.file, schema)
+
+
+class ParquetRatingsWriter(ArrowRatingsWriter):
+    """writes a Parquet file with one row group per chunk"""
+
+    def _new_writer(self, schema: Any) -> Any:
+        pq = import_optional("pyarrow.parquet", "arrow")
+        return pq.ParquetWriter(self.file, schema)
+
+
+def format_rounded(values: np.ndarray, json_compatible: bool = False) -> list[str]:
+    """return str(round(value, 3)) for each value of a float64 column, formatted at once"""
+    rounded = np.round(np.asarray(values, dtype=np.float64), 3)
+    text = rounded.astype(str)
+    if json_compatible and not np.isfinite(rounded).all():
+        for value, literal in (
+            ("nan", "NaN"),
+            ("inf", "Infinity"),
+            ("-inf", "-Infinity"),
+        ):
+            text[text == value] = literal
+    return text.tolist()
+
+
+def format_labels(ratings: np.ndarray) -> list[str]:
+    """return the label of each rating, raising KeyError for ratings without a label"""
+    labels = QCRatingsData.rating_labels
+    ratings = np.asarray(ratings)
+    if ratings.size == 0:
+        return []
+    elif ratings.dtype.kind not in "iu":
+        invalid = ratings.ravel()
+    else:
+        invalid = ratings[~np.isin(ratings, list(labels))]
+    if invalid.size:
+        raise KeyError(invalid[0])
+    return np.array([labels[index] for index in range(len(labels))])[ratings].tolist()
+
+
+def _iter_results(qc_data: QCRatingsData) -> list[tuple[np.ndarray, np.ndarray]]:
+    return [(qc_data.ratings, qc_data.probabilities), *qc_data.models.values()]
+
+
+def _iter_explanations(qc_data: QCRatingsData) -> list[tuple[list[str], np.ndarray]]:
+    """return the names and contributions of the explaining features of each rank"""
+    if qc_data.explanations is None:
+        return []
+    features, contributions = qc_data.explanations
+    names = CivetData.feature_names[features]
+    return [
+        (names[:, rank].tolist(), contributions[:, rank])
+        for rank in range(qc_data.n_explained)
+    ]
+
+
+def _format_entry_columns(qc_data: QCRatingsData) -> list[list[str]]:
+    """return the JSON-encoded subject IDs and values of the entries of to_dict, as columns"""
+    subject_ids = qc_data.subject_ids.astype(str).tolist()
+    joined = "".join(subject_ids)
+    if (
+        joined.isascii()
+        and joined.isprintable()
+        and not any(c in joined for c in '"\\')
+    ):
+        columns = [[f'"{subject_id}"' for subject_id in subject_ids]]
+    else:
+        columns = [[json.dumps(subject_id) for subject_id in subject_ids]]
+    for ratings, probabilities in _iter_results(qc_data):
+        columns += [
+            [json.dumps(label) for label in format_labels(ratings)],
+            format_rounded(probabilities[:, 0], json_compatible=True),
+            format_rounded(probabilities[:, 1], json_compatible=True),
+        ]
+    for names, contributions in _iter_explanations(qc_data):
+        columns += [
+            [f'"{name}"' for name in names],
+            format_rounded(contributions, json_compatible=True),
+        ]
+    return columns
+
+
+def _entry_template(
+    model_names: list[str],
+    indent: int | None = None,
+    subject_id: bool = False,
+    n_explained: int = 0,
+) -> str:
+    """return the JSON of an entry of to_dict, with %s for each value in column order
+
+    The template is rendered by json.dumps from an entry of placeholders, so that it is
+    formatted exactly as json.dumps would format each entry.
+    """
+    n_values = 1 + 3 * (1 + len(model_names)) + 2 * n_explained
+    placeholders = iter(range(n_values))
+
+    def result() -> dict:
+        labels = QCRatingsData.rating_labels
+        return {
+            "rating": f"<{next(placeholders)}>",
+            "probabilities": {
+                labels[0]: f"<{next(placeholders)}>",
+                labels[1]: f"<{next(placeholders)}>",
+            },
+        }
+
+    entry = {"subject_id": f"<{next(placeholders)}>"} if subject_id else {}
+    if not subject_id:
+        next(placeholders)
+    entry.update(result())
+    if model_names:
+        entry["models"] = {name: result() for name in model_names}
+    if n_explained:
+        entry["explanation"] = [
+            {
+                "feature": f"<{next(placeholders)}>",
+                "contribution": f"<{next(placeholders)}>",
+            }
+            for _ in range(n_explained)
+        ]
+    template = json.dumps(entry, indent=indent).replace("%", "%%")
+    for index in range(n_values):
+        template = template.replace(f'"<{index}>"', "%s")
+    return template
+
+
+RATINGS_WRITERS: dict[str, type[RatingsWriter]] = {
+    "csv": CSVRatingsWriter,
+    "json": JSONRatingsWriter,
+    "ndjson": NDJSONRatingsWriter,
+    "npz": NPZRatingsWriter,
+    "parquet": ParquetRatingsWriter,
+    "arrow": ArrowRatingsWriter,
+}
@@ -1,6 +1,13 @@
+import csv
+import importlib.util
+import json
 import os
 import shutil
+import tempfile
+import threading
 import unittest
+import urllib.error
+import urllib.request
 
 from pathlib import Path
 from pkg_resources import resource_filename
@@ -8,10 +15,27 @@ from unittest.mock import patch
 
 import numpy as np
 
-from civetqc import utils
+from civetqc import profiling, utils
 
-from civetqc.data import CivetData, QCRatingsData
+from civetqc.artifact import ModelArtifact
+from civetqc.cache import PredictionCache
+from civetqc.data import CivetData, QCRatingsData, StringTable
+from civetqc.discovery import OutputFileIndex
+from civetqc.exceptions import (
+    ColumnNotFoundError,
+    IncompleteShardsError,
+    InvalidModelArtifactError,
+    ModelNotFoundError,
+    NonNumericValueError,
+    NonUniqueIDsError,
+)
 from civetqc.main import main
+from civetqc.model import Model
+from civetqc.parallel import ParallelScorer
+from civetqc.registry import ModelRegistry
+from civetqc.server import PredictionServer
+from civetqc.watch import OutputFileScorer
+from civetqc.writers import RatingsWriter
 
 DUMMY_DATA_PATHS = {
     "csv": resource_filename(__name__, "dummy_data/dummy.csv"),
@@ -38,6 +62,524 @@ class TestData(unittest.TestCase):
             np.array_equal(data_from_csv.features, data_from_output_files.features)
         )
 
+    def test_from_csv_errors(self) -> None:
+        lines = Path(DUMMY_DATA_PATHS["csv"]).read_text().splitlines()
+        fields = lines[3].split(",")
+        lines[3] = ",".join([fields[0], "abc", *fields[2:]])
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            filepath = Path(tmp_dir, "invalid.csv")
+            filepath.write_text("\n".join(lines))
+            with self.assertRaisesRegex(NonNumericValueError, "'abc'.*line 4$"):
+                CivetData.from_csv(filepath, chunk_size=2)
+            self.assertRaises(ColumnNotFoundError, CivetData.from_csv, filepath, "X")
+
+    def test_from_output_files_workers(self) -> None:
+        sequential = CivetData.from_output_files(Path(DUMMY_DATA_PATHS["dir"]))
+        parallel = CivetData.from_output_files(Path(DUMMY_DATA_PATHS["dir"]), workers=4)
+        self.assertTrue(np.array_equal(sequential.subject_ids, parallel.subject_ids))
+        self.assertTrue(np.array_equal(sequential.features, parallel.features))
+
+    def test_archive(self) -> None:
+        expected = CivetData.from_output_files(Path(DUMMY_DATA_PATHS["dir"]))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for archive_format in ("gztar", "zip"):
+                filepath = shutil.make_archive(
+                    str(Path(tmp_dir, "verify")),
+                    archive_format,
+                    Path(DUMMY_DATA_PATHS["dir"]).parent,
+                    "verify",
+                )
+                data = CivetData.from_output_files(filepath)
+                self.assertTrue(np.array_equal(data.subject_ids, expected.subject_ids))
+                self.assertTrue(np.array_equal(data.features, expected.features))
+                chunks = list(CivetData.iter_output_files(filepath, chunk_size=150))
+                self.assertEqual([len(chunk) for chunk in chunks], [150, 150, 100])
+                subset = CivetData.from_output_files(
+                    filepath, subset_subject_ids=expected.subject_ids[:3]
+                )
+                self.assertTrue(
+                    np.array_equal(subset.subject_ids, expected.subject_ids[:3])
+                )
+
+    def test_npz(self) -> None:
+        data = CivetData.from_csv(DUMMY_DATA_PATHS["csv"])
+        qc_data = QCRatingsData(
+            data.subject_ids, np.arange(len(data.subject_ids)) % 2, data.features[:, :2]
+        )
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            data.to_npz(Path(tmp_dir, "features.npz"))
+            loaded = CivetData.from_npz(Path(tmp_dir, "features.npz"))
+            self.assertIsInstance(loaded.features.base, np.memmap)
+            self.assertTrue(np.array_equal(loaded.subject_ids, data.subject_ids))
+            self.assertTrue(np.array_equal(loaded.features, data.features))
+            qc_data.to_npz(Path(tmp_dir, "ratings.npz"))
+            loaded_ratings = QCRatingsData.from_npz(Path(tmp_dir, "ratings.npz"))
+            self.assertTrue(np.array_equal(loaded_ratings.ratings, qc_data.ratings))
+            self.assertTrue(
+                np.array_equal(loaded_ratings.probabilities, qc_data.probabilities)
+            )
+
+    def test_compact(self) -> None:
+        subject_ids = np.array(["sub-02", "sub-1", "", "süb-ß"])
+        table = StringTable.from_array(subject_ids)
+        self.assertTrue(np.array_equal(table.to_array(), subject_ids))
+        self.assertEqual(table[3], "süb-ß")
+        self.assertTrue(np.array_equal(table[1:3].to_array(), subject_ids[1:3]))
+
+        civet_data = CivetData.from_csv(DUMMY_DATA_PATHS["csv"], compact=True)
+        self.assertEqual(civet_data.features.dtype, np.float32)
+        model = Model.load()
+        probabilities = model.predict_probabilities(civet_data.features)
+        qc_data = QCRatingsData(
+            civet_data.subject_ids,
+            model.ratings_from_probabilities(probabilities),
+            probabilities,
+        )
+        compact_qc_data = qc_data.to_compact()
+        self.assertEqual(compact_qc_data.ratings.dtype, np.int8)
+        self.assertTrue(np.allclose(compact_qc_data.probabilities, probabilities))
+        self.assertRaises(AttributeError, setattr, compact_qc_data, "extra", None)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            qc_data.to_json(Path(tmp_dir, "expected.json"))
+            compact_qc_data.to_json(Path(tmp_dir, "compact.json"))
+            self.assertEqual(
+                Path(tmp_dir, "expected.json").read_text(),
+                Path(tmp_dir, "compact.json").read_text(),
+            )
+
+    def test_index(self) -> None:
+        civet_data = CivetData.from_csv(DUMMY_DATA_PATHS["csv"])
+        subject_ids = civet_data.subject_ids
+        self.assertTrue(
+            np.array_equal(civet_data[subject_ids[5]], civet_data.features[5])
+        )
+        self.assertNotIn("not_a_subject", civet_data)
+        self.assertRaises(KeyError, civet_data.__getitem__, "not_a_subject")
+
+        subset = civet_data.subset([subject_ids[9], "not_a_subject", subject_ids[2]])
+        self.assertEqual(list(subset.subject_ids), [subject_ids[2], subject_ids[9]])
+
+        combined = CivetData.concat(
+            [civet_data.subset(subject_ids[1::2]), civet_data.subset(subject_ids[::2])]
+        )
+        self.assertTrue(np.array_equal(combined.subject_ids, subject_ids))
+        self.assertTrue(np.array_equal(combined.features, civet_data.features))
+        self.assertRaises(NonUniqueIDsError, CivetData.concat, [subset, civet_data])
+
+        qc_data = QCRatingsData.from_csv(DUMMY_DATA_PATHS["csv"])
+        joined_civet_data, joined_qc_data = subset.join(qc_data)
+        self.assertTrue(
+            np.array_equal(joined_civet_data.subject_ids, joined_qc_data.subject_ids)
+        )
+        self.assertEqual(len(joined_qc_data), 2)
+
+    def test_writers(self) -> None:
+        qc_data = QCRatingsData(
+            np.array(["sub,1", 'sub"2', "süb-3"]),
+            np.array([0, 1, 0]),
+            np.array([[0.8, 0.2], [0.1005, 0.8995], [1.0, 0.0]]),
+            models={"alt": (np.array([1, 1, 0]), np.array([[0.4, 0.6]] * 3))},
+        )
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            qc_data.to_json(Path(tmp_dir, "civetqc.json"))
+            self.assertEqual(
+                Path(tmp_dir, "civetqc.json").read_text(),
+                json.dumps(qc_data.to_dict(), indent=2),
+            )
+            qc_data.to_csv(Path(tmp_dir, "civetqc.csv"))
+            with open(Path(tmp_dir, "civetqc.csv"), "r", newline="") as file:
+                rows = list(csv.reader(file))
+            self.assertEqual(rows[2][:4], ["sub,1", "PASS", "0.8", "0.2"])
+            self.assertEqual(rows[3][1:], ["PASS", "1.0", "0.0", "PASS", "0.4", "0.6"])
+
+    @unittest.skipUnless(importlib.util.find_spec("pyarrow"), "requires pyarrow")
+    def test_arrow(self) -> None:
+        data = CivetData.from_csv(DUMMY_DATA_PATHS["csv"])
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for output_format in ("parquet", "arrow"):
+                filepath = Path(tmp_dir, f"features.{output_format}")
+                getattr(data, f"to_{output_format}")(filepath)
+                loaded = getattr(CivetData, f"from_{output_format}")(filepath)
+                self.assertTrue(np.array_equal(loaded.subject_ids, data.subject_ids))
+                self.assertTrue(np.array_equal(loaded.features, data.features))
+
+
+class TestModel(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        from sklearn.ensemble import RandomForestClassifier
+        from sklearn.feature_selection import SelectPercentile, f_regression
+        from sklearn.pipeline import Pipeline
+        from sklearn.preprocessing import StandardScaler
+
+        cls.features = CivetData.from_csv(DUMMY_DATA_PATHS["csv"]).features
+        cls.ratings = QCRatingsData.from_csv(DUMMY_DATA_PATHS["csv"]).ratings
+        cls.clf = Pipeline(
+            [
+                ("scaler", StandardScaler()),
+                ("fs", SelectPercentile(score_func=f_regression, percentile=75)),
+                ("clf", RandomForestClassifier(n_estimators=20, random_state=0)),
+            ]
+        ).fit(cls.features, cls.ratings)
+
+    def test_compile(self) -> None:
+        expected = self.clf.predict_proba(self.features)
+        model = Model(self.clf, 0.5).compile()
+        for n_rows in (1, len(self.features)):
+            self.assertTrue(
+                np.allclose(
+                    model.predict_probabilities(self.features[:n_rows]),
+                    expected[:n_rows],
+                    rtol=0,
+                    atol=1e-12,
+                )
+            )
+
+    def test_non_finite(self) -> None:
+        model = Model(self.clf, 0.5).compile()
+        for value in (np.nan, np.inf):
+            features = self.features[:3].copy()
+            features[1, 4] = value
+            self.assertRaises(ValueError, model.predict_probabilities, features)
+            self.assertRaises(ValueError, model.explain, features)
+
+    def test_explain(self) -> None:
+        model = Model(self.clf, 0.5)
+        contributions = model.explain(self.features)
+        self.assertEqual(contributions.shape, self.features.shape)
+        self.assertTrue(
+            np.allclose(
+                model.expected_value + contributions.sum(axis=1),
+                self.clf.predict_proba(self.features)[:, 1],
+                rtol=0,
+                atol=1e-12,
+            )
+        )
+        # tree by tree, as for large batches
+        with patch.object(model.forest, "batch_elements", 0):
+            self.assertTrue(
+                np.allclose(model.explain(self.features), contributions, atol=1e-12)
+            )
+
+    def test_score(self) -> None:
+        import civetqc
+
+        model = Model(self.clf, 0.5)
+        ids = np.array([f"sub-{i:03d}" for i in range(len(self.features))])[::-1]
+        result = civetqc.score(self.features, ids, model=model)
+        np.testing.assert_array_equal(result["id"], ids)
+        np.testing.assert_allclose(
+            result["p_fail"], model.predict_probabilities(self.features)[:, 1]
+        )
+        np.testing.assert_array_equal(result["rating"], model.predict(self.features))
+        self.assertTrue(np.shares_memory(result["p_fail"], result))
+        columns = list(CivetData.feature_names[::-1])
+        reordered = civetqc.score(
+            memoryview(np.ascontiguousarray(self.features[:, ::-1])),
+            ids,
+            columns,
+            model=model,
+            sort=True,
+        )
+        np.testing.assert_array_equal(reordered, result[::-1])
+        with self.assertRaises(ValueError):
+            civetqc.score(self.features[:, 1:], columns=columns[1:], model=model)
+        with self.assertRaises(ValueError):
+            civetqc.score(self.features, model=model, sort=True)
+
+    def test_prune(self) -> None:
+        from civetqc.compress import select_trees
+
+        forest = Model(self.clf, 0.5).compile().forest
+        leaves = forest.apply(self.features)
+        pruned = forest.prune([3, 0])
+        np.testing.assert_allclose(
+            pruned.predict_probabilities(self.features),
+            forest.value[leaves[:, [3, 0]]].mean(axis=1),
+        )
+        capped = forest.prune(max_depth=2)
+        self.assertEqual(capped.depths.max(), 2)
+        self.assertLess(capped.n_nodes, forest.n_nodes)
+        trees = select_trees(forest, self.features, forest.n_trees)
+        self.assertEqual(sorted(trees), list(range(forest.n_trees)))
+        np.testing.assert_allclose(
+            forest.prune(trees).predict_probabilities(self.features),
+            forest.predict_probabilities(self.features),
+        )
+
+    def test_parallel(self) -> None:
+        model = Model(self.clf, 0.5)
+        expected = model.predict_probabilities(self.features)
+        with patch.object(ParallelScorer, "min_rows", 50), model.parallel(2):
+            self.assertIsNotNone(model._scorer)
+            probabilities = model.predict_probabilities(self.features)
+        self.assertIsNone(model._scorer)
+        self.assertTrue(np.allclose(probabilities, expected, rtol=0, atol=1e-12))
+
+    def test_save_load(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            Model(self.clf, 0.3).save(tmp_dir)
+            self.assertEqual(Model.get_default_threshold(tmp_dir), 0.3)
+            model = Model.load(tmp_dir)
+            self.assertIs(model, Model.load(tmp_dir))
+            self.assertTrue(
+                np.array_equal(
+                    model.predict_probabilities(self.features),
+                    self.clf.predict_proba(self.features),
+                )
+            )
+            ModelArtifact(tmp_dir).verify()
+            with open(Path(tmp_dir, "threshold.npy"), "r+b") as file:
+                file.seek(-1, os.SEEK_END)
+                file.write(b"\x00")
+            self.assertRaises(InvalidModelArtifactError, ModelArtifact(tmp_dir).verify)
+
+
+class TestTrain(unittest.TestCase):
+    def test_resume(self) -> None:
+        from sklearn.ensemble import RandomForestClassifier
+
+        from civetqc.train import CheckpointedSearch, forest_distribution, make_pipeline
+
+        features = CivetData.from_csv(DUMMY_DATA_PATHS["csv"]).features
+        ratings = QCRatingsData.from_csv(DUMMY_DATA_PATHS["csv"]).ratings.astype(int)
+        distribution = dict(
+            forest_distribution,
+            clf=(RandomForestClassifier(n_estimators=5, random_state=0),),
+        )
+        with tempfile.TemporaryDirectory() as tmp_dir, patch("sys.stdout") as stdout:
+            searches = [
+                CheckpointedSearch(
+                    make_pipeline(random_state=0),
+                    distribution,
+                    tmp_dir,
+                    n_iter=6,
+                    cv=2,
+                    batch_size=2,
+                ).fit(features, ratings)
+                for _ in range(2)
+            ]
+        stdout.write.assert_not_called()
+        self.assertGreater(searches[0].evaluated_count, 0)
+        self.assertEqual(searches[1].evaluated_count, 0)
+        self.assertEqual(searches[0].best_index_, searches[1].best_index_)
+
+    def test_update(self) -> None:
+        from civetqc.update import OutOfBagCache, update_model
+
+        civet_data = CivetData.from_csv(DUMMY_DATA_PATHS["csv"])
+        ratings = QCRatingsData.from_csv(DUMMY_DATA_PATHS["csv"]).ratings
+        model = Model.load()
+        updated, cache, _ = update_model(
+            model,
+            civet_data.subject_ids[:300],
+            civet_data.features[:300],
+            ratings[:300],
+            n_trees=5,
+        )
+        self.assertEqual(updated.forest.n_trees, model.forest.n_trees + 5)
+        self.assertTrue(np.all(cache.n_trees >= model.forest.n_trees))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            updated.save(tmp_dir)
+            cache.save(tmp_dir)
+            updated = Model.load(tmp_dir)
+            cache = OutOfBagCache.load(tmp_dir)
+        # subjects rated again are replaced, the others are scored by every new tree
+        updated_again, cache_again, _ = update_model(
+            updated,
+            civet_data.subject_ids[200:],
+            civet_data.features[200:],
+            ratings[200:],
+            cache,
+            n_trees=5,
+        )
+        self.assertEqual(len(cache_again), len(civet_data))
+        np.testing.assert_array_equal(
+            cache_again.n_trees[:200], cache.n_trees[:200] + 5
+        )
+        np.testing.assert_array_equal(cache_again.ratings, ratings.astype(int))
+        self.assertTrue(0 < updated_again.default_threshold < 1)
+
+
+class TestThresholds(unittest.TestCase):
+    def test_sweep_thresholds(self) -> None:
+        from civetqc.thresholds import best_threshold, summarize, sweep_thresholds
+
+        rng = np.random.default_rng(0)
+        p_fail = np.round(rng.random(1000), 2)
+        labels = (rng.random(1000) < p_fail).astype(int)
+        table = sweep_thresholds(np.column_stack([1 - p_fail, p_fail]), labels)
+        n_thresholds = len(np.unique(p_fail)) + (p_fail.min() > 0)
+        self.assertEqual(len(table["threshold"]), n_thresholds)
+        for index, threshold in enumerate(table["threshold"]):
+            predicted = p_fail > threshold
+            self.assertEqual(table["fail_count"][index], predicted.sum())
+            self.assertEqual(
+                table["true_positives"][index], (predicted & (labels == 1)).sum()
+            )
+        current = summarize(table, 0.5)["current"]
+        self.assertEqual(current["fail_count"], (p_fail > 0.5).sum())
+        threshold, fbeta = best_threshold(p_fail, labels)
+        self.assertEqual(fbeta, table["fbeta"].max())
+        self.assertTrue(0 < threshold < 1)
+
+
+class TestWatch(unittest.TestCase):
+    def test_step(self) -> None:
+        filenames = sorted(os.listdir(DUMMY_DATA_PATHS["dir"]))[:3]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            input_dir = Path(tmp_dir, "qc")
+            input_dir.mkdir()
+            output_filepath = Path(tmp_dir, "civetqc_watch.csv")
+            with RatingsWriter.open(output_filepath, "csv", append=True) as writer:
+                scorer = OutputFileScorer(
+                    input_dir, Model.load(), writer, settle=0, poll_interval=0
+                )
+                self.assertEqual(scorer.step(0), 0)
+                for filename in filenames:
+                    shutil.copy(Path(DUMMY_DATA_PATHS["dir"], filename), input_dir)
+                Path(input_dir, "notes.txt").write_text("not a QC file")
+                self.assertEqual(scorer.step(0), 3)
+                self.assertEqual(scorer.step(0), 0)
+                scorer.close()
+            qc_data = QCRatingsData.from_csv(
+                output_filepath, qcvar="RATING", allow_non_numeric=True
+            )
+            self.assertEqual(
+                list(qc_data.subject_ids),
+                sorted(map(CivetData.get_subject_id, filenames)),
+            )
+
+    def test_incomplete(self) -> None:
+        lines = Path(DUMMY_DATA_PATHS["dir"], "dummy_0_civet_qc.txt").read_text()
+        lines = lines.splitlines()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            input_dir = Path(tmp_dir, "qc")
+            input_dir.mkdir()
+            output_filepath = Path(tmp_dir, "civetqc_watch.csv")
+            with RatingsWriter.open(output_filepath, "csv", append=True) as writer:
+                scorer = OutputFileScorer(
+                    input_dir, Model.load(), writer, settle=0, poll_interval=0
+                )
+                # each file lacks features the other has, so neither may be scored
+                Path(input_dir, "a_civet_qc.txt").write_text("\n".join(lines[:10]))
+                Path(input_dir, "b_civet_qc.txt").write_text("\n".join(lines[10:]))
+                with patch("sys.stderr"):
+                    self.assertEqual(scorer.step(0), 0)
+                scorer.close()
+
+
+class TestDiscovery(unittest.TestCase):
+    def test_walk(self) -> None:
+        filenames = sorted(os.listdir(DUMMY_DATA_PATHS["dir"]))[:6]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            root = Path(tmp_dir, "root")
+            for i, filename in enumerate(filenames):
+                dir_path = root.joinpath(f"s{i}", "verify")
+                dir_path.mkdir(parents=True)
+                shutil.copy(Path(DUMMY_DATA_PATHS["dir"], filename), dir_path)
+            # directories modified within the last seconds are always listed again
+            for dir_path in [root, *root.glob("*"), *root.glob("*/*")]:
+                os.utime(dir_path, ns=(10**18, 10**18))
+            index_filepath = Path(tmp_dir, OutputFileIndex.filename)
+
+            with OutputFileIndex(index_filepath) as index:
+                found = index.walk([root], workers=2)
+                self.assertEqual(index.listed_count, 13)
+            expected = sorted(map(CivetData.get_subject_id, filenames))
+            self.assertEqual(sorted(subject_id for subject_id, *_ in found), expected)
+            with OutputFileIndex(index_filepath) as index:
+                self.assertEqual(sorted(index.walk([root])), sorted(found))
+                self.assertEqual(index.listed_count, 0)
+                self.assertEqual(index.walk([root], max_depth=1), [])
+                self.assertEqual(len(index.walk([root], "s1/*")), 1)
+
+            shutil.rmtree(root.joinpath("s0"))
+            os.utime(root, ns=(11 * 10**17, 11 * 10**17))
+            with OutputFileIndex(index_filepath) as index:
+                self.assertEqual(len(index.walk([root])), len(filenames) - 1)
+                self.assertEqual(index.listed_count, 1)
+
+
+class TestCache(unittest.TestCase):
+    def test_predict_output_files(self) -> None:
+        model = Model.load()
+        expected = model.predict_probabilities(
+            CivetData.from_output_files(DUMMY_DATA_PATHS["dir"]).features
+        )
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            input_dir = Path(tmp_dir, "verify")
+            shutil.copytree(DUMMY_DATA_PATHS["dir"], input_dir)
+            with PredictionCache(Path(tmp_dir, "cache.sqlite"), "test") as cache:
+                qc_data = cache.predict_output_files(input_dir, model)
+                self.assertEqual(cache.scored_count, 400)
+                self.assertTrue(np.allclose(qc_data.probabilities, expected))
+
+                input_dir.joinpath("dummy_0_civet_qc.txt").write_text(
+                    input_dir.joinpath("dummy_1_civet_qc.txt").read_text()
+                )
+                os.remove(input_dir.joinpath("dummy_2_civet_qc.txt"))
+                qc_data = cache.predict_output_files(input_dir, model)
+                self.assertEqual((cache.parsed_count, cache.scored_count), (1, 1))
+                self.assertEqual(len(qc_data.subject_ids), 399)
+                self.assertTrue(
+                    np.array_equal(qc_data.probabilities[0], qc_data.probabilities[1])
+                )
+
+
+class TestServer(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.server = PredictionServer(Model.load())
+        cls.httpd = cls.server.serve_tcp("127.0.0.1", 0)
+        cls.url = f"http://127.0.0.1:{cls.httpd.server_address[1]}"
+        threading.Thread(target=cls.httpd.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.httpd.shutdown()
+        cls.httpd.server_close()
+        cls.server.close()
+
+    def post(self, path: str, body: bytes, content_type: str) -> dict:
+        request = urllib.request.Request(
+            self.url + path, body, {"Content-Type": content_type}
+        )
+        with urllib.request.urlopen(request) as response:
+            return json.load(response)
+
+    def test_predict(self) -> None:
+        civet_data = CivetData.from_output_files(DUMMY_DATA_PATHS["dir"])
+        expected = QCRatingsData(
+            civet_data.subject_ids[:2],
+            Model.load().predict(civet_data.features[:2]),
+            Model.load().predict_probabilities(civet_data.features[:2]),
+        ).to_dict()
+        text = Path(DUMMY_DATA_PATHS["dir"], "dummy_0_civet_qc.txt").read_text()
+        result = self.post("/predict?id=dummy_0", text.encode(), "text/plain")
+        self.assertEqual(result, {"dummy_0": expected["dummy_0"]})
+        records = [
+            {"subject_id": subject_id, "features": row.tolist()}
+            for subject_id, row in zip(civet_data.subject_ids[:2], civet_data.features)
+        ]
+        result = self.post("/predict", json.dumps(records).encode(), "application/json")
+        self.assertEqual(result, expected)
+        with urllib.request.urlopen(self.url + "/metrics") as response:
+            self.assertGreaterEqual(json.load(response)["requests"], 2)
+
+    def test_invalid_request(self) -> None:
+        with self.assertRaises(urllib.error.HTTPError) as context:
+            self.post("/predict", b"MASK_ERROR=1", "text/plain")
+        self.assertEqual(context.exception.code, 400)
+        with self.assertRaises(urllib.error.HTTPError) as context:
+            self.post("/predict", b"[1, 2]", "application/json")
+        self.assertEqual(context.exception.code, 400)
+        text = Path(DUMMY_DATA_PATHS["dir"], "dummy_0_civet_qc.txt").read_bytes()
+        for threshold in ("-3", "nan"):
+            with self.assertRaises(urllib.error.HTTPError) as context:
+                self.post(f"/predict?threshold={threshold}", text, "text/plain")
+            self.assertEqual(context.exception.code, 400)
+
 
 class TestMain(unittest.TestCase):
     @classmethod
@@ -79,6 +621,110 @@ class TestMain(unittest.TestCase):
         self.assertEqual(sum(data.ratings == "PASS"), EXPECTED_RESULTS["PASS"])
         self.assertEqual(sum(data.ratings == "FAIL"), EXPECTED_RESULTS["FAIL"])
 
+    def test_chunk_size(self) -> None:
+        args = ["civetqc", DUMMY_DATA_PATHS["csv"], "--output_dir", TEST_OUTPUT_DIR]
+        output_file = os.path.join(TEST_OUTPUT_DIR, "civetqc.json")
+        results = []
+        for extra_args in (["--no_sort"], ["--chunk_size", "7"]):
+            with patch("sys.argv", args + ["--output_format", "json"] + extra_args):
+                main()
+            with open(output_file, "r") as file:
+                results.append(file.read())
+        self.assertEqual(results[0], results[1])
+
+    def test_shard_merge(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            args = ["civetqc", DUMMY_DATA_PATHS["dir"], "--output_dir", tmp_dir]
+            with patch("sys.argv", args + ["--output_format", "ndjson"]):
+                main()
+            for index in range(3):
+                with patch("sys.argv", args + ["--shard", f"{index}/3"]):
+                    main()
+            merge_args = ["civetqc", "merge", tmp_dir, "--output_dir", TEST_OUTPUT_DIR]
+            with patch("sys.argv", merge_args + ["--output_format", "ndjson"]):
+                main()
+            self.assertEqual(
+                Path(TEST_OUTPUT_DIR, "civetqc.ndjson").read_text(),
+                Path(tmp_dir, "civetqc.ndjson").read_text(),
+            )
+            with patch("sys.argv", merge_args + ["--output_format", "npz"]):
+                self.assertRaises(ValueError, main)
+            os.remove(Path(tmp_dir, "civetqc_shard_1_of_3.csv"))
+            with patch("sys.argv", merge_args):
+                self.assertRaises(IncompleteShardsError, main)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            args = ["civetqc", DUMMY_DATA_PATHS["dir"], "--output_dir", tmp_dir]
+            with patch("sys.argv", args + ["--output_format", "npz"]):
+                main()
+            for index in range(3):
+                with patch(
+                    "sys.argv",
+                    args + ["--shard", f"{index}/3", "--output_format", "npz"],
+                ):
+                    main()
+            merge_args = ["civetqc", "merge", tmp_dir, "--output_dir", TEST_OUTPUT_DIR]
+            with patch("sys.argv", merge_args + ["--output_format", "npz"]):
+                main()
+            merged = QCRatingsData.from_npz(Path(TEST_OUTPUT_DIR, "civetqc.npz"))
+            expected = QCRatingsData.from_npz(Path(tmp_dir, "civetqc.npz"))
+            self.assertTrue(np.array_equal(merged.subject_ids, expected.subject_ids))
+            self.assertTrue(
+                np.array_equal(merged.probabilities, expected.probabilities)
+            )
+
+    def test_incompatible_args(self) -> None:
+        args = ["civetqc", DUMMY_DATA_PATHS["dir"], "--output_dir", TEST_OUTPUT_DIR]
+        for extra_args in (
+            ["--shard", "0/2", "--explain", "2"],
+            ["--chunk_size", "7", "--compact"],
+        ):
+            with patch("sys.argv", args + extra_args):
+                self.assertRaises(ValueError, main)
+        csv_args = ["civetqc", DUMMY_DATA_PATHS["csv"], "--output_dir", TEST_OUTPUT_DIR]
+        with patch("sys.argv", csv_args + ["--cache"]):
+            self.assertRaises(ValueError, main)
+        for extra_args in (["--cache", "--no_sort"], ["--cache", "--compact"]):
+            with patch("sys.argv", args + extra_args):
+                self.assertRaises(ValueError, main)
+
+    def test_model_registry(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            registry = ModelRegistry(Path(tmp_dir, "models"))
+            bundled = Model.load()
+            for threshold in (0.3, 0.2):
+                registry.register("alt", Model(None, threshold, forest=bundled.forest))
+            self.assertEqual(registry.versions("alt"), ["1", "2"])
+            self.assertEqual(registry.load("alt").default_threshold, 0.2)
+            self.assertRaises(ModelNotFoundError, registry.resolve, "alt@3")
+            args = ["civetqc", DUMMY_DATA_PATHS["csv"], "--output_dir", tmp_dir]
+            with patch(
+                "sys.argv",
+                args
+                + ["--model", "bundled,alt@1", "--model_dir", str(registry.path)]
+                + ["--output_format", "npz"],
+            ):
+                main()
+            qc_data = QCRatingsData.from_npz(Path(tmp_dir, "civetqc.npz"))
+            ratings, probabilities = qc_data.models["alt@1"]
+            self.assertTrue(np.array_equal(probabilities, qc_data.probabilities))
+            self.assertTrue(
+                np.array_equal(ratings, (probabilities[:, 1] > 0.3).astype(int))
+            )
+
+
+class TestProfiling(unittest.TestCase):
+    def test_profile(self) -> None:
+        profiling.count("files_read")
+        with profiling.profile() as profiler:
+            civet_data = CivetData.from_output_files(Path(DUMMY_DATA_PATHS["dir"]))
+            Model.load().predict_probabilities(civet_data.features)
+        profiling.count("files_read")
+        report = profiler.report()
+        self.assertEqual(report["counters"]["files_read"], len(civet_data.subject_ids))
+        self.assertEqual(report["counters"]["rows_scored"], len(civet_data.subject_ids))
+        self.assertEqual(report["spans"]["read_output_files"]["calls"], 1)
+        self.assertIn("rows_scored_per_second", report["rates"])
+
 
 class TestUtils(unittest.TestCase):
     def test_get_non_unique(self) -> None: